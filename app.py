@@ -1,35 +1,93 @@
+import time
+_import_start = time.perf_counter()
 import os
-from typing import Any
+from typing import Any, Dict, List, Literal, Optional
 import uuid
-from fastapi import FastAPI, UploadFile, File, HTTPException, APIRouter, Depends
+from fastapi import FastAPI, HTTPException, APIRouter, Depends, Query, Request
 from fastapi.concurrency import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware   
 from sqlalchemy import text
-from services.db import get_session, init_db
-from services.documents import list_documents
-from services.history import append_history, get_history
-from services.ingest import ingest_pdf
-from schemas import UploadResponse, QueryRequest, QueryResponse
-from typing import Any, List, Dict
-from services.db import init_db, get_session
-from fastapi.responses import JSONResponse, StreamingResponse
+from services.db import close_db, get_session, init_db, maintenance_engine, pool_stats
+from services.documents import export_ndjson, export_npy, list_documents, parse_fields
+from services.context import context_packer
+from services.llm import llm_gateway
+from services.metrics import TimingMiddleware, render_metrics, startup_phase
+from services.history import get_history, history_writer, load_history_context, stop_summary_refreshes
+from services.jobs import job_manager
+from services.uploads import UploadError, save_pdf_upload
+from config import settings
+from schemas import IngestionJobStatus, QueryBatchRequest, QueryRequest, QueryResponse, RetrievalScope
+from fastapi.responses import JSONResponse, ORJSONResponse, Response, StreamingResponse
 import logging
-from fastapi import Query
-from services.query import answer_question, stream_answer
-
-logging.basicConfig(
-    level=logging.DEBUG,  # or DEBUG
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
+from services.query import answer_question, answer_questions, query_flights, stream_flights
+from services.streaming import stream_sse, stream_text
+from services.embeddings import batcher as embedding_batcher, cache as embedding_cache
+from services.answer_cache import answer_cache, answer_cache_sync
+from services.ann_index import ann_index
+from services.vector_index import vector_index
+from services.quantized import compact_vectors
+from services.collections import SearchFilters, collections, validate_collection
+from services.startup import readiness, warm_up
+from services.container import is_built
+import asyncio
+import orjson
 
 logger = logging.getLogger(__name__)
 
+# Services are built in lifespan (warm-up) or on first use, not on import
+startup_phase("import", time.perf_counter() - _import_start)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Application startup: initialize database
+    logging.basicConfig(
+        level=settings.log_level.upper(),  # LOG_LEVEL; DEBUG logs per-batch detail on the hot path
+        format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    started = time.perf_counter()
+    # Application startup: initialize database, start background workers
     await init_db()
+    await collections.ensure()
+    await job_manager.start()
+    await vector_index.ensure()
+    if compact_vectors:
+        await compact_vectors.ensure()
+    if answer_cache_sync:
+        answer_cache_sync.start()
+    ann_build = None
+    if ann_index and not ann_index.ready and settings.ann_build_on_startup:
+        # Queries use pgvector until the local index is built
+        ann_build = asyncio.create_task(ann_index.build_from_table(if_missing=True))
+        ann_build.add_done_callback(
+            lambda t: t.cancelled() or t.exception() is None or logger.error(f"ANN index build failed: {t.exception()}")
+        )
+    # Pool connections, first embedding, index load; /v1/ready says when done
+    warmup = asyncio.create_task(warm_up()) if settings.warmup_background else None
+    if warmup is None:
+        await warm_up()
+    startup_phase("lifespan", time.perf_counter() - started)
     yield
-    # Application shutdown: (no actions needed currently)
+    readiness.ready = False
+    if warmup is not None:
+        warmup.cancel()
+    if ann_build is not None:
+        ann_build.cancel()
+    await vector_index.stop()
+    if is_built(answer_cache_sync) and answer_cache_sync:
+        await answer_cache_sync.stop()
+    if is_built(compact_vectors) and compact_vectors:
+        await compact_vectors.index.stop()
+    # Application shutdown: stop background workers, close pooled connections
+    await job_manager.stop()
+    if is_built(history_writer):
+        await history_writer.aclose()  # flush buffered chat turns
+    await stop_summary_refreshes()
+    if is_built(embedding_batcher):
+        await embedding_batcher.aclose()
+    if is_built(llm_gateway):
+        await llm_gateway.aclose()
+    if is_built(embedding_cache) and embedding_cache:
+        embedding_cache.close()
+    await close_db()
 
 app = FastAPI(
     title="RAG Supabase FastAPI (SQLModel)",
@@ -59,10 +117,29 @@ app.add_middleware(
         "Authorization",
         "X-HTTP-Method-Override",
     ],
+    expose_headers=["Server-Timing", "x-conversation-id", "x-next-cursor"],
 )
+# Outermost, so the recorded duration covers the whole stack
+app.add_middleware(TimingMiddleware, probe_paths=["/v1/ready"])
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    # Prometheus scrape: rag_stage_seconds{stage=...}, rag_http_request_seconds{route=...}
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
 
 router_v1 = APIRouter(prefix="/v1")
 
+@router_v1.get(
+    "/ready",
+    tags=["Health"],
+    summary="Readiness probe",
+    description="200 once this worker's startup warm-up has finished, 503 before that and during shutdown. "
+                "Includes startup timings (import, lifespan, warm-up steps, time to ready and to the first request)."
+)
+async def ready():
+    return ORJSONResponse(readiness.stats(), status_code=200 if readiness.ready else 503)
+
 @router_v1.get("/test-db")
 async def test_db():
     try:
@@ -72,70 +149,335 @@ async def test_db():
     except Exception as e:
         return {"status": "error", "detail": str(e)}
 
+@router_v1.get(
+    "/stats/db-pool",
+    tags=["Stats"],
+    summary="Database connection pool statistics",
+    description="Returns size, checked-in/checked-out and overflow counts of this worker's pool."
+)
+async def db_pool_stats():
+    return pool_stats()
+
+@router_v1.get(
+    "/stats/embedding-cache",
+    tags=["Stats"],
+    summary="Query embedding cache statistics",
+    description="Hit/miss/eviction counters of this worker's query embedding cache."
+)
+async def embedding_cache_stats():
+    if not embedding_cache:
+        return {"enabled": False}
+    return {"enabled": True, **embedding_cache.stats()}
+
+@router_v1.get(
+    "/stats/llm",
+    tags=["Stats"],
+    summary="LLM gateway statistics",
+    description="In-flight and queued completions, queue wait and latency percentiles, retries and hedges of this worker's LLM gateway."
+)
+async def llm_stats():
+    return llm_gateway.stats()
+
+@router_v1.get(
+    "/stats/context-packing",
+    tags=["Stats"],
+    summary="Context packing counters",
+    description="Tokens of retrieved text before and after merging overlapping chunks and applying CONTEXT_TOKEN_BUDGET, summed over requests in this worker."
+)
+async def context_packing_stats():
+    return context_packer.stats()
+
+@router_v1.get(
+    "/stats/history-writer",
+    tags=["Stats"],
+    summary="Write-behind chat history buffer",
+    description="Unsaved turns, flushes, rows per multi-row insert, flush latency, turns dropped as unsaveable and backpressure waits of this worker's history writer."
+)
+async def history_writer_stats():
+    return history_writer.stats()
+
+@router_v1.get(
+    "/stats/coalescing",
+    tags=["Stats"],
+    summary="Single-flight query coalescing",
+    description="Leaders, followers that shared a run, late joiners of streams, failures and abandoned flights "
+                "for /v1/query and /v1/query-stream in this worker."
+)
+async def coalescing_stats():
+    return {"enabled": settings.query_coalescing_enabled, "query": query_flights.stats(), "stream": stream_flights.stats()}
+
+@router_v1.get(
+    "/stats/answer-cache",
+    tags=["Stats"],
+    summary="Semantic answer cache statistics",
+    description="Hit/miss/invalidation counters of this worker's /v1/query answer cache, and of its polling "
+                "for ingestions run by other workers (`sync`)."
+)
+async def answer_cache_stats():
+    if not answer_cache:
+        return {"enabled": False}
+    return {"enabled": True, **answer_cache.stats(), "sync": answer_cache_sync.stats() if answer_cache_sync else None}
+
+@router_v1.get(
+    "/stats/ann-index",
+    tags=["Stats"],
+    summary="Local ANN index statistics",
+    description="Version, row counts, size on disk and search counters of the memory-mapped retrieval index."
+)
+async def ann_index_stats():
+    if not ann_index:
+        return {"enabled": False}
+    return {"enabled": True, **ann_index.stats()}
+
+@router_v1.get(
+    "/index/vector",
+    tags=["Index"],
+    summary="pgvector index health",
+    description="Live vector indexes on documents.embedding (method, validity, size, options), "
+                "table size and warnings such as a missing, invalid or mis-sized index. With "
+                "VECTOR_COMPACT, `compact` reports the compact column's backfill progress, index and whether "
+                "search uses it yet (`search`: `two_phase`, or `full` while rows lack a compact value)."
+)
+async def vector_index_health():
+    health = await vector_index.health()
+    if compact_vectors:
+        health["compact"] = await compact_vectors.status()
+    return health
+
+@router_v1.post(
+    "/index/vector/rebuild",
+    status_code=202,
+    tags=["Index"],
+    summary="Create or rebuild the pgvector index",
+    description="Builds the VECTOR_INDEX_TYPE index concurrently in the background and swaps it in; "
+                "track progress with GET /v1/index/vector."
+)
+async def rebuild_vector_index():
+    if vector_index.index_type == "none":
+        raise HTTPException(status_code=400, detail="VECTOR_INDEX_TYPE is 'none'")
+    if not maintenance_engine:
+        raise HTTPException(
+            status_code=409,
+            detail="Index builds need a direct connection: set DB_MAINTENANCE_URL (DB_PGBOUNCER_MODE=transaction)",
+        )
+    if not vector_index.start_rebuild():
+        raise HTTPException(status_code=409, detail="A vector index build is already running")
+    return {"status": "started", "name": vector_index.name, "type": vector_index.index_type}
+
 @router_v1.post(
     "/upload",
-    response_model=UploadResponse,
+    response_model=IngestionJobStatus,
+    status_code=202,
     tags=["Ingestion"],
     summary="Upload a PDF document",
-    description="Ingests a PDF, splits into chunks, and stores embeddings in Supabase"
-)
-async def upload_pdf(file: UploadFile = File(...)):
-    if not file.filename.lower().endswith(".pdf"):
-        raise HTTPException(status_code=400, detail="Only PDF files are supported")
-    
-    contents = await file.read()
-    os.makedirs("pdfs", exist_ok=True)
-    path = os.path.join("pdfs", file.filename)
-    
-    with open(path, "wb") as f:
-        f.write(contents)
-
-    count = await ingest_pdf(path)
-
-    logger.info(f"Finished ingestion, inserted {count} chunks.")
-
-    return UploadResponse(
-        message="PDF ingested successfully",
-        inserted_count=count
+    description="Stores the PDF and queues a background job that splits it into chunks and stores embeddings "
+                "in `collection` (DEFAULT_COLLECTION if omitted; created on first use). "
+                "Poll /v1/jobs/{job_id} for progress.",
+    # The body is parsed by save_pdf_upload as it streams in; describe it for the docs
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "required": ["file"],
+                        "properties": {"file": {"type": "string", "format": "binary"}},
+                    }
+                }
+            },
+        }
+    },
+)
+async def upload_pdf(
+    request: Request,
+    collection: Optional[str] = Query(None, description="Collection to add the document to (a-z, 0-9, _)"),
+):
+    collection = collection or settings.default_collection
+    try:
+        validate_collection(collection)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Files of other collections live in their own directory, so equal names don't collide
+    directory = settings.pdf_dir if collection == settings.default_collection else os.path.join(settings.pdf_dir, collection)
+    try:
+        upload = await save_pdf_upload(request, directory, settings.upload_max_bytes)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+    job = await job_manager.submit(
+        upload.filename, upload.path, file_hash=upload.sha256, collection=collection, source=upload.source
     )
+    logger.info(f"Queued ingestion job {job['id']} for {upload.filename} in collection {collection}.")
+    return job
+
+@router_v1.get(
+    "/collections",
+    tags=["Ingestion"],
+    summary="List collections",
+    description="Collections (partitions of the documents table) with estimated rows and size on disk."
+)
+async def list_collections():
+    return await collections.list()
+
+@router_v1.get(
+    "/jobs",
+    response_model=List[IngestionJobStatus],
+    tags=["Ingestion"],
+    summary="List recent ingestion jobs",
+)
+async def list_jobs(limit: int = Query(20, ge=1, le=100)):
+    return await job_manager.list(limit=limit)
+
+def _parse_job_id(job_id: str) -> str:
+    try:
+        return str(uuid.UUID(job_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid job_id format (must be UUID)")
+
+@router_v1.get(
+    "/jobs/{job_id}",
+    response_model=IngestionJobStatus,
+    tags=["Ingestion"],
+    summary="Ingestion job status and progress",
+)
+async def get_job(job_id: str):
+    job = await job_manager.get(_parse_job_id(job_id))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@router_v1.post(
+    "/jobs/{job_id}/cancel",
+    response_model=IngestionJobStatus,
+    tags=["Ingestion"],
+    summary="Cancel an ingestion job",
+    description="Queued jobs are cancelled immediately; running jobs stop at the next progress update "
+                "and roll back everything they wrote."
+)
+async def cancel_job(job_id: str):
+    job = await job_manager.cancel(_parse_job_id(job_id))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 @router_v1.get(
     "/documents",
     summary="List documents with pagination",
-    description="Fetches paginated rows from the Supabase 'documents' table.",
+    description="Fetches rows from the 'documents' table ordered by id. Pass the `x-next-cursor` "
+                "response header back as `cursor` for the next page; `fields` selects the returned "
+                "fields (e.g. `id,content,metadata` to skip embeddings).",
     response_model=List[Dict[str, Any]],
 )
-async def get_all_documents(skip: int = Query(0, ge=0), limit: int = Query(10, ge=1, le=100)) -> Any:
+async def get_all_documents(
+    cursor: Optional[str] = Query(None, description="Return documents with id greater than this"),
+    limit: int = Query(10, ge=1, le=100),
+    fields: Optional[str] = Query(None, description="Comma-separated: id, content, embedding, metadata, collection"),
+    skip: int = Query(0, ge=0, description="Deprecated OFFSET paging; ignored when cursor is given"),
+) -> Any:
     """
-    Open a single AsyncSession, select all Document rows, and return them.
+    Open a single AsyncSession, select one page of Document rows, and return them.
     """
     try:
-        logger.info(f"Fetching documents: skip={skip}, limit={limit}")
-        docs = await list_documents(skip=skip, limit=limit)
+        columns = parse_fields(fields)
+        after = uuid.UUID(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        logger.info(f"Fetching documents: cursor={cursor}, limit={limit}, fields={columns}")
+        docs, next_cursor = await list_documents(after=after, limit=limit, fields=columns, skip=skip)
         logger.info(f"Received docs from list_documents")
-        return JSONResponse(content=docs)
-
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
+    # orjson serializes the float32 embedding arrays natively
+    headers = {"x-next-cursor": next_cursor} if next_cursor else {}
+    return ORJSONResponse(content=docs, headers=headers)
+
+@router_v1.get(
+    "/documents/export",
+    summary="Export all documents",
+    description="Streams the whole 'documents' table through a server-side cursor. `format=ndjson` "
+                "writes one JSON document per line (with `fields` projection); `format=npy` writes a "
+                "NumPy .npy array of (id S16, embedding float32) records.",
+)
+async def export_documents(
+    format: Literal["ndjson", "npy"] = Query("ndjson"),
+    fields: Optional[str] = Query(None, description="ndjson only: comma-separated fields"),
+):
+    if format == "npy":
+        return StreamingResponse(
+            export_npy(),
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": 'attachment; filename="documents.npy"'},
+        )
+    try:
+        columns = parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return StreamingResponse(
+        export_ndjson(columns),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="documents.ndjson"'},
+    )
+
+def _search_filters(req: RetrievalScope) -> SearchFilters:
+    return SearchFilters(
+        collection=req.collection,
+        source=req.source,
+        page_from=req.page_from,
+        page_to=req.page_to,
+        ingestion_id=req.ingestion_id,
+    )
 
 @router_v1.post(
     "/query",
     response_model=QueryResponse,
     tags=["RAG"],
     summary="Query the knowledge base",
-    description="Retrieval-Augmented Generation over ingested documents."
+    description="Retrieval-Augmented Generation over ingested documents. `collection`, `source`, `page_from`/"
+                "`page_to` and `ingestion_id` restrict which chunks are retrieved."
 )
 async def query_qa(req: QueryRequest):
-    answer, sources = await answer_question(req.question)
+    answer, sources = await answer_question(req.question, search_mode=req.search_mode, filters=_search_filters(req))
     return QueryResponse(answer=answer, source_docs=sources)
 
+@router_v1.post(
+    "/query-batch",
+    response_model=None,
+    tags=["RAG"],
+    summary="Answer many questions in one request",
+    description="Embeds all questions in one call and retrieves their top-k documents in a single SQL statement, "
+                "then streams one NDJSON line per question as its answer completes: "
+                "{index, question, answer, source_docs} or {index, question, error}."
+)
+async def query_batch(req: QueryBatchRequest):
+    if len(req.questions) > settings.query_batch_max_questions:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {settings.query_batch_max_questions} questions per batch",
+        )
+    results = await answer_questions(req.questions, search_mode=req.search_mode, filters=_search_filters(req))
+
+    async def ndjson():
+        async for result in results:
+            yield orjson.dumps(result) + b"\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
 @router_v1.post(
     "/query-stream",
     response_model=None,
     tags=["RAG"],
-    summary="Streamed Q&A with history"
+    summary="Streamed Q&A with history",
+    description="Streams the answer as plain text, or as Server-Sent Events (`meta`, `sources`, `timing`, "
+                "`token`, `done`/`error`) with `?format=sse` or `Accept: text/event-stream`. Tokens are "
+                "coalesced into frames; disconnecting cancels the upstream completion."
 )
-async def query_stream(req: QueryRequest):
+async def query_stream(
+    req: QueryRequest,
+    request: Request,
+    format: Optional[Literal["text", "sse"]] = Query(None, description="Defaults to sse if Accept asks for it"),
+):
     if req.conversation_id is None:
         conversation_id = str(uuid.uuid4())
     else:
@@ -146,18 +488,22 @@ async def query_stream(req: QueryRequest):
         except ValueError:
             raise HTTPException(status_code=400, detail="Invalid conversation_id format (must be UUID)")
 
-    history = await get_history(conversation_id)
-
-    # 2) stream tokens from OpenAI
-    async def event_generator():
-        full_answer = ""
-        async for token in stream_answer(req.question, history):
-            full_answer += token
-            yield token
-        await append_history(conversation_id, req.question, full_answer)
+    # Rolling summary + recent turns within HISTORY_TOKEN_BUDGET
+    history = await load_history_context(conversation_id)
 
+    # 2) stream tokens from OpenAI; the turn goes to the write-behind history buffer once complete
+    if format == "sse" or (format is None and "text/event-stream" in request.headers.get("accept", "")):
+        return StreamingResponse(
+            stream_sse(req.question, history, conversation_id, search_mode=req.search_mode, filters=_search_filters(req)),
+            media_type="text/event-stream",
+            headers={
+                "x-conversation-id": conversation_id,
+                "Cache-Control": "no-cache",
+                "X-Accel-Buffering": "no",  # don't let nginx buffer the stream
+            },
+        )
     return StreamingResponse(
-        event_generator(),
+        stream_text(req.question, history, conversation_id, search_mode=req.search_mode, filters=_search_filters(req)),
         media_type="text/plain; charset=utf-8",
         headers={"x-conversation-id": conversation_id}
     )
@@ -0,0 +1,142 @@
+"""
+Recall/latency of the local IVF index (services/ann_index.py) against an
+exact scan.
+
+By default it builds the index over synthetic clustered vectors and uses an
+exact numpy scan as ground truth. With --dsn it indexes the real
+`documents` table instead and compares against pgvector's exact
+`ORDER BY embedding <=> q LIMIT k` (latency of both, recall of the index).
+Queries are stored vectors with a little noise added, which is how real
+questions relate to the chunks that answer them.
+
+    python -m benchmarks.bench_ann_index --rows 100000 --nprobe 4 8 16 32
+    python -m benchmarks.bench_ann_index --dsn postgresql://postgres@localhost/postgres
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+import uuid
+from typing import Dict, List
+import numpy as np
+from services.ann_index import AnnIndex
+
+
+def synthetic(rows: int, dims: int, clusters: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dims)).astype(np.float32)
+    labels = rng.integers(0, clusters, rows)
+    vectors = centers[labels] + 0.6 * rng.standard_normal((rows, dims)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def make_queries(vectors: np.ndarray, count: int, noise: float, seed: int = 1) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    picks = vectors[rng.choice(len(vectors), size=count, replace=False)]
+    queries = picks + noise * rng.standard_normal(picks.shape).astype(np.float32) / np.sqrt(picks.shape[1])
+    return (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(np.float32)
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    ms = np.array(samples) * 1e3
+    return {"p50": float(np.percentile(ms, 50)), "p95": float(np.percentile(ms, 95))}
+
+
+async def build(index: AnnIndex, ids: List[uuid.UUID], vectors: np.ndarray, batch: int = 5000) -> dict:
+    async def batches():
+        for start in range(0, len(ids), batch):
+            yield ids[start:start + batch], vectors[start:start + batch]
+
+    return await index.build(batches())
+
+
+def report(label: str, recall: float, latency: Dict[str, float]) -> None:
+    recall_text = f"recall {recall:6.3f}" if recall == recall else " " * 12
+    print(f"  {label:<18} {recall_text}   p50 {latency['p50']:8.3f} ms   p95 {latency['p95']:8.3f} ms")
+
+
+def run_index(index: AnnIndex, queries: np.ndarray, truth: List[set], k: int, nprobe: int) -> None:
+    index.search_sync(queries[0], k, nprobe)  # map pages / build the list layout
+    hits, times = 0, []
+    for q, expected in zip(queries, truth):
+        start = time.perf_counter()
+        found = index.search_sync(q, k, nprobe)
+        times.append(time.perf_counter() - start)
+        hits += len(expected & {i for i, _ in found})
+    report(f"ivf nprobe={nprobe}", hits / (len(queries) * k), percentiles(times))
+
+
+async def bench_synthetic(args: argparse.Namespace) -> None:
+    vectors = synthetic(args.rows, args.dims, args.clusters)
+    ids = [uuid.uuid4() for _ in range(args.rows)]
+    queries = make_queries(vectors, args.queries, args.noise)
+
+    times, truth = [], []
+    for q in queries:
+        start = time.perf_counter()
+        sims = vectors @ q
+        top = np.argpartition(-sims, args.k - 1)[:args.k]
+        times.append(time.perf_counter() - start)
+        truth.append({ids[i] for i in top})
+
+    with tempfile.TemporaryDirectory() as directory:
+        index = AnnIndex(directory, nlist=args.nlist)
+        print(f"rows={args.rows} dims={args.dims} k={args.k} queries={args.queries}")
+        print(f"  build: {await build(index, ids, vectors)}")
+        report("exact numpy scan", 1.0, percentiles(times))
+        for nprobe in args.nprobe:
+            run_index(index, queries, truth, args.k, nprobe)
+
+
+async def bench_pgvector(args: argparse.Namespace) -> None:
+    import asyncpg
+    from services.vectors import register_vector_codec
+
+    conn = await asyncpg.connect(args.dsn)
+    try:
+        await register_vector_codec(conn)
+        rows = await conn.fetch("SELECT id, embedding FROM documents WHERE embedding IS NOT NULL")
+        ids = [r["id"] for r in rows]
+        vectors = np.stack([r["embedding"] for r in rows]).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        queries = make_queries(vectors, min(args.queries, len(ids)), args.noise)
+
+        # Exact scan: disable index scans so pgvector compares every row
+        await conn.execute("SET enable_indexscan = off")
+        stmt = await conn.prepare("SELECT id FROM documents ORDER BY embedding <=> $1 LIMIT $2")
+        await stmt.fetch(queries[0], args.k)
+        times, truth = [], []
+        for q in queries:
+            start = time.perf_counter()
+            found = await stmt.fetch(q, args.k)
+            times.append(time.perf_counter() - start)
+            truth.append({r["id"] for r in found})
+
+        with tempfile.TemporaryDirectory() as directory:
+            index = AnnIndex(directory, nlist=args.nlist)
+            print(f"documents rows={len(ids)} dims={vectors.shape[1]} k={args.k} queries={len(queries)}")
+            print(f"  build: {await build(index, ids, vectors)}")
+            report("pgvector exact", 1.0, percentiles(times))
+            for nprobe in args.nprobe:
+                run_index(index, queries, truth, args.k, nprobe)
+    finally:
+        await conn.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=50_000)
+    parser.add_argument("--dims", type=int, default=1536)
+    parser.add_argument("--clusters", type=int, default=200, help="clusters in the synthetic data")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--noise", type=float, default=0.5, help="query perturbation (relative L2)")
+    parser.add_argument("--nlist", type=int, default=0, help="0 = sqrt(rows)")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--dsn", help="plain postgresql:// DSN: index the documents table instead")
+    args = parser.parse_args()
+    asyncio.run(bench_pgvector(args) if args.dsn else bench_synthetic(args))
+
+
+if __name__ == "__main__":
+    main()
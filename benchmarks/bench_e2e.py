@@ -0,0 +1,564 @@
+"""
+End-to-end benchmark and load test on one box, with no external services.
+
+Starts the fake OpenAI server (benchmarks/fake_openai.py) and the app
+(uvicorn, one worker) against a local Postgres with pgvector instead of
+Supabase, seeds a synthetic corpus, then drives /v1/query, /v1/query-stream
+and /v1/upload at each concurrency level. For every level it records
+p50/p95/p99 latency, time to first token, throughput, the app's memory and
+the per-stage breakdown from /metrics, plus the worker's startup timings
+(GET /v1/ready), and writes it all to JSON so runs can be compared.
+
+    # Postgres with pgvector, e.g.:
+    #   docker run -d -p 5432:5432 -e POSTGRES_HOST_AUTH_METHOD=trust pgvector/pgvector:pg16
+    python -m benchmarks.bench_e2e run --dsn postgresql://postgres@127.0.0.1:5432/rag_bench \\
+        --concurrency 1 8 32 --requests 200 --output bench-results/new.json
+    python -m benchmarks.bench_e2e compare bench-results/base.json bench-results/new.json
+
+The database in --dsn is created if missing and its tables are emptied and
+reseeded: never point it at real data.
+"""
+import argparse
+import asyncio
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit, urlunsplit
+import httpx
+import numpy as np
+import orjson
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+# --- processes ----------------------------------------------------------------
+
+def _dsn_parts(dsn: str) -> Dict[str, str]:
+    url = urlsplit(dsn)
+    return {
+        "host": url.hostname or "127.0.0.1",
+        "port": str(url.port or 5432),
+        "user": url.username or "postgres",
+        "password": url.password or "",
+        "database": url.path.lstrip("/") or "postgres",
+    }
+
+
+def service_env(args: argparse.Namespace, pdf_dir: str) -> Dict[str, str]:
+    db = _dsn_parts(args.dsn)
+    env = {
+        **os.environ,
+        "POSTGRES_URL": urlunsplit(("postgresql+asyncpg",) + tuple(urlsplit(args.dsn))[1:]),
+        "POSTGRES_SERVER": db["host"],
+        "POSTGRES_PORT": db["port"],
+        "POSTGRES_USER": db["user"],
+        "POSTGRES_PASSWORD": db["password"],
+        "POSTGRES_DB": db["database"],
+        "POSTGRES_SSL": "false",
+        # Required settings; nothing talks to Supabase or OpenAI
+        "SUPABASE_URL": "http://127.0.0.1:9",
+        "SUPABASE_KEY": "bench",
+        "OPENAI_API_KEY": "sk-bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{args.fake_port}/v1",
+        "EMBEDDING_PROVIDER": "openai",
+        "EMBEDDING_DIMENSIONS": str(args.dimensions),
+        "PDF_DIR": pdf_dir,
+        "LOG_LEVEL": "WARNING",
+    }
+    for item in args.app_env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    return env
+
+
+def start_process(cmd: List[str], env: Dict[str, str], log_path: Path) -> subprocess.Popen:
+    log = open(log_path, "wb")
+    return subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def stop_process(process: Optional[subprocess.Popen]) -> None:
+    if process is None or process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+async def wait_http(url: str, process: Optional[subprocess.Popen], timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process is not None and process.poll() is not None:
+                raise RuntimeError(f"process for {url} exited with {process.returncode}")
+            try:
+                await client.get(url, timeout=2.0)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise TimeoutError(f"{url} not reachable after {timeout:.0f}s")
+
+
+def rss_mb(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+# --- database -----------------------------------------------------------------
+
+async def prepare_database(args: argparse.Namespace, pages: Sequence[str]) -> int:
+    import asyncpg
+    from benchmarks.workload import schema_sql, seed_documents, split_chunks
+    from services.vectors import register_vector_codec
+
+    database = _dsn_parts(args.dsn)["database"]
+    admin = await asyncpg.connect(urlunsplit(urlsplit(args.dsn)._replace(path="/postgres")))
+    try:
+        if not await admin.fetchval("SELECT 1 FROM pg_database WHERE datname = $1", database):
+            await admin.execute(f'CREATE DATABASE "{database}"')
+    finally:
+        await admin.close()
+
+    conn = await asyncpg.connect(args.dsn)
+    try:
+        schema = schema_sql()
+        if conn.get_server_version().major >= 13:
+            # gen_random_uuid() is built in; plain pgvector builds may not ship pgcrypto
+            schema = schema.replace("create extension if not exists pgcrypto;", "")
+        await conn.execute(schema)
+        await register_vector_codec(conn)
+        await conn.execute("TRUNCATE chat_history, chat_summary, ingestion_job, pdf_ingestion")
+        chunks = [(page, chunk) for page, text in enumerate(pages) for chunk in split_chunks(text)]
+        return await seed_documents(conn, chunks, args.dimensions)
+    finally:
+        await conn.close()
+
+
+# --- measurements -------------------------------------------------------------
+
+def summarize(samples: Sequence[float]) -> Optional[Dict[str, float]]:
+    if not len(samples):
+        return None
+    ms = np.asarray(samples) * 1e3
+    return {
+        "p50": round(float(np.percentile(ms, 50)), 2),
+        "p95": round(float(np.percentile(ms, 95)), 2),
+        "p99": round(float(np.percentile(ms, 99)), 2),
+        "mean": round(float(ms.mean()), 2),
+        "max": round(float(ms.max()), 2),
+    }
+
+
+def parse_stage_histograms(text: str) -> Dict[str, Dict[str, Any]]:
+    """
+    rag_stage_seconds buckets, sum and count per stage from a /metrics page.
+    """
+    from prometheus_client.parser import text_string_to_metric_families
+
+    stages: Dict[str, Dict[str, Any]] = {}
+    for family in text_string_to_metric_families(text):
+        if family.name != "rag_stage_seconds":
+            continue
+        for sample in family.samples:
+            entry = stages.setdefault(sample.labels["stage"], {"buckets": {}, "sum": 0.0, "count": 0.0})
+            if sample.name.endswith("_bucket"):
+                entry["buckets"][float(sample.labels["le"])] = sample.value
+            elif sample.name.endswith("_sum"):
+                entry["sum"] = sample.value
+            elif sample.name.endswith("_count"):
+                entry["count"] = sample.value
+    return stages
+
+
+def _bucket_quantile(q: float, buckets: List[Tuple[float, float]]) -> float:
+    # Same linear interpolation as PromQL's histogram_quantile
+    total = buckets[-1][1]
+    rank = q * total
+    lower_bound, lower_count = 0.0, 0.0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float("inf"):
+                return lower_bound
+            width = count - lower_count
+            return lower_bound + (bound - lower_bound) * ((rank - lower_count) / width if width else 0.0)
+        lower_bound, lower_count = bound, count
+    return lower_bound
+
+
+def stage_breakdown(before: Dict[str, Dict[str, Any]], after: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    """
+    Per-stage count, mean and bucket-estimated percentiles (ms) of what
+    happened between two /metrics scrapes.
+    """
+    result = {}
+    for stage, now in sorted(after.items()):
+        then = before.get(stage, {"buckets": {}, "sum": 0.0, "count": 0.0})
+        count = now["count"] - then["count"]
+        if count <= 0:
+            continue
+        buckets = sorted((le, now["buckets"][le] - then["buckets"].get(le, 0.0)) for le in now["buckets"])
+        result[stage] = {
+            "count": int(count),
+            "mean": round((now["sum"] - then["sum"]) / count * 1e3, 2),
+            **{f"p{int(q * 100)}": round(_bucket_quantile(q, buckets) * 1e3, 2) for q in (0.5, 0.95, 0.99)},
+        }
+    return result
+
+
+@dataclass
+class Sample:
+    ok: bool
+    latency: float
+    ttft: Optional[float] = None
+    accept: Optional[float] = None  # uploads: time until the 202
+    pages: int = 0
+
+
+@dataclass
+class Level:
+    scenario: str
+    concurrency: int
+    samples: List[Sample] = field(default_factory=list)
+    elapsed: float = 0.0
+    rss: List[float] = field(default_factory=list)
+    stages: Dict[str, Dict[str, float]] = field(default_factory=dict)
+
+    def as_dict(self) -> Dict[str, Any]:
+        ok = [s for s in self.samples if s.ok]
+        result: Dict[str, Any] = {
+            "scenario": self.scenario,
+            "concurrency": self.concurrency,
+            "requests": len(self.samples),
+            "errors": len(self.samples) - len(ok),
+            "duration_s": round(self.elapsed, 3),
+            "throughput_rps": round(len(ok) / self.elapsed, 3) if self.elapsed else 0.0,
+            "latency_ms": summarize([s.latency for s in ok]),
+            "ttft_ms": summarize([s.ttft for s in ok if s.ttft is not None]),
+            "rss_mb": {"peak": round(max(self.rss), 1), "end": round(self.rss[-1], 1)} if self.rss else None,
+            "stages_ms": self.stages,
+        }
+        if self.scenario == "upload":
+            result["accept_ms"] = summarize([s.accept for s in ok if s.accept is not None])
+            result["pages_per_s"] = round(sum(s.pages for s in ok) / self.elapsed, 2) if self.elapsed else 0.0
+        return result
+
+
+# --- scenarios ----------------------------------------------------------------
+
+async def do_query(client: httpx.AsyncClient, question: str) -> Sample:
+    start = time.perf_counter()
+    response = await client.post("/v1/query", json={"question": question})
+    return Sample(ok=response.status_code == 200, latency=time.perf_counter() - start)
+
+
+async def do_stream(client: httpx.AsyncClient, question: str) -> Sample:
+    start = time.perf_counter()
+    ttft = None
+    async with client.stream("POST", "/v1/query-stream", json={"question": question}) as response:
+        async for chunk in response.aiter_raw():
+            if chunk and ttft is None:
+                ttft = time.perf_counter() - start
+        ok = response.status_code == 200 and ttft is not None
+    return Sample(ok=ok, latency=time.perf_counter() - start, ttft=ttft)
+
+
+def upload_scenario(pages_per_pdf: int, poll: float = 0.2) -> Callable[[httpx.AsyncClient, int], Awaitable[Sample]]:
+    from benchmarks.workload import make_pages, make_pdf
+
+    async def do_upload(client: httpx.AsyncClient, n: int) -> Sample:
+        # A fresh document each time, so nothing is skipped as unchanged
+        pdf = make_pdf(make_pages(pages_per_pdf, seed=100_000 + n))
+        start = time.perf_counter()
+        response = await client.post("/v1/upload", files={"file": (f"bench-{n}.pdf", pdf, "application/pdf")})
+        accept = time.perf_counter() - start
+        if response.status_code != 202:
+            return Sample(ok=False, latency=accept, accept=accept)
+        job_id = response.json()["id"]
+        while True:
+            await asyncio.sleep(poll)
+            job = (await client.get(f"/v1/jobs/{job_id}")).json()
+            if job["status"] not in ("queued", "running"):
+                break
+        return Sample(
+            ok=job["status"] == "succeeded",
+            latency=time.perf_counter() - start,
+            accept=accept,
+            pages=pages_per_pdf,
+        )
+
+    return do_upload
+
+
+async def run_level(
+    client: httpx.AsyncClient,
+    scenario: str,
+    concurrency: int,
+    inputs: Sequence[Any],
+    action: Callable[[httpx.AsyncClient, Any], Awaitable[Sample]],
+    pid: Optional[int],
+    warmup: int = 0,
+) -> Level:
+    """
+    Closed loop: `concurrency` clients each send their next request as soon
+    as the previous one finishes, until every input has been sent.
+    """
+    level = Level(scenario, concurrency)
+    queue = list(inputs)
+    for item in queue[:warmup]:
+        await action(client, item)
+    queue = queue[warmup:][::-1]
+
+    async def worker() -> None:
+        while queue:
+            item = queue.pop()
+            try:
+                level.samples.append(await action(client, item))
+            except httpx.HTTPError:
+                level.samples.append(Sample(ok=False, latency=0.0))
+
+    async def sample_memory() -> None:
+        while True:
+            value = rss_mb(pid)
+            if value is not None:
+                level.rss.append(value)
+            await asyncio.sleep(0.1)
+
+    before = parse_stage_histograms((await client.get("/metrics")).text)
+    sampler = asyncio.create_task(sample_memory()) if pid is not None else None
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    level.elapsed = time.perf_counter() - start
+    if sampler is not None:
+        sampler.cancel()
+        value = rss_mb(pid)
+        if value is not None:
+            level.rss.append(value)
+    level.stages = stage_breakdown(before, parse_stage_histograms((await client.get("/metrics")).text))
+    return level
+
+
+def print_level(result: Dict[str, Any]) -> None:
+    latency = result["latency_ms"] or {}
+    ttft = result["ttft_ms"] or {}
+    rss = result["rss_mb"] or {}
+    print(
+        f"  {result['scenario']:<7} c={result['concurrency']:<4} n={result['requests']:<5} err={result['errors']:<3} "
+        f"{result['throughput_rps']:8.2f} req/s   p50 {latency.get('p50', 0):8.1f}  p95 {latency.get('p95', 0):8.1f}  "
+        f"p99 {latency.get('p99', 0):8.1f} ms   "
+        + (f"ttft p50 {ttft['p50']:7.1f} ms   " if ttft else " " * 21)
+        + f"rss {rss.get('peak', 0):6.0f} MB"
+    )
+
+
+# --- commands -----------------------------------------------------------------
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    work = Path(tempfile.mkdtemp(prefix="rag-bench-"))
+    (work / "pdfs").mkdir()
+    env = service_env(args, str(work / "pdfs"))
+    # The workload helpers import app modules, whose settings come from the same environment
+    os.environ.update(env)
+    from benchmarks.workload import make_pages, make_questions
+
+    pages = make_pages(args.corpus_pages, seed=args.seed)
+    questions = make_questions(pages, args.requests * len(args.concurrency) * 2 + 100, seed=args.seed + 1)
+    fake = app = None
+    try:
+        print(f"seeding {args.corpus_pages} pages into {_dsn_parts(args.dsn)['database']} ...")
+        chunks = await prepare_database(args, pages)
+        print(f"  {chunks} chunks")
+
+        fake = start_process([
+            sys.executable, "-m", "benchmarks.fake_openai", "--port", str(args.fake_port),
+            "--dimensions", str(args.dimensions), "--embed-ms", str(args.embed_ms), "--ttft-ms", str(args.ttft_ms),
+            "--token-ms", str(args.token_ms), "--tokens", str(args.tokens), "--jitter", str(args.jitter),
+        ], env, work / "fake_openai.log")
+        await wait_http(f"http://127.0.0.1:{args.fake_port}/stats", fake)
+        spawned = time.monotonic()
+        app = start_process([
+            sys.executable, "-m", "uvicorn", "app:app", "--port", str(args.app_port), "--log-level", "warning",
+        ], env, work / "app.log")
+        base_url = f"http://127.0.0.1:{args.app_port}"
+        await wait_http(f"{base_url}/metrics", app, timeout=120)
+
+        limits = httpx.Limits(max_connections=max(args.concurrency) * 2, max_keepalive_connections=max(args.concurrency) * 2)
+        async with httpx.AsyncClient(base_url=base_url, timeout=httpx.Timeout(300.0), limits=limits) as client:
+            while (await client.get("/v1/ready")).status_code != 200:
+                await asyncio.sleep(0.05)
+            spawn_to_ready = (time.monotonic() - spawned) * 1e3
+            # Queries fall back to an exact scan until the startup index build is done
+            deadline = time.monotonic() + args.index_timeout
+            while (await client.get("/v1/index/vector")).json().get("status") == "building":
+                if time.monotonic() > deadline:
+                    raise TimeoutError("vector index still building")
+                await asyncio.sleep(1.0)
+
+            results = []
+            offset = 0
+            scenarios = {"query": do_query, "stream": do_stream}
+            for scenario in args.scenarios:
+                for concurrency in args.concurrency:
+                    if scenario == "upload":
+                        inputs: Sequence[Any] = range(offset, offset + args.uploads)
+                        action = upload_scenario(args.upload_pages)
+                        warmup = 0
+                        offset += args.uploads
+                    else:
+                        inputs = questions[offset:offset + args.requests + concurrency]
+                        action = scenarios[scenario]
+                        warmup = concurrency
+                        offset += args.requests + concurrency
+                    level = await run_level(client, scenario, concurrency, inputs, action, app.pid, warmup)
+                    results.append(level.as_dict())
+                    print_level(results[-1])
+            # Worker startup as the app reports it: import, warm-up, ready, first request
+            startup = {"spawn_to_ready_ms": round(spawn_to_ready, 1), **(await client.get("/v1/ready")).json()["startup_ms"]}
+            print("startup: " + ", ".join(f"{name} {ms:.0f} ms" for name, ms in startup.items()))
+            fake_stats = httpx.get(f"http://127.0.0.1:{args.fake_port}/stats").json()
+    finally:
+        stop_process(app)
+        stop_process(fake)
+        print(f"logs in {work}")
+
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "host": platform.node(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "python": platform.python_version(),
+            "corpus_chunks": chunks,
+            "args": vars(args),
+            "fake_openai": fake_stats,
+        },
+        "startup": startup,
+        "results": results,
+    }
+
+
+# Compared per scenario/concurrency; True = higher is better
+_COMPARED = (
+    (("latency_ms", "p50"), False),
+    (("latency_ms", "p95"), False),
+    (("latency_ms", "p99"), False),
+    (("ttft_ms", "p50"), False),
+    (("ttft_ms", "p95"), False),
+    (("throughput_rps",), True),
+    (("rss_mb", "peak"), False),
+)
+# Startup phases compared (milliseconds, lower is better)
+_COMPARED_STARTUP = ("spawn_to_ready_ms", "import", "warmup", "ready", "first_request_duration")
+
+
+def _lookup(result: Dict[str, Any], path: Tuple[str, ...]) -> Optional[float]:
+    value: Any = result
+    for key in path:
+        if not isinstance(value, dict) or value.get(key) is None:
+            return None
+        value = value[key]
+    return float(value)
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> int:
+    """
+    Print the relative change of every compared metric and return the number
+    of regressions worse than `threshold` (e.g. 0.1 = 10%).
+    """
+    old = {(r["scenario"], r["concurrency"]): r for r in baseline["results"]}
+    regressions = 0
+    print(f"baseline {baseline['meta'].get('commit')}  vs  current {current['meta'].get('commit')}  (threshold {threshold:.0%})")
+    for result in current["results"]:
+        key = (result["scenario"], result["concurrency"])
+        if key not in old:
+            continue
+        for path, higher_is_better in _COMPARED:
+            before, after = _lookup(old[key], path), _lookup(result, path)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            worse = -change if higher_is_better else change
+            flag = "REGRESSION" if worse > threshold else ("improved" if worse < -threshold else "")
+            regressions += flag == "REGRESSION"
+            print(f"  {key[0]:<7} c={key[1]:<4} {'.'.join(path):<18} {before:10.2f} -> {after:10.2f}  {change:+7.1%}  {flag}")
+    for phase in _COMPARED_STARTUP:
+        before, after = baseline.get("startup", {}).get(phase), current.get("startup", {}).get(phase)
+        if not before or after is None:
+            continue
+        change = (after - before) / before
+        flag = "REGRESSION" if change > threshold else ("improved" if change < -threshold else "")
+        regressions += flag == "REGRESSION"
+        print(f"  startup {phase:<27} {before:10.2f} -> {after:10.2f}  {change:+7.1%}  {flag}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="start the stand-ins and the app, run the load, write JSON")
+    run_parser.add_argument("--dsn", default="postgresql://postgres@127.0.0.1:5432/rag_bench",
+                            help="plain postgresql:// DSN of a database the benchmark may reset")
+    run_parser.add_argument("--scenarios", nargs="+", choices=["query", "stream", "upload"], default=["query", "stream", "upload"])
+    run_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    run_parser.add_argument("--requests", type=int, default=200, help="query/stream requests per level")
+    run_parser.add_argument("--uploads", type=int, default=8, help="PDF uploads per level")
+    run_parser.add_argument("--upload-pages", type=int, default=20)
+    run_parser.add_argument("--corpus-pages", type=int, default=5000, help="pages seeded into documents (~3 chunks each)")
+    run_parser.add_argument("--dimensions", type=int, default=1536)
+    run_parser.add_argument("--embed-ms", type=float, default=20.0)
+    run_parser.add_argument("--ttft-ms", type=float, default=300.0)
+    run_parser.add_argument("--token-ms", type=float, default=15.0)
+    run_parser.add_argument("--tokens", type=int, default=120)
+    run_parser.add_argument("--jitter", type=float, default=0.2)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--app-port", type=int, default=8010)
+    run_parser.add_argument("--fake-port", type=int, default=8100)
+    run_parser.add_argument("--app-env", action="append", default=[], metavar="KEY=VALUE",
+                            help="extra app setting, e.g. --app-env VECTOR_INDEX_TYPE=ivfflat (repeatable)")
+    run_parser.add_argument("--index-timeout", type=float, default=900.0, help="seconds to wait for the vector index")
+    run_parser.add_argument("--output", help="write results JSON here")
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.10, help="relative change counted as a regression")
+
+    args = parser.parse_args()
+    if args.command == "compare":
+        baseline = orjson.loads(Path(args.baseline).read_bytes())
+        current = orjson.loads(Path(args.current).read_bytes())
+        sys.exit(1 if compare(baseline, current, args.threshold) else 0)
+
+    report = asyncio.run(run(args))
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.output).write_bytes(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+        print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Recall/latency of two-phase search over compact embeddings
+(services/quantized.py) against the current exact search.
+
+Loads vectors into a scratch table with the same columns as `documents`
+plus both compact columns, then times, per query:
+
+  exact scan       ORDER BY embedding <=> q with index scans disabled (ground truth)
+  hnsw vector      the default search: HNSW on the full vectors
+  halfvec xF       HNSW on the float16 copy, F*k candidates reranked exactly
+  binary xF        HNSW (Hamming) on the bit copy, F*k candidates reranked exactly
+
+and reports recall@k against the exact scan, latency and index sizes.
+Sequential scans are disabled for the index rows, so they show what the
+indexes do once the table is large enough for the planner to use them.
+Vectors are synthetic and clustered by default, or the `documents` table's
+embeddings with --from-documents; queries are stored vectors with a little
+noise added. Needs pgvector >= 0.7.
+
+    python -m benchmarks.bench_quantized --dsn postgresql://postgres@localhost/postgres --rows 50000
+    python -m benchmarks.bench_quantized --dsn postgresql://... --from-documents --factors 1 2 4 8 16
+"""
+import argparse
+import asyncio
+import time
+import uuid
+from typing import Dict, List, Set
+import numpy as np
+from benchmarks.bench_ann_index import make_queries, percentiles, report, synthetic
+from services.quantized import CompactVectors, DEFAULT_RERANK_FACTOR
+from services.vectors import register_vector_codec
+
+TABLE = "bench_quantized"
+
+
+async def load(conn, vectors: np.ndarray, ef_construction: int) -> Dict[str, float]:
+    dims = vectors.shape[1]
+    compact = {kind: CompactVectors(kind, dims, table=TABLE) for kind in DEFAULT_RERANK_FACTOR}
+    await conn.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    await conn.execute(f"""
+        CREATE TABLE {TABLE} (
+            id uuid PRIMARY KEY, content text NOT NULL, metadata jsonb NOT NULL DEFAULT '{{}}',
+            embedding vector({dims}),
+            {", ".join(f"{c.column} {c.sql_type}" for c in compact.values())}
+        )
+    """)
+    batch = 5000
+    for start in range(0, len(vectors), batch):
+        rows = vectors[start:start + batch]
+        await conn.copy_records_to_table(
+            TABLE,
+            columns=["id", "content", "embedding"],
+            records=[(uuid.uuid4(), f"chunk {start + i}", v) for i, v in enumerate(rows)],
+        )
+    # Filled in SQL like the backfill, so the benchmark checks the same expressions
+    await conn.execute(
+        f"UPDATE {TABLE} SET "
+        + ", ".join(f"{c.column} = {c.quantize_sql('embedding')}" for c in compact.values())
+    )
+    await conn.execute(f"VACUUM ANALYZE {TABLE}")
+    await conn.execute("SET maintenance_work_mem = '1GB'")
+    build: Dict[str, float] = {}
+    indexes = [("embedding", "vector_cosine_ops")] + [(c.column, c.opclass) for c in compact.values()]
+    for column, opclass in indexes:
+        start = time.perf_counter()
+        await conn.execute(
+            f"CREATE INDEX {TABLE}_{column}_idx ON {TABLE} USING hnsw ({column} {opclass}) "
+            f"WITH (m = 16, ef_construction = {ef_construction})"
+        )
+        build[column] = round(time.perf_counter() - start, 2)
+    return build
+
+
+async def sizes(conn) -> Dict[str, str]:
+    rows = await conn.fetch(f"""
+        SELECT c.relname AS name, pg_size_pretty(pg_relation_size(c.oid)) AS size
+        FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = '{TABLE}'::regclass AND c.relname <> '{TABLE}_pkey'
+        ORDER BY c.relname
+    """)
+    return {r["name"]: r["size"] for r in rows}
+
+
+async def run(conn, label: str, sql: str, args: list, queries: np.ndarray, truth: List[Set[uuid.UUID]]) -> None:
+    stmt = await conn.prepare(sql)
+    await stmt.fetch(queries[0], *args)
+    hits, times = 0, []
+    for q, expected in zip(queries, truth):
+        start = time.perf_counter()
+        found = await stmt.fetch(q, *args)
+        times.append(time.perf_counter() - start)
+        hits += len(expected & {r["id"] for r in found})
+    report(label, hits / (len(queries) * len(truth[0])), percentiles(times))
+
+
+async def bench(args: argparse.Namespace) -> None:
+    import asyncpg
+
+    conn = await asyncpg.connect(args.dsn)
+    try:
+        await register_vector_codec(conn)
+        if args.from_documents:
+            rows = await conn.fetch("SELECT embedding FROM documents WHERE embedding IS NOT NULL")
+            vectors = np.stack([r["embedding"] for r in rows]).astype(np.float32)
+        else:
+            vectors = synthetic(args.rows, args.dims, args.clusters)
+        queries = make_queries(vectors, min(args.queries, len(vectors)), args.noise)
+        print(f"rows={len(vectors)} dims={vectors.shape[1]} k={args.k} queries={len(queries)} "
+              f"ef_search={args.ef_search}")
+        print(f"  load + index build (s): {await load(conn, vectors, args.ef_construction)}")
+        print(f"  index sizes: {await sizes(conn)}")
+
+        await conn.execute("SET enable_indexscan = off")
+        exact = await conn.prepare(f"SELECT id FROM {TABLE} ORDER BY embedding <=> $1 LIMIT $2")
+        await exact.fetch(queries[0], args.k)
+        truth, times = [], []
+        for q in queries:
+            start = time.perf_counter()
+            truth.append({r["id"] for r in await exact.fetch(q, args.k)})
+            times.append(time.perf_counter() - start)
+        await conn.execute("SET enable_indexscan = on")
+        report("exact scan", 1.0, percentiles(times))
+
+        # On small tables the planner may prefer a sequential scan (it doesn't
+        # cost reading TOASTed vectors); measure the index paths themselves
+        await conn.execute("SET enable_seqscan = off")
+
+        await conn.execute(f"SET hnsw.ef_search = {max(args.ef_search, args.k)}")
+        await run(conn, "hnsw vector", f"SELECT id FROM {TABLE} ORDER BY embedding <=> $1 LIMIT $2",
+                  [args.k], queries, truth)
+        dims = vectors.shape[1]
+        for kind in DEFAULT_RERANK_FACTOR:
+            for factor in args.factors:
+                compact = CompactVectors(kind, dims, table=TABLE, rerank_factor=factor)
+                n = compact.candidates(args.k)
+                # As VectorIndexManager.apply_search_params: the candidate list covers all n
+                await conn.execute(f"SET hnsw.ef_search = {max(args.ef_search, n)}")
+                sql = compact.search_sql("CAST($1 AS vector)").replace(":n", "$3").replace(":k", "$2")
+                await run(conn, f"{kind} x{factor}", f"SELECT id FROM ({sql}) d", [args.k, n], queries, truth)
+    finally:
+        if not args.keep:
+            await conn.execute(f"DROP TABLE IF EXISTS {TABLE}")
+        await conn.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn", required=True, help="plain postgresql:// DSN (pgvector >= 0.7)")
+    parser.add_argument("--rows", type=int, default=20_000)
+    parser.add_argument("--dims", type=int, default=1536)
+    parser.add_argument("--clusters", type=int, default=200, help="clusters in the synthetic data")
+    parser.add_argument("--from-documents", action="store_true", help="use the documents table's embeddings")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--noise", type=float, default=0.5, help="query perturbation (relative L2)")
+    parser.add_argument("--ef-search", type=int, default=40, help="hnsw.ef_search (balanced mode)")
+    parser.add_argument("--ef-construction", type=int, default=64)
+    parser.add_argument("--factors", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="rerank factors")
+    parser.add_argument("--keep", action="store_true", help=f"keep the {TABLE} table")
+    args = parser.parse_args()
+    asyncio.run(bench(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Micro-benchmark: text literal vs binary pgvector parameter encoding.
+
+Client side it compares building the '[x,y,...]' literal (old path) with the
+binary codec in services/vectors.py, and parsing text back vs decoding binary.
+With --dsn it also round-trips vectors through a real Postgres + pgvector so
+the server-side parse cost shows up too.
+
+    python -m benchmarks.bench_vector_encoding
+    python -m benchmarks.bench_vector_encoding --dsn postgresql://postgres@localhost/postgres
+"""
+import argparse
+import asyncio
+import time
+import numpy as np
+from services.vectors import decode_vector, encode_vector, register_vector_codec, to_pgvector_literal
+
+
+def _timeit(fn, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e6  # µs per call
+
+
+def client_side(dims: int, repeat: int) -> None:
+    vec = np.random.default_rng(0).standard_normal(dims).astype(np.float32)
+    as_list = vec.tolist()  # what the embeddings API hands us
+    literal = to_pgvector_literal(as_list)
+    binary = encode_vector(vec)
+
+    print(f"dims={dims}, {repeat} iterations")
+    print(f"  encode text literal   : {_timeit(lambda: to_pgvector_literal(as_list), repeat):9.1f} µs  ({len(literal)} bytes)")
+    print(f"  encode binary (numpy) : {_timeit(lambda: encode_vector(vec), repeat):9.1f} µs  ({len(binary)} bytes)")
+    print(f"  decode text -> floats : {_timeit(lambda: [float(x) for x in literal[1:-1].split(',')], repeat):9.1f} µs")
+    print(f"  decode binary -> numpy: {_timeit(lambda: decode_vector(binary), repeat):9.1f} µs")
+
+    parsed = np.array([float(x) for x in literal[1:-1].split(",")], dtype=np.float32)
+    print(f"  max abs error, text   : {np.abs(parsed - vec).max():.2e}")
+    print(f"  max abs error, binary : {np.abs(decode_vector(binary) - vec).max():.2e}")
+
+
+async def round_trip(dsn: str, dims: int, repeat: int) -> None:
+    import asyncpg
+
+    conn = await asyncpg.connect(dsn)
+    try:
+        await register_vector_codec(conn)
+        vec = np.random.default_rng(1).standard_normal(dims).astype(np.float32)
+        literal = to_pgvector_literal(vec.tolist())
+        text_stmt = await conn.prepare("SELECT vector_dims($1::text::vector)")
+        binary_stmt = await conn.prepare("SELECT vector_dims($1::vector)")
+
+        for label, stmt, value in (("text", text_stmt, literal), ("binary", binary_stmt, vec)):
+            await stmt.fetchval(value)  # warm up
+            start = time.perf_counter()
+            for _ in range(repeat):
+                await stmt.fetchval(value)
+            per_call = (time.perf_counter() - start) / repeat * 1e6
+            print(f"  round trip ({label:6}) : {per_call:9.1f} µs")
+    finally:
+        await conn.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dims", type=int, default=1536)
+    parser.add_argument("--repeat", type=int, default=2000)
+    parser.add_argument("--dsn", help="plain postgresql:// DSN for the round-trip comparison")
+    args = parser.parse_args()
+
+    client_side(args.dims, args.repeat)
+    if args.dsn:
+        asyncio.run(round_trip(args.dsn, args.dims, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+OpenAI-compatible stand-in for offline benchmarks.
+
+- POST /v1/embeddings returns the same deterministic unit vectors as
+  services.embeddings.FakeEmbeddingProvider (so a corpus seeded locally
+  matches what the app embeds over HTTP), float or base64 encoded.
+- POST /v1/chat/completions answers with a deterministic text, streamed
+  (SSE chunks) or not, after a time-to-first-token plus a per-token delay.
+- GET /stats counts requests, tokens and streams the client abandoned.
+
+    python -m benchmarks.fake_openai --port 8100 --ttft-ms 300 --token-ms 15 --tokens 120
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import random
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List
+import numpy as np
+import orjson
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, StreamingResponse
+from services.embeddings import FakeEmbeddingProvider
+
+_WORDS = (
+    "the index stores vectors so that retrieval stays fast while the model writes an answer from "
+    "the context of each page and every chunk keeps its source for citations in the final response"
+).split()
+
+
+@dataclass
+class FakeConfig:
+    dimensions: int = 1536
+    embed_ms: float = 20.0        # per embeddings request
+    ttft_ms: float = 300.0        # before the first token / whole non-streamed answer
+    token_ms: float = 15.0        # between streamed tokens
+    tokens: int = 120             # tokens per answer
+    jitter: float = 0.2           # each delay is scaled by uniform(1 - jitter, 1 + jitter)
+    seed: int = 0
+
+
+def answer_tokens(messages: List[Dict[str, Any]], count: int) -> List[str]:
+    """
+    Deterministic answer for a prompt: the same prompt always gets the same text.
+    """
+    digest = hashlib.sha256(orjson.dumps(messages)).digest()
+    rng = random.Random(digest)
+    return [rng.choice(_WORDS) + " " for _ in range(count)]
+
+
+def create_app(config: FakeConfig) -> FastAPI:
+    app = FastAPI(title="fake-openai")
+    embedder = FakeEmbeddingProvider(dimensions=config.dimensions)
+    rng = random.Random(config.seed)
+    stats = {"embedding_requests": 0, "embedded_texts": 0, "completions": 0, "streams": 0,
+             "streams_aborted": 0, "tokens": 0}
+
+    async def sleep_ms(ms: float) -> None:
+        if ms > 0:
+            await asyncio.sleep(ms * rng.uniform(1 - config.jitter, 1 + config.jitter) / 1000)
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request) -> Response:
+        body = orjson.loads(await request.body())
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        stats["embedding_requests"] += 1
+        stats["embedded_texts"] += len(texts)
+        await sleep_ms(config.embed_ms)
+        vectors = np.asarray(await embedder.embed(texts), dtype=np.float32)
+        as_base64 = body.get("encoding_format") == "base64"
+        data = [
+            {
+                "object": "embedding",
+                "index": i,
+                "embedding": base64.b64encode(v.astype("<f4").tobytes()).decode() if as_base64 else v,
+            }
+            for i, v in enumerate(vectors)
+        ]
+        payload = {
+            "object": "list",
+            "data": data,
+            "model": body.get("model", "fake-embedding"),
+            "usage": {"prompt_tokens": sum(len(t) // 4 for t in texts), "total_tokens": sum(len(t) // 4 for t in texts)},
+        }
+        return Response(orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY), media_type="application/json")
+
+    @app.post("/v1/chat/completions")
+    async def chat(request: Request) -> Response:
+        body = orjson.loads(await request.body())
+        tokens = answer_tokens(body["messages"], min(config.tokens, body.get("max_tokens") or config.tokens))
+        model = body.get("model", "fake-chat")
+        created = int(time.time())
+        stats["completions"] += 1
+
+        if not body.get("stream"):
+            await sleep_ms(config.ttft_ms + config.token_ms * len(tokens))
+            stats["tokens"] += len(tokens)
+            payload = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+            }
+            return Response(orjson.dumps(payload), media_type="application/json")
+
+        def chunk(delta: Dict[str, Any], finish: Any = None) -> bytes:
+            return b"data: " + orjson.dumps({
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+            }) + b"\n\n"
+
+        async def stream():
+            stats["streams"] += 1
+            try:
+                await sleep_ms(config.ttft_ms)
+                yield chunk({"role": "assistant", "content": ""})
+                for i, token in enumerate(tokens):
+                    if i:
+                        await sleep_ms(config.token_ms)
+                    stats["tokens"] += 1
+                    yield chunk({"content": token})
+                yield chunk({}, "stop")
+                yield b"data: [DONE]\n\n"
+            except asyncio.CancelledError:
+                stats["streams_aborted"] += 1
+                raise
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    @app.get("/stats")
+    async def get_stats() -> Dict[str, Any]:
+        return {**stats, "config": vars(config)}
+
+    return app
+
+
+def main() -> None:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--embed-ms", type=float, default=20.0)
+    parser.add_argument("--ttft-ms", type=float, default=300.0)
+    parser.add_argument("--token-ms", type=float, default=15.0)
+    parser.add_argument("--tokens", type=int, default=120)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    args = parser.parse_args()
+    config = FakeConfig(
+        dimensions=args.dimensions,
+        embed_ms=args.embed_ms,
+        ttft_ms=args.ttft_ms,
+        token_ms=args.token_ms,
+        tokens=args.tokens,
+        jitter=args.jitter,
+    )
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
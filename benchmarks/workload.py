@@ -0,0 +1,153 @@
+"""
+Synthetic corpus and query workload for the end-to-end benchmark.
+
+Everything is generated from a seed: page texts (used both for the seeded
+`documents` table and for PDFs uploaded during the run), questions taken
+from those pages, and minimal text PDFs that pypdf can extract again.
+"""
+import hashlib
+import random
+import re
+from pathlib import Path
+from typing import List, Sequence, Tuple
+import numpy as np
+import orjson
+from services.embeddings import FakeEmbeddingProvider
+
+_SUBJECTS = "the index|the cache|each worker|the pipeline|a replica|the planner|the gateway|every shard|the scheduler|a client".split("|")
+_VERBS = "stores|rebuilds|streams|compacts|retries|batches|validates|evicts|replicates|measures".split("|")
+_OBJECTS = (
+    "vectors|pages|embeddings|connections|requests|summaries|partitions|tokens|checkpoints|"
+    "transactions|snapshots|segments|queries|chunks|events"
+).split("|")
+_DETAILS = (
+    "before the deadline|under heavy load|after every commit|in the background|per tenant|"
+    "within the budget|across regions|on startup|without locking|in small batches"
+).split("|")
+
+README = Path(__file__).resolve().parent.parent / "README.md"
+
+
+def sentence(rng: random.Random) -> str:
+    return (
+        f"{rng.choice(_SUBJECTS).capitalize()} {rng.choice(_VERBS)} {rng.randint(2, 900)} "
+        f"{rng.choice(_OBJECTS)} {rng.choice(_DETAILS)}."
+    )
+
+
+def make_pages(count: int, chars_per_page: int = 1800, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    pages = []
+    for _ in range(count):
+        parts: List[str] = []
+        size = 0
+        while size < chars_per_page:
+            parts.append(sentence(rng))
+            size += len(parts[-1]) + 1
+        pages.append(" ".join(parts))
+    return pages
+
+
+def make_questions(pages: Sequence[str], count: int, seed: int = 1) -> List[str]:
+    """
+    Questions built from sentences of the corpus, all distinct, so the
+    answer and embedding caches don't flatter the numbers.
+    """
+    rng = random.Random(seed)
+    questions = []
+    for n in range(count):
+        page = rng.choice(pages)
+        fragment = rng.choice(re.split(r"(?<=\.) ", page)).rstrip(".")
+        questions.append(f"Why {fragment[0].lower()}{fragment[1:]}? (q{n})")
+    return questions
+
+
+def split_chunks(page: str, size: int = 1000, overlap: int = 200) -> List[str]:
+    step = max(1, size - overlap)
+    return [page[start:start + size] for start in range(0, max(1, len(page) - overlap), step)]
+
+
+# --- PDFs -------------------------------------------------------------------
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def make_pdf(pages: Sequence[str], line_chars: int = 90) -> bytes:
+    """
+    A minimal PDF with one Helvetica text page per string; pypdf extracts
+    the text back (line breaks become spaces or newlines).
+    """
+    objects: List[bytes] = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"",  # page tree, filled in below
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    kids = []
+    for text in pages:
+        lines = [text[i:i + line_chars] for i in range(0, len(text), line_chars)] or [""]
+        ops = ["BT", "/F1 9 Tf", "11 TL", "40 800 Td"]
+        ops += [f"({_pdf_escape(line)}) Tj T*" for line in lines]
+        ops.append("ET")
+        stream = "\n".join(ops).encode("latin-1", "replace")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_ref = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_ref
+        )
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % k for k in kids), len(kids)
+    )
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % o for o in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+# --- database ---------------------------------------------------------------
+
+def schema_sql() -> str:
+    """
+    The schema from the README's "Database Schema" section, so the benchmark
+    database always matches what the docs tell users to create.
+    """
+    section = README.read_text().split("## Database Schema", 1)[1]
+    return section.split("```sql", 1)[1].split("```", 1)[0]
+
+
+async def seed_documents(conn, chunks: Sequence[Tuple[int, str]], dimensions: int, source: str = "bench-corpus") -> int:
+    """
+    Replace the `documents` table contents with (page, text) chunks,
+    embedded by the same deterministic function the fake OpenAI server uses.
+    """
+    embedder = FakeEmbeddingProvider(dimensions=dimensions)
+    await conn.execute("TRUNCATE documents")
+    batch = 2000
+    for start in range(0, len(chunks), batch):
+        pages = [page for page, _ in chunks[start:start + batch]]
+        texts = [text for _, text in chunks[start:start + batch]]
+        vectors = np.asarray(await embedder.embed(texts), dtype=np.float32)
+        await conn.copy_records_to_table(
+            "documents",
+            columns=["content", "embedding", "metadata", "content_hash"],
+            records=[
+                (
+                    text,
+                    vector,
+                    orjson.dumps({"source": source, "page": page}).decode(),
+                    hashlib.sha256(text.encode()).hexdigest(),
+                )
+                for page, text, vector in zip(pages, texts, vectors)
+            ],
+        )
+    await conn.execute("ANALYZE documents")
+    return len(chunks)
@@ -1,6 +1,8 @@
 from pydantic_settings import BaseSettings
 from pydantic import Field
+from typing import Optional
 from sqlalchemy.engine import URL
+from services.container import Lazy
 
 class Settings(BaseSettings):
     # Supabase
@@ -13,11 +15,132 @@ class Settings(BaseSettings):
     openai_api_key: str = Field(..., env="OPENAI_API_KEY")
     openai_model: str = Field("gpt-3.5-turbo", env="OPENAI_MODEL")
     embedding_model: str = Field("text-embedding-ada-002", env="EMBEDDING_MODEL")
+    # Point at any OpenAI-compatible server (e.g. a local stub); None = api.openai.com
+    openai_base_url: Optional[str] = Field(None, env="OPENAI_BASE_URL")
+
+    # Chat completions gateway (services/llm.py), per worker
+    llm_max_concurrency: int = Field(32, env="LLM_MAX_CONCURRENCY")  # requests in flight
+    llm_max_connections: int = Field(64, env="LLM_MAX_CONNECTIONS")  # pooled keep-alive connections
+    llm_timeout: float = Field(60.0, env="LLM_TIMEOUT")
+    llm_max_retries: int = Field(3, env="LLM_MAX_RETRIES")  # on 429 / 5xx / connection errors
+    llm_retry_base_delay: float = Field(0.5, env="LLM_RETRY_BASE_DELAY")
+    llm_retry_max_delay: float = Field(8.0, env="LLM_RETRY_MAX_DELAY")
+    # Seconds a /v1/query answer may spend on attempts and retries (slot queueing excluded)
+    llm_answer_budget: float = Field(20.0, env="LLM_ANSWER_BUDGET")
+    # Send a second copy of a slow non-streaming completion after the p95 latency
+    llm_hedge_enabled: bool = Field(False, env="LLM_HEDGE_ENABLED")
+    llm_hedge_min_delay: float = Field(1.0, env="LLM_HEDGE_MIN_DELAY")
+
+    # Query embeddings: "openai" or "fake" (deterministic, offline)
+    embedding_provider: str = Field("openai", env="EMBEDDING_PROVIDER")
+    embedding_dimensions: int = Field(1536, env="EMBEDDING_DIMENSIONS")
+    # Concurrent questions arriving within this window share one embeddings request
+    embedding_batch_window_ms: float = Field(5.0, env="EMBEDDING_BATCH_WINDOW_MS")
+    embedding_max_batch: int = Field(64, env="EMBEDDING_MAX_BATCH")
+
+    # Query embedding cache: in-memory LRU + optional SQLite file shared by workers
+    embedding_cache_enabled: bool = Field(True, env="EMBEDDING_CACHE_ENABLED")
+    embedding_cache_size: int = Field(10_000, env="EMBEDDING_CACHE_SIZE")
+    embedding_cache_ttl_seconds: float = Field(3600.0, env="EMBEDDING_CACHE_TTL_SECONDS")
+    embedding_cache_path: Optional[str] = Field(None, env="EMBEDDING_CACHE_PATH")
+    embedding_cache_disk_ttl_seconds: float = Field(7 * 86400.0, env="EMBEDDING_CACHE_DISK_TTL_SECONDS")
+    embedding_cache_disk_max_entries: int = Field(200_000, env="EMBEDDING_CACHE_DISK_MAX_ENTRIES")
+
+    # Logging and metrics
+    log_level: str = Field("INFO", env="LOG_LEVEL")
+    # Share of requests timed stage by stage (Server-Timing, rag_stage_seconds)
+    metrics_sample_rate: float = Field(1.0, env="METRICS_SAMPLE_RATE")
+
+    # Startup warm-up before the worker reports ready (GET /v1/ready): build the
+    # services, open DB_POOL_WARMUP connections, load the vector index
+    warmup_enabled: bool = Field(True, env="WARMUP_ENABLED")
+    # Also send one embeddings request, so the first query finds a warm connection
+    warmup_embedding: bool = Field(True, env="WARMUP_EMBEDDING")
+    # Accept requests while warming up (GET /v1/ready answers 503 until done)
+    warmup_background: bool = Field(False, env="WARMUP_BACKGROUND")
 
     # RAG params
     top_k: int = Field(5, env="TOP_K")
+    # Identical /v1/query and /v1/query-stream requests in flight together share one pipeline run
+    query_coalescing_enabled: bool = Field(True, env="QUERY_COALESCING_ENABLED")
+    # /v1/query-batch: questions per request, completions running at once
+    query_batch_max_questions: int = Field(1000, env="QUERY_BATCH_MAX_QUESTIONS")
+    query_batch_concurrency: int = Field(8, env="QUERY_BATCH_CONCURRENCY")
+    # /v1/query-stream frames: flush after this many chars or ms since the first buffered token
+    stream_coalesce_chars: int = Field(64, env="STREAM_COALESCE_CHARS")
+    stream_coalesce_ms: float = Field(40.0, env="STREAM_COALESCE_MS")
+    # Tokens of retrieved text in the prompt, after merging overlapping chunks
+    context_token_budget: int = Field(2000, env="CONTEXT_TOKEN_BUDGET")
+    # pgvector index on documents.embedding: "hnsw", "ivfflat" or "none"
+    vector_index_type: str = Field("hnsw", env="VECTOR_INDEX_TYPE")
+    vector_index_m: int = Field(16, env="VECTOR_INDEX_M")
+    vector_index_ef_construction: int = Field(64, env="VECTOR_INDEX_EF_CONSTRUCTION")
+    vector_index_lists: int = Field(0, env="VECTOR_INDEX_LISTS")  # ivfflat; 0 = rows/1000
+    vector_index_auto_create: bool = Field(True, env="VECTOR_INDEX_AUTO_CREATE")  # on startup, if missing
+    vector_index_maintenance_work_mem: str = Field("512MB", env="VECTOR_INDEX_MAINTENANCE_WORK_MEM")
+    # Default recall/latency trade-off: "fast", "balanced" or "accurate"
+    vector_search_mode: str = Field("balanced", env="VECTOR_SEARCH_MODE")
+    # Two-phase search over a compact copy of the embeddings (pgvector >= 0.7): "none",
+    # "halfvec" (float16) or "binary" (1 bit per dimension, Hamming); exact cosine rerank on `embedding`
+    vector_compact: str = Field("none", env="VECTOR_COMPACT")
+    vector_rerank_factor: int = Field(0, env="VECTOR_RERANK_FACTOR")  # candidates per result; 0 = per type
+    # "pgvector" (ORDER BY embedding <=> q in Postgres) or "ann" (local memory-mapped IVF index)
+    retrieval_backend: str = Field("pgvector", env="RETRIEVAL_BACKEND")
+    ann_index_dir: str = Field("index/ann", env="ANN_INDEX_DIR")
+    ann_nlist: int = Field(0, env="ANN_NLIST")  # 0 = sqrt(rows)
+    ann_nprobe: int = Field(8, env="ANN_NPROBE")
+    ann_train_sample: int = Field(10_000, env="ANN_TRAIN_SAMPLE")
+    ann_build_on_startup: bool = Field(True, env="ANN_BUILD_ON_STARTUP")  # build if missing
+
+    # Semantic answer cache for /v1/query (per worker, invalidated across workers)
+    answer_cache_enabled: bool = Field(True, env="ANSWER_CACHE_ENABLED")
+    answer_cache_threshold: float = Field(0.95, env="ANSWER_CACHE_THRESHOLD")
+    answer_cache_max_entries: int = Field(1000, env="ANSWER_CACHE_MAX_ENTRIES")
+    answer_cache_ttl_seconds: float = Field(3600.0, env="ANSWER_CACHE_TTL_SECONDS")
+    # Seconds between polls for ingestions run by other workers (0 = only this worker's own)
+    answer_cache_sync_interval: float = Field(2.0, env="ANSWER_CACHE_SYNC_INTERVAL")
+
+    # Conversation history in the prompt: recent turns within a token budget,
+    # older turns folded into a rolling summary (chat_summary table)
+    history_max_turns: int = Field(10, env="HISTORY_MAX_TURNS")
+    history_token_budget: int = Field(1500, env="HISTORY_TOKEN_BUDGET")  # summary + turns
+    history_summary_enabled: bool = Field(True, env="HISTORY_SUMMARY_ENABLED")
+    history_summary_batch: int = Field(4, env="HISTORY_SUMMARY_BATCH")  # turns folded per refresh, at least
+    history_summary_max_fold: int = Field(50, env="HISTORY_SUMMARY_MAX_FOLD")  # and at most
+    history_summary_max_tokens: int = Field(300, env="HISTORY_SUMMARY_MAX_TOKENS")
+    history_summary_model: Optional[str] = Field(None, env="HISTORY_SUMMARY_MODEL")  # None = OPENAI_MODEL
+    # Write-behind buffer for new turns: one multi-row INSERT per batch/interval
+    history_flush_batch: int = Field(200, env="HISTORY_FLUSH_BATCH")
+    history_flush_interval_ms: float = Field(50.0, env="HISTORY_FLUSH_INTERVAL_MS")
+    history_buffer_max: int = Field(5000, env="HISTORY_BUFFER_MAX")  # writers wait when this many are unsaved
+
+    # Rows per server-side cursor fetch in /v1/documents/export
+    documents_export_batch_size: int = Field(1000, env="DOCUMENTS_EXPORT_BATCH_SIZE")
 
     pdf_dir: str = Field("pdfs/", env="PDF_DIR")
+    upload_max_bytes: int = Field(256 * 1024 * 1024, env="UPLOAD_MAX_BYTES")
+    # Collection (documents partition) for uploads that don't name one
+    default_collection: str = Field("default", env="DEFAULT_COLLECTION")
+
+    # Ingestion pipeline: pages -> splitter -> embedding -> insert, bounded queues
+    ingest_chunk_size: int = Field(1000, env="INGEST_CHUNK_SIZE")
+    ingest_chunk_overlap: int = Field(200, env="INGEST_CHUNK_OVERLAP")
+    ingest_embed_batch_size: int = Field(64, env="INGEST_EMBED_BATCH_SIZE")
+    ingest_embed_concurrency: int = Field(4, env="INGEST_EMBED_CONCURRENCY")
+    ingest_insert_batch_size: int = Field(256, env="INGEST_INSERT_BATCH_SIZE")
+    ingest_queue_size: int = Field(4, env="INGEST_QUEUE_SIZE")  # batches buffered between stages
+    # "copy" (binary COPY) or "insert" (pipelined multi-row INSERT) into documents
+    ingest_write_method: str = Field("copy", env="INGEST_WRITE_METHOD")
+    # PDF text extraction in a process pool (0 = use a thread instead)
+    ingest_parse_processes: int = Field(2, env="INGEST_PARSE_PROCESSES")
+    ingest_parse_pages_per_task: int = Field(8, env="INGEST_PARSE_PAGES_PER_TASK")
+
+    ## Background ingestion jobs (ingestion_job table)
+    ingest_workers: int = Field(2, env="INGEST_WORKERS")  # concurrent jobs per app worker
+    ingest_job_poll_interval: float = Field(2.0, env="INGEST_JOB_POLL_INTERVAL")
+    ingest_progress_interval: float = Field(1.0, env="INGEST_PROGRESS_INTERVAL")
+    # running jobs without a progress update for this long are re-queued on startup
+    ingest_job_stale_after: float = Field(60.0, env="INGEST_JOB_STALE_AFTER")
 
     ## PostgreSQL (metadata) credentials, read from .env
     POSTGRES_SERVER: str  = Field(..., env="POSTGRES_SERVER")
@@ -26,8 +149,28 @@ class Settings(BaseSettings):
     POSTGRES_PASSWORD: str = Field("", env="POSTGRES_PASSWORD")
     POSTGRES_DB: str      = Field("", env="POSTGRES_DB")
     POSTGRES_URL: str = Field("", env="POSTGRES_URL")
+    POSTGRES_SSL: bool = Field(True, env="POSTGRES_SSL")  # false for a plain local Postgres
+
+    ## Connection pool
+    # "queue" keeps a pool of warm connections per worker; "null" opens a new
+    # connection for every session (the old behaviour, useful for debugging).
+    db_pool_mode: str = Field("queue", env="DB_POOL_MODE")
+    db_pool_size: int = Field(10, env="DB_POOL_SIZE")
+    db_max_overflow: int = Field(10, env="DB_MAX_OVERFLOW")
+    db_pool_timeout: float = Field(30.0, env="DB_POOL_TIMEOUT")
+    db_pool_recycle: int = Field(1800, env="DB_POOL_RECYCLE")
+    db_pool_pre_ping: bool = Field(False, env="DB_POOL_PRE_PING")
+    # Connections opened on startup so the first requests don't pay for TLS setup
+    db_pool_warmup: int = Field(5, env="DB_POOL_WARMUP")
+    # "none" (direct Postgres), "session" or "transaction" (pgbouncer pool mode)
+    db_pgbouncer_mode: str = Field("none", env="DB_PGBOUNCER_MODE")
+    # Direct (or session-mode) Postgres URL for vector index builds, which need
+    # session state; defaults to POSTGRES_URL unless DB_PGBOUNCER_MODE=transaction
+    db_maintenance_url: Optional[str] = Field(None, env="DB_MAINTENANCE_URL")
+    db_statement_cache_size: int = Field(256, env="DB_STATEMENT_CACHE_SIZE")
 
     class Config:
         env_file = ".env"
 
-settings = Settings()
\ No newline at end of file
+# Validated on first use, so importing a module doesn't require the environment
+settings: Settings = Lazy("settings", Settings, fork_safe=True)  # type: ignore[assignment]
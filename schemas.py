@@ -1,13 +1,57 @@
 from pydantic import BaseModel, Field
-from typing import Any, List, Dict, Optional
+from typing import Any, List, Dict, Literal, Optional
+from uuid import UUID
 
-class UploadResponse(BaseModel):
-    message: str
-    inserted_count: int
+class IngestionJobStatus(BaseModel):
+    id: str
+    filename: str
+    source: Optional[str] = Field(None, description="metadata.source of the document's chunks")
+    collection: str = "default"
+    status: str = Field(..., description="queued | running | succeeded | failed | cancelled")
+    cancel_requested: bool = False
+    progress: Dict[str, Any] = Field(
+        default_factory=dict,
+        description="stage, total_pages, pages_parsed, chunks_embedded, rows_written",
+    )
+    result: Dict[str, Any] = Field(
+        default_factory=dict,
+        description=(
+            "Counts of a finished ingestion: skipped (file unchanged since its last ingestion), pages, "
+            "inserted_count (chunks written), reused_count (inserted chunks whose embedding was reused "
+            "by content hash), unchanged_count (chunks already stored for this file and kept as-is), "
+            "deleted_count (chunks of a previous version of this file that were removed)"
+        ),
+    )
+    error: Optional[str] = None
+    ingestion_id: Optional[str] = Field(None, description="pdf_ingestion row written on success")
+    created_at: str
+    started_at: Optional[str] = None
+    finished_at: Optional[str] = None
+
+class RetrievalScope(BaseModel):
+    """
+    Which chunks retrieval may use; everything when no field is set.
+    """
+    collection: Optional[str] = Field(
+        None, pattern=r"^[a-z0-9][a-z0-9_]{0,47}$", description="Search only this collection"
+    )
+    source: Optional[str] = Field(None, description="Only chunks of this stored file (metadata.source, e.g. pdfs/manual.pdf)")
+    page_from: Optional[int] = Field(None, ge=0, description="Only chunks from this page on (metadata.page)")
+    page_to: Optional[int] = Field(None, ge=0, description="Only chunks up to this page (inclusive)")
+    ingestion_id: Optional[UUID] = Field(None, description="Only chunks of this file version (pdf_ingestion id)")
 
-class QueryRequest(BaseModel):
+class QueryRequest(RetrievalScope):
     question: str
     conversation_id: Optional[str] = Field(None, description="Conversation UUID")
+    search_mode: Optional[Literal["fast", "balanced", "accurate"]] = Field(
+        None, description="Vector search recall/latency trade-off; defaults to VECTOR_SEARCH_MODE"
+    )
+
+class QueryBatchRequest(RetrievalScope):
+    questions: List[str] = Field(..., min_length=1, description="Up to QUERY_BATCH_MAX_QUESTIONS questions")
+    search_mode: Optional[Literal["fast", "balanced", "accurate"]] = Field(
+        None, description="Vector search recall/latency trade-off; defaults to VECTOR_SEARCH_MODE"
+    )
 
 
 class SourceDoc(BaseModel):
@@ -0,0 +1,493 @@
+"""
+In-process approximate nearest neighbour index over documents.embedding.
+
+An IVF (inverted file) index: vectors are L2-normalized, clustered into
+`nlist` lists by spherical k-means, and a query scans only the `nprobe`
+lists whose centroids are closest to it. Everything lives in flat files
+under ANN_INDEX_DIR that are opened with numpy.memmap, so every uvicorn
+worker on the host maps the same pages from the OS page cache instead of
+holding its own copy:
+
+    CURRENT              name of the active version directory
+    lock                 flock() target serializing writers across processes
+    build.lock           flock() held for a whole build: one build per host
+    v<ns>/meta.json      dims, nlist, embedding model, build time
+    v<ns>/centroids.npy  (nlist, dims) float32
+    v<ns>/vectors.f32    (n, dims) float32, normalized, append-only
+    v<ns>/ids.s16        (n,) document UUIDs as 16 raw bytes
+    v<ns>/lists.i32      (n,) list each row belongs to
+    v<ns>/alive.u8       (n,) 0 once the row was deleted
+    v<ns>/state.i64      [row count, retired flag]
+
+Writers append rows and then bump the row count in state.i64; readers only
+look at rows below that count and pick up new rows, tombstones and
+rebuilds (the retired flag) on their next search without any syscalls.
+"""
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Sequence, Tuple
+from uuid import UUID
+import numpy as np
+from sqlalchemy import text
+from config import settings
+from services.container import Lazy
+
+logger = logging.getLogger(__name__)
+
+_COUNT, _RETIRED = 0, 1
+_ASSIGN_BATCH = 8192
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _id_bytes(ids: Sequence[Any]) -> np.ndarray:
+    return np.array([(i if isinstance(i, UUID) else UUID(str(i))).bytes for i in ids], dtype="S16")
+
+
+def _to_uuid(raw: bytes) -> UUID:
+    # numpy drops trailing NUL bytes of S16 items
+    return UUID(bytes=raw.ljust(16, b"\0"))
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    lists = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), _ASSIGN_BATCH):
+        block = np.asarray(vectors[start:start + _ASSIGN_BATCH])
+        lists[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return lists
+
+
+def train_centroids(vectors: np.ndarray, nlist: int, sample: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    Spherical k-means on a random sample of (normalized) rows.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(vectors)
+    rows = np.sort(rng.choice(n, size=min(n, sample), replace=False))
+    data = np.asarray(vectors[rows])
+    centroids = data[rng.choice(len(data), size=nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(data @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, data)
+        empty = np.bincount(assign, minlength=nlist) == 0
+        # Re-seed empty lists with random points so every list stays useful
+        sums[empty] = data[rng.choice(len(data), size=int(empty.sum()))]
+        centroids = _normalize(sums)
+    return centroids
+
+
+@dataclass
+class _Snapshot:
+    """
+    Arrays of one index version as of a given row count; immutable once
+    published so searches in worker threads never see a half-refresh.
+    """
+    count: int
+    vectors: np.ndarray
+    ids: np.ndarray
+    alive: np.ndarray
+    order: np.ndarray    # row numbers sorted by list
+    offsets: np.ndarray  # order[offsets[l]:offsets[l + 1]] are the rows of list l
+
+
+class _Version:
+    def __init__(self, path: str):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.dims = int(self.meta["dims"])
+        self.nlist = int(self.meta["nlist"])
+        self.centroids = np.load(os.path.join(path, "centroids.npy"), mmap_mode="r")
+        self.state = np.memmap(os.path.join(path, "state.i64"), dtype=np.int64, mode="r+", shape=(2,))
+        self.snapshot: Optional[_Snapshot] = None
+
+    def file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    @property
+    def retired(self) -> bool:
+        return bool(self.state[_RETIRED])
+
+    def refresh(self) -> _Snapshot:
+        count = int(self.state[_COUNT])
+        if self.snapshot is not None and self.snapshot.count == count:
+            return self.snapshot
+        if count == 0:
+            empty = np.empty(0, dtype=np.int64)
+            self.snapshot = _Snapshot(0, np.empty((0, self.dims), np.float32), np.empty(0, "S16"),
+                                      np.empty(0, np.uint8), empty, np.zeros(self.nlist + 1, np.int64))
+            return self.snapshot
+        lists = np.memmap(self.file("lists.i32"), dtype=np.int32, mode="r", shape=(count,))
+        order = np.argsort(lists, kind="stable")
+        offsets = np.zeros(self.nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(lists, minlength=self.nlist), out=offsets[1:])
+        self.snapshot = _Snapshot(
+            count=count,
+            vectors=np.memmap(self.file("vectors.f32"), dtype=np.float32, mode="r", shape=(count, self.dims)),
+            ids=np.memmap(self.file("ids.s16"), dtype="S16", mode="r", shape=(count,)),
+            alive=np.memmap(self.file("alive.u8"), dtype=np.uint8, mode="r", shape=(count,)),
+            order=order,
+            offsets=offsets,
+        )
+        return self.snapshot
+
+    def append(self, ids: np.ndarray, vectors: np.ndarray) -> int:
+        """
+        Append rows (caller holds the writer lock). Data files are written
+        before the row count is bumped, so readers never see partial rows.
+        """
+        if len(ids) == 0:
+            return 0
+        vectors = _normalize(vectors)
+        if vectors.shape[1] != self.dims:
+            raise ValueError(f"Index has {self.dims} dims, got {vectors.shape[1]}")
+        count = int(self.state[_COUNT])
+        payload = {
+            "vectors.f32": vectors.tobytes(),
+            "ids.s16": ids.tobytes(),
+            "lists.i32": _assign(vectors, np.asarray(self.centroids)).tobytes(),
+            "alive.u8": np.ones(len(ids), dtype=np.uint8).tobytes(),
+        }
+        itemsize = {"vectors.f32": 4 * self.dims, "ids.s16": 16, "lists.i32": 4, "alive.u8": 1}
+        for name, data in payload.items():
+            with open(self.file(name), "r+b") as f:
+                # Truncate anything a crashed writer left past the row count
+                f.truncate(count * itemsize[name])
+                f.seek(count * itemsize[name])
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        self.state[_COUNT] = count + len(ids)
+        self.state.flush()
+        return len(ids)
+
+    def remove(self, ids: np.ndarray) -> int:
+        count = int(self.state[_COUNT])
+        if count == 0 or len(ids) == 0:
+            return 0
+        stored = np.memmap(self.file("ids.s16"), dtype="S16", mode="r", shape=(count,))
+        rows = np.flatnonzero(np.isin(stored, ids))
+        if len(rows):
+            alive = np.memmap(self.file("alive.u8"), dtype=np.uint8, mode="r+", shape=(count,))
+            alive[rows] = 0
+            alive.flush()
+        return len(rows)
+
+    def size_bytes(self) -> int:
+        return sum(os.path.getsize(self.file(name)) for name in os.listdir(self.path))
+
+
+class AnnIndex:
+    """
+    Memory-mapped IVF index shared by all workers on a host (see module
+    docstring for the file layout). Searches return (document id,
+    cosine similarity) pairs; `ready` is False until an index was built.
+    """
+
+    def __init__(self, directory: str, nprobe: int = 8, nlist: int = 0, train_sample: int = 10_000):
+        self.directory = directory
+        self.nprobe = nprobe
+        self.nlist = nlist
+        self.train_sample = train_sample
+        self._version: Optional[_Version] = None
+        self._lock = threading.Lock()
+        self.searches = 0
+        self.fallbacks = 0
+
+    # --- files / locking -------------------------------------------------
+
+    @contextmanager
+    def _writer_lock(self) -> Iterator[None]:
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "lock"), "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @contextmanager
+    def _build_lock(self) -> Iterator[bool]:
+        """
+        Host-wide build ownership: yields False, without waiting, if another
+        worker or process is already building.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "build.lock"), "a+") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _current_name(self) -> Optional[str]:
+        try:
+            with open(os.path.join(self.directory, "CURRENT")) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _open_current(self) -> Optional[_Version]:
+        with self._lock:
+            if self._version is not None and not self._version.retired:
+                return self._version
+            name = self._current_name()
+            if name is None:
+                self._version = None
+            elif self._version is None or self._version.name != name:
+                self._version = _Version(os.path.join(self.directory, name))
+                logger.info(f"Opened ANN index {name} ({int(self._version.state[_COUNT])} rows).")
+            return self._version
+
+    @property
+    def ready(self) -> bool:
+        return self._open_current() is not None
+
+    # --- search ----------------------------------------------------------
+
+    def search_sync(self, q_vector: np.ndarray, k: int, nprobe: Optional[int] = None) -> List[Tuple[UUID, float]]:
+        version = self._open_current()
+        if version is None:
+            raise RuntimeError("ANN index has not been built")
+        with self._lock:
+            snap = version.refresh()
+        q = _normalize(q_vector)
+        nprobe = min(nprobe or self.nprobe, version.nlist)
+        probe = np.argpartition(-(np.asarray(version.centroids) @ q), nprobe - 1)[:nprobe]
+        rows = np.concatenate([snap.order[snap.offsets[l]:snap.offsets[l + 1]] for l in probe])
+        rows = np.sort(rows)  # sequential page access into the memmap
+        rows = rows[snap.alive[rows] == 1]
+        if len(rows) == 0:
+            return []
+        sims = snap.vectors[rows] @ q
+        top = np.argpartition(-sims, min(k, len(sims)) - 1)[:k]
+        top = top[np.argsort(-sims[top])]
+        self.searches += 1
+        return [(_to_uuid(snap.ids[rows[i]]), float(sims[i])) for i in top]
+
+    async def search(self, q_vector: np.ndarray, k: int, nprobe: Optional[int] = None) -> List[Tuple[UUID, float]]:
+        return await asyncio.to_thread(self.search_sync, q_vector, k, nprobe)
+
+    # --- incremental updates ---------------------------------------------
+
+    def apply_sync(self, added_ids: Sequence[Any], added_vectors: Any, deleted_ids: Sequence[Any]) -> Tuple[int, int]:
+        with self._writer_lock():
+            name = self._current_name()
+            if name is None:
+                return 0, 0
+            version = _Version(os.path.join(self.directory, name))
+            removed = version.remove(_id_bytes(deleted_ids)) if len(deleted_ids) else 0
+            added = version.append(_id_bytes(added_ids), np.asarray(added_vectors)) if len(added_ids) else 0
+        return added, removed
+
+    async def apply(self, added_ids: Sequence[Any], added_vectors: Any, deleted_ids: Sequence[Any] = ()) -> None:
+        """
+        Mirror committed chunk inserts/deletes into the index. A no-op until
+        the index has been built; never fails the caller's ingestion.
+        """
+        try:
+            added, removed = await asyncio.to_thread(self.apply_sync, added_ids, added_vectors, deleted_ids)
+            if added or removed:
+                logger.info(f"ANN index: added {added} rows, removed {removed}.")
+        except Exception as e:
+            logger.error(f"ANN index update failed, rebuild it to resync: {e}")
+
+    # --- build -----------------------------------------------------------
+
+    async def build_from_table(self, batch_size: int = 5000, if_missing: bool = False) -> Dict[str, Any]:
+        """
+        Build a fresh version from the documents table and switch to it.
+        With `if_missing` (startup), skip when an index exists or another
+        worker is already building one.
+        """
+        from services.db import get_session  # keep the module importable without a DB
+
+        async def batches() -> AsyncIterator[Tuple[List[Any], np.ndarray]]:
+            async with get_session() as session:
+                result = await session.stream(
+                    text("SELECT id, embedding FROM documents WHERE embedding IS NOT NULL")
+                )
+                async for rows in result.partitions(batch_size):
+                    yield [r.id for r in rows], np.stack([r.embedding for r in rows])
+
+        return await self.build(batches(), if_missing=if_missing)
+
+    async def build(
+        self, batches: AsyncIterator[Tuple[List[Any], np.ndarray]], if_missing: bool = False
+    ) -> Dict[str, Any]:
+        """
+        Build a new version from (ids, vectors) batches and switch to it.
+        Batches are written straight to the new version's files, so memory
+        stays bounded by the training sample. Rows added to or deleted from
+        the current version while the build ran are carried over.
+
+        One build runs per host at a time: a second one raises, or with
+        `if_missing` returns {"skipped": ...} (as it does when an index
+        already exists), without reading any batch.
+        """
+        with self._build_lock() as owner:
+            if not owner:
+                if if_missing:
+                    logger.info("ANN index is being built by another worker; not building here.")
+                    return {"skipped": "building elsewhere"}
+                raise RuntimeError("another worker is already building the ANN index")
+            if if_missing and self._current_name() is not None:
+                return {"skipped": "already built"}
+            return await self._build(batches)
+
+    async def _build(self, batches: AsyncIterator[Tuple[List[Any], np.ndarray]]) -> Dict[str, Any]:
+        started = time.perf_counter()
+        with self._writer_lock():
+            old_name = self._current_name()
+            old_count = int(_Version(os.path.join(self.directory, old_name)).state[_COUNT]) if old_name else 0
+        name = f"v{time.time_ns()}"
+        path = os.path.join(self.directory, name)
+        os.makedirs(path)
+
+        count, dims = 0, None
+        try:
+            with open(os.path.join(path, "vectors.f32"), "wb") as vf, open(os.path.join(path, "ids.s16"), "wb") as idf:
+                async for ids, vectors in batches:
+                    vectors = _normalize(vectors)
+                    dims = vectors.shape[1]
+                    await asyncio.to_thread(vf.write, vectors.tobytes())
+                    idf.write(_id_bytes(ids).tobytes())
+                    count += len(ids)
+            if count == 0:
+                raise RuntimeError("No embeddings to index")
+            nlist = min(self.nlist or max(1, int(np.sqrt(count))), count)
+            await asyncio.to_thread(self._train, path, count, dims, nlist)
+        except BaseException:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+
+        with self._writer_lock():
+            new = _Version(path)
+            carried = 0
+            # Normally still old_name (builds hold build.lock), but retire
+            # whatever is actually being replaced: a version nobody retires
+            # stays open, and unsynced, in every worker that mapped it
+            current = self._current_name()
+            if current:
+                old = _Version(os.path.join(self.directory, current))
+                # Rows of another version may or may not be in ours: replay all (ids are deduplicated)
+                carried = self._carry_over(old, new, old_count if current == old_name else 0)
+            tmp = os.path.join(self.directory, "CURRENT.tmp")
+            with open(tmp, "w") as f:
+                f.write(name)
+            os.replace(tmp, os.path.join(self.directory, "CURRENT"))
+            if current:
+                old.state[_RETIRED] = 1
+                old.state.flush()
+                # Workers still mapping the old files keep them alive until they reopen
+                shutil.rmtree(old.path, ignore_errors=True)
+
+        stats = {
+            "version": name,
+            "rows": int(new.state[_COUNT]),
+            "carried_over": carried,
+            "nlist": new.nlist,
+            "dims": new.dims,
+            "seconds": round(time.perf_counter() - started, 2),
+        }
+        logger.info(f"Built ANN index: {stats}")
+        return stats
+
+    def _train(self, path: str, count: int, dims: int, nlist: int) -> None:
+        vectors = np.memmap(os.path.join(path, "vectors.f32"), dtype=np.float32, mode="r", shape=(count, dims))
+        centroids = train_centroids(vectors, nlist, self.train_sample)
+        np.save(os.path.join(path, "centroids.npy"), centroids)
+        _assign(vectors, centroids).tofile(os.path.join(path, "lists.i32"))
+        np.ones(count, dtype=np.uint8).tofile(os.path.join(path, "alive.u8"))
+        np.array([count, 0], dtype=np.int64).tofile(os.path.join(path, "state.i64"))
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({
+                "dims": dims,
+                "nlist": nlist,
+                "embedding_model": settings.embedding_model,
+                "built_at": time.time(),
+            }, f)
+
+    @staticmethod
+    def _carry_over(old: _Version, new: _Version, since: int) -> int:
+        """
+        Replay changes the old version received during the build: rows
+        appended after the build started, and tombstones.
+        """
+        snap = old.refresh()
+        new_ids = np.memmap(new.file("ids.s16"), dtype="S16", mode="r", shape=(int(new.state[_COUNT]),))
+        dead = snap.ids[snap.alive == 0]
+        if len(dead):
+            new.remove(np.asarray(dead))
+        rows = np.arange(since, snap.count)
+        rows = rows[(snap.alive[rows] == 1) & ~np.isin(snap.ids[rows], new_ids)]
+        return new.append(np.asarray(snap.ids[rows]), np.asarray(snap.vectors[rows]))
+
+    # --- stats -----------------------------------------------------------
+
+    def stats(self) -> Dict[str, Any]:
+        version = self._open_current()
+        if version is None:
+            return {"ready": False, "directory": self.directory}
+        with self._lock:
+            snap = version.refresh()
+        return {
+            "ready": True,
+            "version": version.name,
+            "rows": snap.count,
+            "alive_rows": int(snap.alive.sum()) if snap.count else 0,
+            "dims": version.dims,
+            "nlist": version.nlist,
+            "nprobe": self.nprobe,
+            "size_bytes": version.size_bytes(),
+            "embedding_model": version.meta.get("embedding_model"),
+            "searches": self.searches,
+            "fallbacks": self.fallbacks,
+        }
+
+
+# Falsy unless RETRIEVAL_BACKEND=ann
+ann_index: Optional[AnnIndex] = Lazy(  # type: ignore[assignment]
+    "ann_index",
+    lambda: AnnIndex(
+        settings.ann_index_dir,
+        nprobe=settings.ann_nprobe,
+        nlist=settings.ann_nlist,
+        train_sample=settings.ann_train_sample,
+    )
+    if settings.retrieval_backend == "ann"
+    else None,
+)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Manage the local ANN index (python -m services.ann_index build)")
+    parser.add_argument("command", choices=["build", "stats"])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    index = ann_index or AnnIndex(settings.ann_index_dir, settings.ann_nprobe, settings.ann_nlist, settings.ann_train_sample)
+    if args.command == "build":
+        print(json.dumps(asyncio.run(index.build_from_table()), indent=2))
+    else:
+        print(json.dumps(index.stats(), indent=2))
@@ -0,0 +1,349 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+from sqlalchemy import text
+from config import settings
+from services.container import Lazy, resolve
+from services.db import get_session
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedAnswer:
+    answer: str
+    source_docs: List[Dict[str, Any]]
+    created_at: float
+    # Similarity of the weakest retrieved source. A new chunk closer to the
+    # question than this would have entered the top-k and may change the answer.
+    floor_similarity: float
+    hits: int = 0
+
+
+class SemanticAnswerCache:
+    """
+    Caches answers by question embedding. A new question whose (already
+    computed) embedding has cosine similarity >= `threshold` with a previously
+    answered one gets that answer back without retrieval or an LLM call.
+
+    Entries live in a fixed-size float32 matrix so a lookup is one
+    matrix-vector product over at most `max_entries` rows. Answers are only
+    reused within the same `scope` (the retrieval filters they were produced
+    with: an answer from one collection says nothing about another).
+    """
+
+    def __init__(self, threshold: float = 0.95, max_entries: int = 1000, ttl: float = 3600.0):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._vectors: Optional[np.ndarray] = None
+        self._valid = np.zeros(max_entries, dtype=bool)
+        self._scopes = np.full(max_entries, "", dtype=object)
+        self._entries: List[Optional[CachedAnswer]] = [None] * max_entries
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _normalize(vector: Sequence[float]) -> np.ndarray:
+        v = np.asarray(vector, dtype=np.float32)
+        norm = float(np.linalg.norm(v))
+        return v / norm if norm else v
+
+    def _drop(self, slot: int) -> None:
+        self._valid[slot] = False
+        self._entries[slot] = None
+
+    def lookup(self, q_vector: Sequence[float], scope: str = "") -> Optional[Tuple[str, List[Dict[str, Any]]]]:
+        if self._vectors is None or not self._valid.any():
+            self.misses += 1
+            return None
+        q = self._normalize(q_vector)
+        if q.shape[0] != self._vectors.shape[1]:
+            self.misses += 1
+            return None
+        sims = self._vectors @ q
+        sims[~self._valid | (self._scopes != scope)] = -np.inf
+        slot = int(np.argmax(sims))
+        entry = self._entries[slot]
+        if entry is not None and time.monotonic() - entry.created_at > self.ttl:
+            self._drop(slot)
+            entry = None
+        if entry is None or sims[slot] < self.threshold:
+            self.misses += 1
+            return None
+        entry.hits += 1
+        self.hits += 1
+        logger.debug(f"Answer cache hit (similarity={sims[slot]:.4f})")
+        return entry.answer, entry.source_docs
+
+    def store(
+        self, q_vector: Sequence[float], answer: str, source_docs: List[Dict[str, Any]], k: int, scope: str = ""
+    ) -> None:
+        q = self._normalize(q_vector)
+        if self._vectors is None or self._vectors.shape[1] != q.shape[0]:
+            self._vectors = np.zeros((self.max_entries, q.shape[0]), dtype=np.float32)
+            self._valid[:] = False
+            self._entries = [None] * self.max_entries
+
+        free = np.flatnonzero(~self._valid)
+        if free.size:
+            slot = int(free[0])
+        else:
+            # Evict the least useful entry: fewest hits, then oldest
+            slot = min(range(self.max_entries), key=lambda i: (self._entries[i].hits, self._entries[i].created_at))
+            self.evictions += 1
+
+        if len(source_docs) < k:
+            # The corpus didn't fill the top-k, so any new chunk could matter
+            floor = -1.0
+        else:
+            floor = min((d.get("similarity") or 0.0) for d in source_docs)
+
+        self._vectors[slot] = q
+        self._valid[slot] = True
+        self._scopes[slot] = scope
+        self._entries[slot] = CachedAnswer(
+            answer=answer,
+            source_docs=source_docs,
+            created_at=time.monotonic(),
+            floor_similarity=floor,
+        )
+        self.stores += 1
+
+    def invalidate(self, chunk_vectors: Optional[Sequence[Sequence[float]]] = None) -> int:
+        """
+        Drop answers that newly ingested chunks could change. With
+        `chunk_vectors`, only entries whose question is closer to some new
+        chunk than to its weakest cached source are dropped; without them,
+        everything is. Returns the number of entries removed.
+        """
+        scan = self.invalidation_scan()
+        if chunk_vectors is None:
+            scan.observe_all()
+        else:
+            scan.observe(chunk_vectors)
+        return scan.apply()
+
+    def invalidate_collections(self, collections: Iterable[str]) -> int:
+        """
+        Drop every answer that chunks newly written to `collections` could
+        change: those scoped to one of them and those not scoped to any
+        collection. Used when the new chunks' vectors aren't at hand (an
+        ingestion run by another worker). Returns the number removed.
+        """
+        names = set(collections)
+        dropped = 0
+        for slot in np.flatnonzero(self._valid):
+            collection = _scope_collection(self._scopes[slot])
+            if collection is None or collection in names:
+                self._drop(int(slot))
+                dropped += 1
+        self.invalidations += dropped
+        return dropped
+
+    def invalidation_scan(self) -> "InvalidationScan":
+        """
+        Start an incremental invalidation: feed chunk vectors batch by batch
+        while ingesting, then `apply()` once the chunks are committed.
+        Answers stored in between are dropped by `apply()`.
+        """
+        return InvalidationScan(self)
+
+    def clear(self) -> None:
+        self.invalidate()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": int(self._valid.sum()),
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+def _scope_collection(scope: str) -> Optional[str]:
+    # Scopes are SearchFilters.key(): "collection=x&source=y", "" without filters
+    for part in scope.split("&"):
+        name, _, value = part.partition("=")
+        if name == "collection":
+            return value
+    return None
+
+
+class InvalidationScan:
+    """
+    Tracks, per cached entry, the closest newly ingested chunk seen so far.
+    Memory is O(entries), independent of how many chunks are observed.
+
+    Only entries that existed when the scan started are compared with the
+    chunks. Answers cached while the ingestion ran were computed against the
+    corpus before its commit and never saw the earlier batches, so `apply()`
+    drops them too.
+    """
+
+    def __init__(self, cache: SemanticAnswerCache):
+        self.cache = cache
+        self.slots = np.flatnonzero(cache._valid)
+        self.entries = [cache._entries[i] for i in self.slots]
+        self.floors = np.array([e.floor_similarity for e in self.entries], dtype=np.float32)
+        self.closest = np.full(len(self.slots), -np.inf, dtype=np.float32)
+
+    def observe(self, chunk_vectors: Sequence[Sequence[float]]) -> None:
+        if not len(self.slots) or not len(chunk_vectors):
+            return
+        chunks = np.array(chunk_vectors, dtype=np.float32)
+        if chunks.shape[1] != self.cache._vectors.shape[1]:
+            return self.observe_all()
+        chunks /= np.maximum(np.linalg.norm(chunks, axis=1, keepdims=True), 1e-12)
+        np.maximum(self.closest, (self.cache._vectors[self.slots] @ chunks.T).max(axis=1), out=self.closest)
+
+    def observe_all(self) -> None:
+        self.closest[:] = np.inf
+
+    def apply(self) -> int:
+        dropped = 0
+        for slot, entry, stale in zip(self.slots, self.entries, self.closest >= self.floors):
+            # Skip slots that were evicted and reused since the scan started
+            if stale and self.cache._entries[slot] is entry:
+                self.cache._drop(int(slot))
+                dropped += 1
+        scanned = {id(entry) for entry in self.entries}
+        for slot in np.flatnonzero(self.cache._valid):
+            if id(self.cache._entries[slot]) not in scanned:
+                self.cache._drop(int(slot))
+                dropped += 1
+        self.cache.invalidations += dropped
+        if dropped:
+            logger.info(f"Answer cache: invalidated {dropped} entries after ingestion.")
+        return dropped
+
+
+class AnswerCacheSync:
+    """
+    Carries invalidation to the other workers. An ingestion invalidates
+    precisely only in the worker that ran it (InvalidationScan, it has the
+    new chunks' vectors); every worker also polls pdf_ingestion every
+    `interval` seconds and drops the answers whose scope covers a
+    collection ingested into by someone else since the last poll.
+
+    Polling goes through the regular pool, so it works behind a
+    transaction-mode pooler where LISTEN/NOTIFY doesn't. ingested_at is
+    stamped by the ingesting worker just before its commit, so each poll
+    looks `lookback` seconds further back than the previous one and skips
+    records it has already handled.
+    """
+
+    def __init__(self, cache: SemanticAnswerCache, interval: float, lookback: float = 60.0):
+        self.cache = cache
+        self.interval = interval
+        self.lookback = lookback
+        self._since: Optional[datetime] = None
+        # Handled ingestion ids (remote, or run by this worker) -> monotonic time
+        self._seen: Dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.polls = 0
+        self.remote_ingestions = 0
+        self.errors = 0
+
+    def seen(self, ingestion_id: str) -> None:
+        """
+        Mark an ingestion this worker ran (and already invalidated for).
+        """
+        self._seen[str(ingestion_id)] = time.monotonic()
+
+    async def poll(self) -> int:
+        """
+        Invalidate for ingestions committed elsewhere since the last poll;
+        returns the number of answers dropped.
+        """
+        sql = text("""
+            WITH t AS (SELECT now() AS now)
+            SELECT t.now, p.id, p.collection
+            FROM t
+            LEFT JOIN pdf_ingestion p
+              ON p.ingested_at > coalesce(CAST(:since AS timestamptz), t.now) - make_interval(secs => :lookback)
+        """)
+        async with get_session() as session:
+            rows = (await session.execute(sql, {"since": self._since, "lookback": self.lookback})).fetchall()
+        self.polls += 1
+        self._since = rows[0].now
+        collections = set()
+        for row in rows:
+            if row.id is not None and str(row.id) not in self._seen:
+                self.seen(str(row.id))
+                collections.add(row.collection)
+        # Ids older than any poll window can't come back
+        horizon = time.monotonic() - 2 * (self.lookback + self.interval)
+        self._seen = {k: t for k, t in self._seen.items() if t > horizon}
+        if not collections:
+            return 0
+        self.remote_ingestions += len(collections)
+        dropped = self.cache.invalidate_collections(collections)
+        if dropped:
+            logger.info(f"Answer cache: invalidated {dropped} entries after ingestion into {sorted(collections)}.")
+        return dropped
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # The next successful poll still covers the window since the last one
+                self.errors += 1
+                logger.warning(f"Answer cache sync poll failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop(), name="answer-cache-sync")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "interval_seconds": self.interval,
+            "polls": self.polls,
+            "remote_ingestions": self.remote_ingestions,
+            "errors": self.errors,
+        }
+
+
+# Falsy unless ANSWER_CACHE_ENABLED
+answer_cache: Optional[SemanticAnswerCache] = Lazy(  # type: ignore[assignment]
+    "answer_cache",
+    lambda: SemanticAnswerCache(
+        threshold=settings.answer_cache_threshold,
+        max_entries=settings.answer_cache_max_entries,
+        ttl=settings.answer_cache_ttl_seconds,
+    )
+    if settings.answer_cache_enabled
+    else None,
+)
+
+# Falsy unless the answer cache is enabled and ANSWER_CACHE_SYNC_INTERVAL > 0
+answer_cache_sync: Optional[AnswerCacheSync] = Lazy(  # type: ignore[assignment]
+    "answer_cache_sync",
+    lambda: AnswerCacheSync(resolve(answer_cache), interval=settings.answer_cache_sync_interval)
+    if answer_cache and settings.answer_cache_sync_interval > 0
+    else None,
+)
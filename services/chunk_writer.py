@@ -0,0 +1,130 @@
+import logging
+from typing import Any, Dict, List, Optional, Sequence
+from uuid import UUID, uuid4
+import numpy as np
+from sqlalchemy import text
+from sqlmodel.ext.asyncio.session import AsyncSession
+from services.db import orjson_serializer
+from services.models import Document
+from services.quantized import CompactVectors
+
+logger = logging.getLogger(__name__)
+
+_COLUMNS = ("id", "collection", "content", "metadata", "embedding", "content_hash", "ingestion_id")
+
+
+class ChunkWriter:
+    """
+    Writes chunk rows straight into the `documents` table over the session's
+    asyncpg connection, inside the session's transaction.
+
+    `method="copy"` streams rows with binary COPY (content, JSONB metadata and
+    float32 embeddings, no per-row statements); `method="insert"` falls back to
+    a pipelined multi-row executemany for poolers that reject COPY. With
+    `compact` (VECTOR_COMPACT) each row also gets its halfvec/binary copy of
+    the embedding, so new chunks never need the backfill. All rows go to
+    `collection` (its partition must exist, see Collections.create) and are
+    tagged with `ingestion_id`, the PdfIngestion record being written. Nothing is
+    visible to readers until the session commits, so chunk rows and the
+    PdfIngestion record land atomically.
+    """
+
+    def __init__(
+        self,
+        session: AsyncSession,
+        method: str = "copy",
+        compact: Optional[CompactVectors] = None,
+        collection: str = "default",
+        ingestion_id: Optional[UUID] = None,
+    ):
+        if method not in ("copy", "insert"):
+            raise ValueError(f"Unknown chunk write method: {method}")
+        self.session = session
+        self.method = method
+        self.table = Document.__tablename__
+        self.compact = compact
+        self.collection = collection
+        self.ingestion_id = ingestion_id
+        self.columns = _COLUMNS + ((compact.column,) if compact else ())
+        self.rows_written = 0
+        self._conn: Any = None
+
+    async def open(self, lock_key: str | None = None) -> "ChunkWriter":
+        """
+        Begin the transaction and grab the raw asyncpg connection. With
+        `lock_key`, concurrent writers for the same key (e.g. the same file)
+        are serialized by a transaction-scoped advisory lock.
+        """
+        # Executing through the session starts the transaction on the
+        # connection before we use it directly.
+        await self.session.execute(
+            text("SELECT pg_advisory_xact_lock(hashtext(:key))"),
+            {"key": lock_key or f"{self.table}:{uuid4()}"},
+        )
+        connection = await self.session.connection()
+        raw = await connection.get_raw_connection()
+        self._conn = raw.driver_connection
+        if not self._conn.is_in_transaction():
+            raise RuntimeError("ChunkWriter requires an open transaction")
+        return self
+
+    async def write(
+        self,
+        contents: Sequence[str],
+        metadatas: Sequence[Dict[str, Any]],
+        vectors: np.ndarray | Sequence[np.ndarray],
+        content_hashes: Sequence[str],
+    ) -> List[UUID]:
+        """
+        Write one batch of chunks; returns the generated row ids.
+        """
+        if self._conn is None:
+            raise RuntimeError("ChunkWriter.open() must be awaited first")
+        ids = [uuid4() for _ in contents]
+        records = [
+            (row_id, self.collection, content, orjson_serializer(meta), vector, content_hash, self.ingestion_id)
+            for row_id, content, meta, vector, content_hash in zip(ids, contents, metadatas, vectors, content_hashes)
+        ]
+        if self.compact:
+            records = [record + (value,) for record, value in zip(records, self.compact.values(vectors))]
+        if self.method == "copy":
+            await self._conn.copy_records_to_table(self.table, records=records, columns=self.columns)
+        else:
+            placeholders = ", ".join(f"${i}" for i in range(1, len(self.columns) + 1))
+            await self._conn.executemany(
+                f"INSERT INTO {self.table} ({', '.join(self.columns)}) VALUES ({placeholders})",
+                records,
+            )
+        self.rows_written += len(records)
+        logger.debug(f"Wrote {len(records)} chunk rows via {self.method}")
+        return ids
+
+    async def fetch(self, query: str, *args: Any) -> List[Any]:
+        """
+        Run a read inside the writer's transaction (sees its own uncommitted rows).
+        """
+        return await self._conn.fetch(query, *args)
+
+    async def delete(self, ids: Sequence[UUID]) -> int:
+        """
+        Delete chunk rows of the writer's collection by id inside its transaction.
+        """
+        if not ids:
+            return 0
+        status = await self._conn.execute(
+            f"DELETE FROM {self.table} WHERE collection = $1 AND id = ANY($2::uuid[])", self.collection, list(ids)
+        )
+        return int(status.split()[-1])
+
+    async def retag(self, ids: Sequence[UUID]) -> int:
+        """
+        Move kept rows of the writer's collection to its ingestion_id, so the
+        latest ingestion of a file covers all of its current chunks.
+        """
+        if not ids:
+            return 0
+        status = await self._conn.execute(
+            f"UPDATE {self.table} SET ingestion_id = $1 WHERE collection = $2 AND id = ANY($3::uuid[])",
+            self.ingestion_id, self.collection, list(ids),
+        )
+        return int(status.split()[-1])
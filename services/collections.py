@@ -0,0 +1,204 @@
+"""
+Named collections and metadata filters for retrieval.
+
+Every chunk row belongs to a collection (`documents.collection`,
+DEFAULT_COLLECTION unless the upload names one). With `documents`
+partitioned by LIST on collection (see the README's schema), each
+collection is its own partition with its own vector index, and a search
+restricted to one collection only scans that partition: its cost follows
+the size of the collection, not of the whole corpus. Partitions are created
+on the first upload to a collection.
+
+SearchFilters narrows retrieval further by source file, page range and
+ingestion (the pdf_ingestion row that wrote the chunk). All of it becomes
+part of the vector search's WHERE clause, so Postgres prunes partitions and
+filters rows inside the index scan instead of the app filtering the top k.
+"""
+import logging
+import re
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional, Set, Tuple
+from uuid import UUID
+from sqlalchemy import text
+from services.container import Lazy
+from services.db import engine
+
+logger = logging.getLogger(__name__)
+
+# Lowercase, so the name is also a valid part of the partition's table name
+COLLECTION_PATTERN = re.compile(r"^[a-z0-9][a-z0-9_]{0,47}$")
+
+
+def validate_collection(name: str) -> str:
+    if not COLLECTION_PATTERN.match(name):
+        raise ValueError(
+            f"Invalid collection name {name!r}: 1-48 characters of a-z, 0-9 and _, not starting with _"
+        )
+    return name
+
+
+@dataclass(frozen=True)
+class SearchFilters:
+    """
+    Restrictions on which chunks a search may return. Empty filters search
+    every collection, as before collections existed.
+    """
+    collection: Optional[str] = None
+    source: Optional[str] = None  # metadata.source, the stored file path (e.g. pdfs/manual.pdf)
+    page_from: Optional[int] = None  # metadata.page, inclusive
+    page_to: Optional[int] = None
+    ingestion_id: Optional[UUID] = None
+
+    def __bool__(self) -> bool:
+        return any(value is not None for value in asdict(self).values())
+
+    @property
+    def filters_rows(self) -> bool:
+        """
+        Whether rows are filtered inside a partition (by an index scan that
+        may have to skip non-matching rows), not just by partition pruning.
+        """
+        return any(v is not None for v in (self.source, self.page_from, self.page_to, self.ingestion_id))
+
+    def where(self, alias: str = "") -> Tuple[str, Dict[str, Any]]:
+        """
+        SQL condition over `documents` (columns prefixed with `alias.`) and
+        its bind parameters; "TRUE" without filters.
+        """
+        col = f"{alias}." if alias else ""
+        conditions: List[str] = []
+        params: Dict[str, Any] = {}
+        if self.collection is not None:
+            conditions.append(f"{col}collection = :f_collection")
+            params["f_collection"] = self.collection
+        if self.source is not None:
+            # Matches the documents_source_idx expression index
+            conditions.append(f"({col}metadata->>'source') = :f_source")
+            params["f_source"] = self.source
+        if self.page_from is not None:
+            conditions.append(f"CAST({col}metadata->>'page' AS integer) >= :f_page_from")
+            params["f_page_from"] = self.page_from
+        if self.page_to is not None:
+            conditions.append(f"CAST({col}metadata->>'page' AS integer) <= :f_page_to")
+            params["f_page_to"] = self.page_to
+        if self.ingestion_id is not None:
+            conditions.append(f"{col}ingestion_id = :f_ingestion_id")
+            params["f_ingestion_id"] = self.ingestion_id
+        return " AND ".join(conditions) or "TRUE", params
+
+    def key(self) -> str:
+        """
+        Identity of the filters for coalescing and answer cache scopes; "" without filters.
+        """
+        return "&".join(f"{name}={value}" for name, value in asdict(self).items() if value is not None)
+
+
+class Collections:
+    """
+    Partitions of the documents table, one per collection.
+    """
+
+    def __init__(self, table: str = "documents"):
+        self.table = table
+        # None until inspect(): the table may predate collections
+        self.partitioned: Optional[bool] = None
+        self._known: Set[str] = set()
+
+    def partition_name(self, collection: str) -> str:
+        return f"{self.table}__{validate_collection(collection)}"
+
+    async def inspect(self) -> Dict[str, Any]:
+        sql = text("""
+            SELECT c.relkind = 'p' AS partitioned,
+                   EXISTS (SELECT 1 FROM pg_attribute a
+                           WHERE a.attrelid = c.oid AND a.attname = 'collection' AND NOT a.attisdropped) AS has_column
+            FROM pg_class c
+            WHERE c.oid = CAST(:table AS regclass)
+        """)
+        async with engine.connect() as conn:
+            r = (await conn.execute(sql, {"table": self.table})).first()
+        self.partitioned = bool(r.partitioned)
+        return {"partitioned": self.partitioned, "has_column": bool(r.has_column)}
+
+    async def ensure(self) -> None:
+        """
+        Called on startup: check the table is ready for collections.
+        """
+        try:
+            state = await self.inspect()
+        except Exception as e:
+            logger.error(f"Could not inspect {self.table}: {e}")
+            return
+        if not state["has_column"]:
+            logger.error(f"{self.table} has no collection column; ingestion will fail until the table is upgraded "
+                         f"(see the README's Database Schema).")
+        elif not state["partitioned"]:
+            logger.warning(f"{self.table} is not partitioned by collection: collection filters work, "
+                           f"but every search still scans the whole table.")
+
+    async def create(self, collection: str) -> None:
+        """
+        Make sure `collection` has a partition before rows are written to it.
+        The partition is created standalone and then attached, which only
+        takes a SHARE UPDATE EXCLUSIVE lock on the parent (searches and
+        other ingestions keep going); attaching builds its indexes, which is
+        instant on an empty table. A no-op on an unpartitioned table.
+        """
+        if collection in self._known:
+            return
+        partition = self.partition_name(collection)
+        if self.partitioned is None:
+            await self.inspect()
+        if self.partitioned:
+            async with engine.begin() as conn:
+                await conn.execute(text("SELECT set_config('lock_timeout', '10s', true)"))
+                await conn.execute(
+                    text("SELECT pg_advisory_xact_lock(hashtext(:key))"), {"key": f"collection:{partition}"}
+                )
+                exists = (await conn.execute(
+                    text("SELECT to_regclass(:name) IS NOT NULL"), {"name": partition}
+                )).scalar()
+                if not exists:
+                    await conn.execute(text(f"CREATE TABLE {partition} (LIKE {self.table} INCLUDING DEFAULTS)"))
+                    # The name was validated, so it is safe in a literal
+                    await conn.execute(text(
+                        f"ALTER TABLE {self.table} ATTACH PARTITION {partition} FOR VALUES IN ('{collection}')"
+                    ))
+                    logger.info(f"Created partition {partition} for collection {collection!r}.")
+        self._known.add(collection)
+
+    async def list(self) -> List[Dict[str, Any]]:
+        """
+        Collections with their approximate row counts and sizes.
+        """
+        if self.partitioned is None:
+            await self.inspect()
+        if not self.partitioned:
+            sql = text(f"SELECT collection, count(*) AS rows FROM {self.table} GROUP BY collection ORDER BY collection")
+            async with engine.connect() as conn:
+                rows = (await conn.execute(sql)).fetchall()
+            return [{"collection": r.collection, "rows": r.rows} for r in rows]
+        sql = text("""
+            SELECT c.relname AS partition, pg_get_expr(c.relpartbound, c.oid) AS bound,
+                   greatest(c.reltuples, 0)::bigint AS estimated_rows,
+                   pg_total_relation_size(c.oid) AS size_bytes
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = CAST(:table AS regclass)
+            ORDER BY c.relname
+        """)
+        async with engine.connect() as conn:
+            rows = (await conn.execute(sql, {"table": self.table})).fetchall()
+        result = []
+        for r in rows:
+            values = re.findall(r"'((?:[^']|'')*)'", r.bound or "")
+            result.append({
+                "collection": values[0].replace("''", "'") if len(values) == 1 else r.bound,
+                "partition": r.partition,
+                "estimated_rows": r.estimated_rows,
+                "size_bytes": r.size_bytes,
+            })
+        return result
+
+
+collections: Collections = Lazy("collections", Collections)  # type: ignore[assignment]
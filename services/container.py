@@ -0,0 +1,152 @@
+"""
+Lazily built services.
+
+Module-level singletons (settings, the database engine, the LLM gateway,
+embedding provider/batcher/cache, caches and background managers) are
+`Lazy` proxies: importing a module neither validates settings nor opens a
+client. Each one is built on first use, or by `build_all()` during the
+startup warm-up, and then behaves like the object itself.
+
+Worker processes forked from a preloaded parent (gunicorn --preload) drop
+every built service after the fork, so each worker opens its own pools,
+HTTP clients and SQLite connections instead of sharing the parent's.
+"""
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Generic, List, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# One re-entrant lock for all builds: factories use other lazy services
+_build_lock = threading.RLock()
+_registry: List["Lazy[Any]"] = []
+
+
+class Lazy(Generic[T]):
+    """
+    Proxy that builds its object with `factory` on first use and forwards
+    attribute access, assignment and calls to it.
+
+    A factory may return None for a disabled optional service. The proxy
+    itself is never None, so test it with `if proxy:` (false exactly when the
+    built value is None), not `is not None`. Use `resolve()` where the real
+    object is needed, e.g. to pass it to a library.
+
+    `fork_safe` services are kept in forked children; for the others
+    `on_fork(value)` runs in the child before the object is dropped (e.g. to
+    detach inherited connections without closing them).
+    """
+
+    __slots__ = ("_name", "_factory", "_value", "_built", "_fork_safe", "_on_fork")
+
+    def __init__(
+        self,
+        name: str,
+        factory: Callable[[], T],
+        fork_safe: bool = False,
+        on_fork: Optional[Callable[[T], None]] = None,
+    ):
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_value", None)
+        object.__setattr__(self, "_built", False)
+        object.__setattr__(self, "_fork_safe", fork_safe)
+        object.__setattr__(self, "_on_fork", on_fork)
+        _registry.append(self)
+
+    def _resolve(self) -> T:
+        if not self._built:
+            with _build_lock:
+                if not self._built:
+                    start = time.perf_counter()
+                    object.__setattr__(self, "_value", self._factory())
+                    object.__setattr__(self, "_built", True)
+                    logger.debug(f"Built {self._name} in {(time.perf_counter() - start) * 1e3:.1f} ms")
+        return self._value
+
+    def _set(self, value: Optional[T]) -> None:
+        with _build_lock:
+            object.__setattr__(self, "_value", value)
+            object.__setattr__(self, "_built", True)
+
+    def _reset(self) -> None:
+        with _build_lock:
+            object.__setattr__(self, "_value", None)
+            object.__setattr__(self, "_built", False)
+
+    def __getattr__(self, name: str) -> Any:
+        if name in Lazy.__slots__:
+            # Only reachable on a half-initialised proxy (copy, unpickling)
+            raise AttributeError(name)
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        setattr(self._resolve(), name, value)
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        return self._resolve()(*args, **kwargs)
+
+    def __bool__(self) -> bool:
+        return self._resolve() is not None
+
+    def __repr__(self) -> str:
+        return f"<Lazy {self._name}: {self._value!r}>" if self._built else f"<Lazy {self._name} (not built)>"
+
+
+def resolve(service: Any) -> Any:
+    """
+    The object behind a Lazy proxy (built if needed); other values pass through.
+    """
+    return service._resolve() if isinstance(service, Lazy) else service
+
+
+def override(service: "Lazy[T]", value: Optional[T]) -> None:
+    """
+    Replace a service, built or not (tests, benchmarks, set_provider()).
+    """
+    service._set(value)
+
+
+def is_built(service: "Lazy[Any]") -> bool:
+    return service._built
+
+
+def build_all() -> Dict[str, float]:
+    """
+    Build every registered service now, returning milliseconds per service
+    built by this call (startup warm-up, so no request pays for it).
+    """
+    timings: Dict[str, float] = {}
+    for service in list(_registry):
+        if not service._built:
+            start = time.perf_counter()
+            service._resolve()
+            timings[service._name] = round((time.perf_counter() - start) * 1e3, 2)
+    return timings
+
+
+def built_services() -> List[str]:
+    return [service._name for service in _registry if service._built]
+
+
+def _after_fork_in_child() -> None:
+    # The lock may have been held by another thread at fork time
+    global _build_lock
+    _build_lock = threading.RLock()
+    for service in _registry:
+        if service._fork_safe or not service._built:
+            continue
+        if service._on_fork is not None and service._value is not None:
+            try:
+                service._on_fork(service._value)
+            except Exception as e:
+                logger.warning(f"{service._name}: after-fork hook failed: {e!r}")
+        service._reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
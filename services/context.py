@@ -0,0 +1,172 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+from services.tokens import count_tokens, truncate_tokens
+from config import settings
+from services.container import Lazy
+
+logger = logging.getLogger(__name__)
+
+SEPARATOR = "\n\n---\n\n"
+# Shorter suffix/prefix matches are treated as coincidence, not splitter overlap
+_MIN_OVERLAP_CHARS = 20
+# Don't bother appending a truncated segment smaller than this
+_MIN_TAIL_TOKENS = 32
+
+
+@dataclass
+class PackedContext:
+    text: str
+    tokens: int                 # tokens of `text`
+    raw_tokens: int             # tokens of the retrieved chunks joined as-is
+    chunks: int                 # chunks retrieved
+    segments: int               # merged segments included
+    dropped: int = 0            # segments left out by the budget
+    doc_ids: List[str] = field(default_factory=list)
+
+    @property
+    def tokens_saved(self) -> int:
+        return max(0, self.raw_tokens - self.tokens)
+
+
+def _overlap(left: str, right: str, max_chars: int) -> int:
+    """
+    Length of the longest suffix of `left` that is a prefix of `right`
+    (the text the splitter repeated at the start of the next chunk).
+    """
+    head = right[:_MIN_OVERLAP_CHARS]
+    if len(head) < _MIN_OVERLAP_CHARS:
+        return 0
+    # Candidate starts are occurrences of right's first characters near left's end
+    start = left.find(head, max(0, len(left) - max_chars))
+    while start != -1:
+        if right.startswith(left[start:]):
+            return len(left) - start
+        start = left.find(head, start + 1)
+    return 0
+
+
+def _merge_group(docs: List[Dict[str, Any]], max_overlap: int) -> List[Tuple[str, float, List[str]]]:
+    """
+    Chain chunks of one source page whose ends overlap into single segments.
+    Returns (text, best similarity, ids) per segment.
+    """
+    segments = [[d["content"], d["similarity"], [d["id"]]] for d in docs]
+    merged = True
+    while merged and len(segments) > 1:
+        merged = False
+        for i, left in enumerate(segments):
+            for j, right in enumerate(segments):
+                if i == j:
+                    continue
+                if right[0] in left[0]:
+                    # Fully contained (e.g. a short tail chunk)
+                    left[1] = max(left[1], right[1])
+                    left[2] += right[2]
+                else:
+                    size = _overlap(left[0], right[0], max_overlap)
+                    if not size:
+                        continue
+                    left[0] += right[0][size:]
+                    left[1] = max(left[1], right[1])
+                    left[2] += right[2]
+                del segments[j]
+                merged = True
+                break
+            if merged:
+                break
+    return [(text, sim, ids) for text, sim, ids in segments]
+
+
+class ContextPacker:
+    """
+    Turns retrieved chunks into the prompt's context block: chunks of the same
+    source page are stitched together without the splitter's overlap, exact
+    duplicates are dropped, and the resulting segments are added in
+    similarity order until the token budget is spent.
+    """
+
+    def __init__(self, token_budget: int, max_overlap: int):
+        self.token_budget = token_budget
+        self.max_overlap = max_overlap
+        self.requests = 0
+        self.raw_tokens = 0
+        self.packed_tokens = 0
+        self.chunks_merged = 0
+        self.segments_dropped = 0
+
+    def pack(self, docs: List[Dict[str, Any]], token_budget: Optional[int] = None) -> PackedContext:
+        budget = token_budget or self.token_budget
+        raw_tokens = count_tokens(SEPARATOR.join(d["content"] for d in docs))
+
+        groups: Dict[Tuple[Any, Any], List[Dict[str, Any]]] = {}
+        seen = set()
+        for d in docs:
+            if d["content"] in seen:
+                continue
+            seen.add(d["content"])
+            meta = d.get("metadata") or {}
+            key = (meta.get("source"), meta.get("page")) if meta.get("source") else ("id", d["id"])
+            groups.setdefault(key, []).append(d)
+        segments = [s for group in groups.values() for s in _merge_group(group, self.max_overlap)]
+        segments.sort(key=lambda s: s[1], reverse=True)
+
+        parts: List[str] = []
+        doc_ids: List[str] = []
+        used = dropped = 0
+        separator_tokens = count_tokens(SEPARATOR)
+        for text, _, ids in segments:
+            cost = count_tokens(text) + (separator_tokens if parts else 0)
+            remaining = budget - used
+            if cost > remaining:
+                if parts and remaining < _MIN_TAIL_TOKENS:
+                    dropped += 1
+                    continue
+                # Best segment alone exceeds the budget, or room for a useful prefix
+                text = truncate_tokens(text, remaining - (separator_tokens if parts else 0))
+                if not text:
+                    dropped += 1
+                    continue
+                cost = count_tokens(text) + (separator_tokens if parts else 0)
+            parts.append(text)
+            doc_ids.extend(ids)
+            used += cost
+
+        packed = PackedContext(
+            text=SEPARATOR.join(parts),
+            tokens=used,
+            raw_tokens=raw_tokens,
+            chunks=len(docs),
+            segments=len(parts),
+            dropped=dropped,
+            doc_ids=doc_ids,
+        )
+        self.requests += 1
+        self.raw_tokens += packed.raw_tokens
+        self.packed_tokens += packed.tokens
+        self.chunks_merged += len(docs) - len(segments)
+        self.segments_dropped += dropped
+        logger.info(
+            f"Packed {packed.chunks} chunks into {packed.segments} segments: "
+            f"{packed.tokens}/{packed.raw_tokens} tokens ({packed.tokens_saved} saved, {dropped} dropped)"
+        )
+        return packed
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "token_budget": self.token_budget,
+            "requests": self.requests,
+            "raw_tokens": self.raw_tokens,
+            "packed_tokens": self.packed_tokens,
+            "tokens_saved": self.raw_tokens - self.packed_tokens,
+            "tokens_saved_per_request": (self.raw_tokens - self.packed_tokens) / self.requests if self.requests else 0.0,
+            "chunks_merged": self.chunks_merged,
+            "segments_dropped": self.segments_dropped,
+        }
+
+
+context_packer: ContextPacker = Lazy(  # type: ignore[assignment]
+    "context_packer",
+    lambda: ContextPacker(settings.context_token_budget, settings.ingest_chunk_overlap),
+    fork_safe=True,
+)
@@ -1,16 +1,25 @@
 from sqlalchemy.pool import NullPool
+import asyncio
+import itertools
+import logging
+import os
 import ssl
-import uuid
 import orjson
+from typing import Any, Dict, Optional
 from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import event, text
 from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
 from config import settings
+from services.container import Lazy, is_built, resolve
+from services.vectors import register_vector_codec
 from fastapi.concurrency import asynccontextmanager
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 ssl_context = ssl.create_default_context()
 ssl_context.check_hostname = False
 ssl_context.verify_mode = ssl.CERT_NONE
@@ -24,27 +33,91 @@ def orjson_serializer(obj: object) -> str:
 def orjson_deserializer(s: str | bytes) -> object:
     return orjson.loads(s)
 
-engine: AsyncEngine = create_async_engine(
-    settings.POSTGRES_URL,
-    json_serializer=orjson_serializer,
-    json_deserializer=orjson_deserializer,
-    echo=False,
-    pool_recycle=1800,
-    future=True,
-    pool_pre_ping=True,
-    poolclass=NullPool,
-    connect_args={
-        "ssl": ssl_context,
-        "prepared_statement_name_func": lambda:  f"__asyncpg_{uuid.uuid4()}__",
-        "statement_cache_size": 0,
-        "prepared_statement_cache_size": 0,
-        },
-)
+_statement_ids = itertools.count()
+
+def prepared_statement_name() -> str:
+    """
+    Deterministic, per-process statement names.
+
+    asyncpg's default names (``__asyncpg_stmt_N__``) are only unique per
+    connection, which collides when pgbouncer hands the same server connection
+    to several clients in transaction mode. Prefixing with the worker pid keeps
+    names unique across workers without the churn of random uuid names, so
+    pgbouncer (>= 1.21, ``max_prepared_statements``) can track and reuse them.
+    """
+    return f"__asyncpg_{os.getpid()}_{next(_statement_ids)}__"
+
+def _connect_args() -> Dict[str, Any]:
+    args: Dict[str, Any] = {
+        "ssl": ssl_context if settings.POSTGRES_SSL else False,
+        "statement_cache_size": settings.db_statement_cache_size,
+        "prepared_statement_cache_size": settings.db_statement_cache_size,
+    }
+    if settings.db_pgbouncer_mode == "transaction":
+        args["prepared_statement_name_func"] = prepared_statement_name
+    return args
+
+def _pool_args() -> Dict[str, Any]:
+    if settings.db_pool_mode == "null":
+        return {"poolclass": NullPool}
+    return {
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": settings.db_pool_timeout,
+        "pool_recycle": settings.db_pool_recycle,
+        "pool_pre_ping": settings.db_pool_pre_ping,
+        "pool_use_lifo": True,  # keep a hot core of connections, let extras idle out
+    }
+
+def _create_engine() -> AsyncEngine:
+    engine = create_async_engine(
+        settings.POSTGRES_URL,
+        json_serializer=orjson_serializer,
+        json_deserializer=orjson_deserializer,
+        echo=False,
+        future=True,
+        connect_args=_connect_args(),
+        **_pool_args(),
+    )
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _register_codecs(dbapi_connection, connection_record) -> None:
+        # Query vectors go over the wire as binary float32 instead of text literals
+        # (and halfvec ones for the compact column's COPY)
+        halfvec = settings.vector_compact == "halfvec"
+        dbapi_connection.run_async(lambda conn: register_vector_codec(conn, halfvec=halfvec))
+
+    return engine
+
+def _forget_pool(engine: AsyncEngine) -> None:
+    # In a forked worker: drop the parent's pooled connections without closing
+    # them (that would close the parent's sockets); the child opens its own
+    engine.sync_engine.dispose(close=False)
+
+engine: AsyncEngine = Lazy("db.engine", _create_engine, on_fork=_forget_pool)  # type: ignore[assignment]
+
+def _create_maintenance_engine() -> Optional[AsyncEngine]:
+    # Unpooled, so session state (advisory locks, SET) ends with the connection
+    url = settings.db_maintenance_url
+    if url is None:
+        if settings.db_pgbouncer_mode == "transaction":
+            return None
+        url = settings.POSTGRES_URL
+    return create_async_engine(
+        url,
+        echo=False,
+        future=True,
+        connect_args={"ssl": ssl_context if settings.POSTGRES_SSL else False, "statement_cache_size": 0},
+        poolclass=NullPool,
+    )
 
-async_session_maker = sessionmaker(
-    engine,
-    class_=AsyncSession,
-    expire_on_commit=False,
+# Index maintenance (DDL with session state): a direct or session-mode
+# connection per use. Falsy behind a transaction-mode pooler without DB_MAINTENANCE_URL.
+maintenance_engine: Optional[AsyncEngine] = Lazy("db.maintenance_engine", _create_maintenance_engine)  # type: ignore[assignment]
+
+async_session_maker = Lazy(
+    "db.session_maker",
+    lambda: sessionmaker(resolve(engine), class_=AsyncSession, expire_on_commit=False),
 )
 
 async def init_db() -> None:
@@ -57,10 +130,79 @@ async def init_db() -> None:
     #async with engine.begin() as conn:
     #    await conn.run_sync(SQLModel.metadata.create_all)
 
+async def warm_up_pool(connections: int | None = None) -> int:
+    """
+    Open `connections` pooled connections concurrently and run a trivial
+    statement on each, so TLS/auth setup happens before the first request.
+    Returns the number of connections that came up.
+    """
+    n = settings.db_pool_warmup if connections is None else connections
+    if settings.db_pool_mode == "null" or n <= 0:
+        return 0
+    n = min(n, settings.db_pool_size)
+
+    # Hold every connection until all are open, otherwise the pool would hand
+    # the same one back to each task.
+    ready = asyncio.Event()
+    arrived = 0
+
+    def _arrive() -> None:
+        nonlocal arrived
+        arrived += 1
+        if arrived == n:
+            ready.set()
+
+    async def _open() -> None:
+        try:
+            conn = await engine.connect()
+        except Exception:
+            _arrive()
+            raise
+        try:
+            await conn.execute(text("SELECT 1"))
+        finally:
+            _arrive()
+            await ready.wait()
+            await conn.close()
+
+    results = await asyncio.gather(*(_open() for _ in range(n)), return_exceptions=True)
+    failures = [r for r in results if isinstance(r, BaseException)]
+    if failures:
+        logger.warning(f"DB pool warm-up: {len(failures)}/{n} connections failed: {failures[0]}")
+    logger.info(f"DB pool warm-up: {n - len(failures)} connections ready.")
+    return n - len(failures)
+
+def pool_stats() -> Dict[str, Any]:
+    """
+    Snapshot of the connection pool for this worker.
+    """
+    pool = engine.pool
+    if isinstance(pool, NullPool):
+        return {"mode": "null"}
+    return {
+        "mode": settings.db_pool_mode,
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "max_overflow": settings.db_max_overflow,
+        "pgbouncer_mode": settings.db_pgbouncer_mode,
+        "status": pool.status(),
+    }
+
+async def close_db() -> None:
+    """
+    Close all pooled connections (called on application shutdown).
+    """
+    if is_built(engine):
+        await engine.dispose()
+    if is_built(maintenance_engine) and maintenance_engine:
+        await maintenance_engine.dispose()
+
 @asynccontextmanager
 async def get_session() -> AsyncSession: # type: ignore
     session: AsyncSession = async_session_maker()
     try:
         yield session
     finally:
-        await session.close()
\ No newline at end of file
+        await session.close()
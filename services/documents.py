@@ -1,59 +1,160 @@
-from typing import Any, Dict, List
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple
+from uuid import UUID
+import numpy as np
+import orjson
+from sqlalchemy import text
 from sqlmodel import select
 from services.models import Document
 from services.db import get_session
+from config import settings
 import logging
 
 logger = logging.getLogger(__name__)
 
-async def list_documents(skip: int = 0, limit: int = 10) -> List[Dict[str, Any]]:
+# API field name -> Document column
+DOCUMENT_FIELDS = {
+    "id": Document.id,
+    "content": Document.content,
+    "embedding": Document.embedding,
+    "metadata": Document.meta,
+    "collection": Document.collection,
+}
+
+def parse_fields(fields: Optional[str]) -> List[str]:
+    """
+    Parse a `fields=id,content,...` projection. `id` is always included
+    (it is the pagination cursor); None means every field.
+    """
+    if not fields:
+        return list(DOCUMENT_FIELDS)
+    names = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in names if f not in DOCUMENT_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(unknown)}; choose from {', '.join(DOCUMENT_FIELDS)}")
+    return ["id"] + [f for f in dict.fromkeys(names) if f != "id"]
+
+def _row_dict(row: Any, fields: Sequence[str]) -> Dict[str, Any]:
+    doc = {}
+    for name, value in zip(fields, row):
+        if name == "id":
+            value = str(value)
+        elif name == "embedding":
+            value = safe_embedding(value)
+        doc[name] = value
+    return doc
+
+async def list_documents(
+    after: Optional[UUID] = None,
+    limit: int = 10,
+    fields: Optional[Sequence[str]] = None,
+    skip: int = 0,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
     """
-    Open a single AsyncSession, SELECT * FROM documents, and return
-    a list of plain dicts (id, content, embedding, metadata).
+    One page of documents ordered by id, as plain dicts with the requested
+    `fields`, plus the cursor for the next page (None on the last page).
+
+    Pages are keyset-paginated (`WHERE id > after`), so every page is an
+    index range scan no matter how deep; `skip` (OFFSET) is still accepted
+    for old clients. Only the projected columns are read, so leaving out
+    `embedding` avoids fetching and decoding the vectors at all.
+    Embeddings stay float32 numpy arrays; serialize with ORJSONResponse.
     """
+    fields = list(fields or DOCUMENT_FIELDS)
+    stmt = select(*(DOCUMENT_FIELDS[f] for f in fields)).order_by(Document.id).limit(limit + 1)
+    if after is not None:
+        stmt = stmt.where(Document.id > after)
+    elif skip:
+        stmt = stmt.offset(skip)
     try:
         async with get_session() as session:
-
-            if session is None:
-                raise RuntimeError("Could not acquire database session")
             logger.debug(f"Starting to fetch documents")
-            
-            # 1) Run a simple SELECT * FROM documents
-            stmt = (
-                select(Document)
-                .offset(skip)
-                .limit(limit)
-                .execution_options(autocommit=True)
-            )
-            result = await session.execute(stmt)
-            docs = result.scalars().all()
-            logger.debug(f"Waiting for commit")
-            await session.commit()
-            logger.debug(f"Commit finished")
-            documents_list: List[Dict[str, Any]] = []
-            for doc in docs:
-                logger.debug(f"Type of embedding: {type(doc.embedding)}")
-                documents_list.append({
-                    "id": str(doc.id),
-                    "content": doc.content,
-                    "embedding": safe_embedding(doc.embedding),
-                    "metadata": doc.meta,
-                })
-
-            return documents_list
+            rows = (await session.execute(stmt)).all()
     except Exception as e:
         logger.error(f"Database error in list_documents: {e}")
         raise
+    docs = [_row_dict(row, fields) for row in rows[:limit]]
+    next_cursor = docs[-1]["id"] if len(rows) > limit else None
+    return docs, next_cursor
+
+async def _stream_rows(fields: Sequence[str], batch_size: int) -> AsyncIterator[List[Any]]:
+    """
+    All documents in id order, `batch_size` rows at a time, through a
+    server-side cursor: memory stays at one batch however large the table.
+    """
+    stmt = select(*(DOCUMENT_FIELDS[f] for f in fields)).order_by(Document.id)
+    async with get_session() as session:
+        result = await session.stream(stmt.execution_options(yield_per=batch_size))
+        async for partition in result.partitions(batch_size):
+            yield partition
+
+async def export_ndjson(fields: Sequence[str], batch_size: Optional[int] = None) -> AsyncIterator[bytes]:
+    """
+    The whole corpus as NDJSON, one document per line.
+    """
+    batch_size = batch_size or settings.documents_export_batch_size
+    count = 0
+    async for rows in _stream_rows(fields, batch_size):
+        yield b"".join(
+            orjson.dumps(_row_dict(row, fields), option=orjson.OPT_SERIALIZE_NUMPY) + b"\n" for row in rows
+        )
+        count += len(rows)
+    logger.info(f"Exported {count} documents as NDJSON")
+
+def embedding_dtype(dims: int) -> np.dtype:
+    """
+    Record layout of the .npy export: the UUID's 16 raw bytes and the vector.
+    """
+    return np.dtype([("id", "S16"), ("embedding", "<f4", (dims,))])
+
+def _npy_header(dtype: np.dtype, rows: int) -> bytes:
+    # .npy format 1.0: magic, version, little-endian header length, then a
+    # dict literal padded with spaces so the data starts 64-byte aligned
+    header = repr({"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": (rows,)})
+    header += " " * (-(10 + len(header) + 1) % 64) + "\n"
+    return b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little") + header.encode("latin1")
+
+async def export_npy(batch_size: Optional[int] = None) -> AsyncIterator[bytes]:
+    """
+    All embeddings as one .npy array of (id, embedding) records, readable with
+    np.load(path) or np.load(path, mmap_mode="r"). Content and metadata are
+    not included; join them by id from the NDJSON export.
+
+    The header needs the row count up front, so the count and the rows are
+    read in one REPEATABLE READ transaction to see the same snapshot.
+    """
+    batch_size = batch_size or settings.documents_export_batch_size
+    stmt = (
+        select(Document.id, Document.embedding)
+        .where(Document.embedding.is_not(None))
+        .order_by(Document.id)
+        .execution_options(yield_per=batch_size)
+    )
+    async with get_session() as session:
+        await session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+        rows, dims = (await session.execute(text(
+            "SELECT count(*), max(vector_dims(embedding)) FROM documents WHERE embedding IS NOT NULL"
+        ))).one()
+        dtype = embedding_dtype(dims or settings.embedding_dimensions)
+        yield _npy_header(dtype, rows)
+        result = await session.stream(stmt)
+        async for partition in result.partitions(batch_size):
+            block = np.empty(len(partition), dtype=dtype)
+            block["id"] = [r[0].bytes for r in partition]
+            block["embedding"] = np.stack([r[1] for r in partition])
+            yield block.tobytes()
+    logger.info(f"Exported {rows} embeddings as .npy")
 
-def safe_embedding(embedding) -> list | None:
+def safe_embedding(embedding) -> np.ndarray | None:
+    """
+    Normalize an embedding to a float32 array. Rows decoded by the binary
+    codec already are one, so this is a no-op on the hot path.
+    """
     if embedding is None:
         return None
     try:
-        if hasattr(embedding, "tolist"):
-            return embedding.tolist()
-        if isinstance(embedding, (list, tuple)):
-            return list(embedding)
-        return [float(x) for x in embedding]  # fallback
+        if isinstance(embedding, np.ndarray) and embedding.dtype == np.float32:
+            return embedding
+        return np.asarray(embedding, dtype=np.float32)
     except Exception as e:
         logger.warning(f"Failed to convert embedding: {e}")
-        return None
\ No newline at end of file
+        return None
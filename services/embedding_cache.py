@@ -0,0 +1,217 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+import numpy as np
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+_whitespace = re.compile(r"\s+")
+
+def normalize_question(question: str) -> str:
+    """
+    Canonical form used for cache keys: NFKC, case-folded, whitespace collapsed.
+    """
+    return _whitespace.sub(" ", unicodedata.normalize("NFKC", question)).strip().casefold()
+
+def cache_key(model: str, question: str) -> str:
+    return hashlib.sha256(f"{model}\x00{normalize_question(question)}".encode("utf-8")).hexdigest()
+
+def _pack(vector: np.ndarray) -> bytes:
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+def _unpack(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=np.float32)
+
+
+class DiskTier:
+    """
+    SQLite-backed second tier. The file survives restarts and, in WAL mode, is
+    safely shared by every uvicorn worker on the host.
+    """
+
+    def __init__(self, path: str, ttl: float, max_entries: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS query_embeddings ("
+            " key TEXT PRIMARY KEY, vector BLOB NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS query_embeddings_created_idx ON query_embeddings (created_at)"
+        )
+
+    def get(self, key: str) -> Optional[Tuple[bytes, float]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector, created_at FROM query_embeddings WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return row[0], row[1]
+
+    def put(self, key: str, blob: bytes) -> int:
+        """
+        Store a vector; every so often prune expired/excess rows.
+        Returns the number of rows evicted by pruning.
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO query_embeddings (key, vector, created_at) VALUES (?, ?, ?)",
+                (key, blob, time.time()),
+            )
+            self._writes += 1
+            if self._writes % 500:
+                return 0
+            return self._prune()
+
+    def _prune(self) -> int:
+        evicted = self._conn.execute(
+            "DELETE FROM query_embeddings WHERE created_at < ?", (time.time() - self.ttl,)
+        ).rowcount
+        (count,) = self._conn.execute("SELECT count(*) FROM query_embeddings").fetchone()
+        if count > self.max_entries:
+            evicted += self._conn.execute(
+                "DELETE FROM query_embeddings WHERE key IN ("
+                " SELECT key FROM query_embeddings ORDER BY created_at LIMIT ?)",
+                (count - self.max_entries,),
+            ).rowcount
+        return evicted
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class EmbeddingCache:
+    """
+    Two-tier cache of query embeddings keyed by (embedding model, normalized
+    question): a bounded in-memory LRU with TTL in front of an optional
+    on-disk tier.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        max_entries: int = 10_000,
+        ttl: float = 3600.0,
+        disk: Optional[DiskTier] = None,
+    ):
+        self.model = model
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk = disk
+        self._entries: "OrderedDict[str, Tuple[np.ndarray, float]]" = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.disk_evictions = 0
+
+    def _get_memory(self, key: str) -> Optional[np.ndarray]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        vector, stored_at = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return vector
+
+    def _put_memory(self, key: str, vector: np.ndarray) -> None:
+        self._entries[key] = (vector, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get(self, question: str) -> Optional[np.ndarray]:
+        key = cache_key(self.model, question)
+        vector = self._get_memory(key)
+        if vector is not None:
+            self.hits += 1
+            return vector
+        if self.disk is not None:
+            try:
+                found = await asyncio.to_thread(self.disk.get, key)
+            except sqlite3.Error as e:
+                logger.warning(f"Embedding disk cache read failed: {e}")
+                found = None
+            if found is not None:
+                vector = _unpack(found[0])
+                self._put_memory(key, vector)
+                self.disk_hits += 1
+                return vector
+        self.misses += 1
+        return None
+
+    async def put(self, question: str, vector: np.ndarray) -> None:
+        key = cache_key(self.model, question)
+        self._put_memory(key, vector)
+        if self.disk is not None:
+            try:
+                self.disk_evictions += await asyncio.to_thread(self.disk.put, key, _pack(vector))
+            except sqlite3.Error as e:
+                logger.warning(f"Embedding disk cache write failed: {e}")
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "model": self.model,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "disk_enabled": self.disk is not None,
+            "disk_evictions": self.disk_evictions,
+        }
+
+    def close(self) -> None:
+        if self.disk is not None:
+            self.disk.close()
+
+
+def build_cache(model: str) -> Optional[EmbeddingCache]:
+    if not settings.embedding_cache_enabled:
+        return None
+    disk = None
+    if settings.embedding_cache_path:
+        disk = DiskTier(
+            settings.embedding_cache_path,
+            ttl=settings.embedding_cache_disk_ttl_seconds,
+            max_entries=settings.embedding_cache_disk_max_entries,
+        )
+    return EmbeddingCache(
+        model=model,
+        max_entries=settings.embedding_cache_size,
+        ttl=settings.embedding_cache_ttl_seconds,
+        disk=disk,
+    )
@@ -0,0 +1,233 @@
+import asyncio
+import contextvars
+import hashlib
+import logging
+from typing import List, Optional, Protocol, Tuple
+import httpx
+import numpy as np
+from openai import AsyncOpenAI
+from config import settings
+from services.container import Lazy, override
+from services.embedding_cache import EmbeddingCache, build_cache
+from services.llm import llm_gateway
+
+logger = logging.getLogger(__name__)
+
+# The OpenAI embeddings endpoint accepts at most 2048 inputs per request
+_MAX_INPUTS_PER_CALL = 2048
+
+
+class EmbeddingProvider(Protocol):
+    """
+    Anything that can embed a batch of texts in one call.
+    """
+    model: str
+
+    async def embed(self, texts: List[str]) -> List[List[float]] | np.ndarray:
+        ...
+
+
+class OpenAIEmbeddingProvider:
+    """
+    Embeds through the OpenAI embeddings endpoint (or any compatible server
+    reachable via OPENAI_BASE_URL).
+    """
+
+    def __init__(self, model: str, api_key: str, base_url: Optional[str] = None,
+                 http_client: Optional[httpx.AsyncClient] = None):
+        self.model = model
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        response = await self.client.embeddings.create(model=self.model, input=texts)
+        # The API may return items out of order; sort by their input index.
+        return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+
+
+class FakeEmbeddingProvider:
+    """
+    Deterministic local embedder for tests and benchmarks: the same text always
+    maps to the same unit vector, no network involved.
+    """
+
+    def __init__(self, dimensions: int = 1536, latency: float = 0.0, model: str = "fake-embedding"):
+        self.model = model
+        self.dimensions = dimensions
+        self.latency = latency
+        self.calls = 0
+
+    def _vector(self, text: str) -> np.ndarray:
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        v = np.random.default_rng(seed).standard_normal(self.dimensions).astype(np.float32)
+        return v / np.linalg.norm(v)
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return np.stack([self._vector(t) for t in texts])
+
+
+def build_provider() -> EmbeddingProvider:
+    if settings.embedding_provider == "fake":
+        return FakeEmbeddingProvider(dimensions=settings.embedding_dimensions)
+    return OpenAIEmbeddingProvider(
+        model=settings.embedding_model,
+        api_key=settings.openai_api_key,
+        base_url=settings.openai_base_url,
+        # Share the LLM gateway's keep-alive connection pool
+        http_client=llm_gateway.http_client,
+    )
+
+
+class EmbeddingBatcher:
+    """
+    Collects query embeddings from concurrent requests and sends them to the
+    provider as one batched call.
+
+    The first queued text opens a window of `window` seconds; everything that
+    arrives before it closes (up to `max_batch` texts) goes out in the same
+    request. Each caller awaits only its own vector, and the event loop is
+    never blocked on the HTTP call.
+    """
+
+    def __init__(self, provider: EmbeddingProvider, window: float = 0.005, max_batch: int = 64):
+        self.provider = provider
+        self.window = window
+        self.max_batch = max_batch
+        self._queue: asyncio.Queue[Tuple[str, asyncio.Future]] | None = None
+        self._worker: asyncio.Task | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._flushes: set[asyncio.Task] = set()
+
+    def _ensure_worker(self) -> asyncio.Queue:
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            # Not in the caller's context: batches serve many requests, not the first one
+            self._worker = asyncio.create_task(
+                self._run(self._queue), name="embedding-batcher", context=contextvars.Context()
+            )
+        return self._queue
+
+    async def embed(self, text: str) -> np.ndarray:
+        queue = self._ensure_worker()
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        await queue.put((text, future))
+        return await future
+
+    async def _collect(self, queue: asyncio.Queue) -> List[Tuple[str, asyncio.Future]]:
+        batch = [await queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self, queue: asyncio.Queue) -> None:
+        while True:
+            batch = await self._collect(queue)
+            pending = [(t, f) for t, f in batch if not f.done()]  # skip cancelled callers
+            if pending:
+                # Flush in the background so the next window can start filling
+                task = asyncio.create_task(self._flush(pending))
+                self._flushes.add(task)
+                task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        # Identical questions in one window are embedded once
+        unique = list(dict.fromkeys(t for t, _ in batch))
+        try:
+            vectors = await self.provider.embed(unique)
+        except Exception as e:
+            logger.error(f"Embedding batch of {len(unique)} failed: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        matrix = np.asarray(vectors, dtype=np.float32)
+        by_text = dict(zip(unique, matrix))
+        for text, future in batch:
+            if not future.done():
+                future.set_result(by_text[text])
+        logger.debug(f"Embedded batch of {len(unique)} queries ({len(batch)} callers)")
+
+    async def aclose(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+
+provider: EmbeddingProvider = Lazy("embeddings.provider", build_provider)  # type: ignore[assignment]
+batcher: EmbeddingBatcher = Lazy(  # type: ignore[assignment]
+    "embeddings.batcher",
+    lambda: EmbeddingBatcher(
+        provider,
+        window=settings.embedding_batch_window_ms / 1000,
+        max_batch=settings.embedding_max_batch,
+    ),
+)
+# Falsy when EMBEDDING_CACHE_ENABLED is off
+cache: Optional[EmbeddingCache] = Lazy("embeddings.cache", lambda: build_cache(provider.model))  # type: ignore[assignment]
+
+def set_provider(new_provider: EmbeddingProvider) -> None:
+    """
+    Swap the embedding backend (e.g. for a FakeEmbeddingProvider in tests).
+    """
+    override(provider, new_provider)
+    batcher.provider = new_provider
+    if cache:
+        cache.model = new_provider.model
+        cache.clear()
+
+async def embed_query(question: str) -> np.ndarray:
+    """
+    Embed a single question, serving repeats from the embedding cache and
+    sending misses through the shared micro-batcher. Returns a float32 array
+    ready for the binary pgvector codec.
+    """
+    if not cache:
+        return await batcher.embed(question)
+    vector = await cache.get(question)
+    if vector is None:
+        vector = await batcher.embed(question)
+        await cache.put(question, vector)
+    return vector
+
+async def embed_queries(questions: List[str]) -> np.ndarray:
+    """
+    Embed many questions at once (batch endpoint): cached ones come from the
+    embedding cache, the distinct misses go to the provider in as few calls
+    as possible. Returns one float32 row per question.
+    """
+    vectors: List[Optional[np.ndarray]] = [None] * len(questions)
+    if cache:
+        cached = await asyncio.gather(*(cache.get(q) for q in questions))
+        vectors = list(cached)
+    missing = list(dict.fromkeys(q for q, v in zip(questions, vectors) if v is None))
+    embedded = {}
+    for start in range(0, len(missing), _MAX_INPUTS_PER_CALL):
+        texts = missing[start:start + _MAX_INPUTS_PER_CALL]
+        embedded.update(zip(texts, np.asarray(await provider.embed(texts), dtype=np.float32)))
+    if cache:
+        await asyncio.gather(*(cache.put(text, vector) for text, vector in embedded.items()))
+    return np.stack([v if v is not None else embedded[q] for q, v in zip(questions, vectors)])
+
+async def embed_documents(texts: List[str]) -> np.ndarray:
+    """
+    Embed a batch of document chunks in one provider call (ingestion path;
+    bypasses the query batcher and cache).
+    """
+    return np.asarray(await provider.embed(texts), dtype=np.float32)
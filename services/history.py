@@ -1,35 +1,545 @@
-from typing import List, Dict
-from sqlalchemy import text
+import asyncio
+import contextvars
+import logging
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, List, Optional
+import numpy as np
+from sqlalchemy import exc, text
 from services.db import get_session
+from services.llm import llm_gateway
+from services.container import Lazy
+from services.metrics import observe, stage
+from services.tokens import count_tokens, truncate_tokens
+from config import settings
+
+logger = logging.getLogger(__name__)
 
 async def get_history(conversation_id: str) -> List[Dict[str, str]]:
     """
-    Fetch all prior turns for this conversation, ordered by timestamp.
+    Fetch all prior turns for this conversation, ordered by timestamp,
+    including turns still in the write-behind buffer.
     """
     sql = text("""
-        SELECT question, answer
+        SELECT question, answer, created_at
         FROM chat_history
         WHERE conversation_id = :cid
         ORDER BY created_at
     """)
-    async with get_session() as session:
-        result = await session.execute(sql, {"cid": conversation_id})
-        rows = result.fetchall()
+    # Taken before the query: a turn saved meanwhile is then in both, and _unsaved_turns drops it
+    unsaved = history_writer.pending(conversation_id)
+    with stage("history_read"):
+        async with get_session() as session:
+            result = await session.execute(sql, {"cid": conversation_id})
+            rows = result.fetchall()
     # return as list of dicts for easy templating
-    return [{"question": r.question, "answer": r.answer} for r in rows]
+    history = [{"question": r.question, "answer": r.answer} for r in rows]
+    history += [{"question": t.question, "answer": t.answer} for t in _unsaved_turns(unsaved, rows[-1] if rows else None)]
+    return history
+
+
+def _unsaved_turns(unsaved: List[Any], newest_row: Any) -> List[Any]:
+    """
+    Buffered turns newer than the newest stored one (the rest were written
+    while the table was being read).
+    """
+    if newest_row is None:
+        return unsaved
+    return [t for t in unsaved if t.created_at > newest_row.created_at]
+
+
+@dataclass
+class HistoryContext:
+    """
+    What goes into the prompt for a conversation: the rolling summary of
+    older turns plus the most recent turns that fit the token budget
+    (chronological).
+    """
+    summary: Optional[str] = None
+    turns: List[Dict[str, str]] = field(default_factory=list)
+    tokens: int = 0
+    omitted: int = 0  # recent turns left out to stay within the budget
+
+
+def _turn_text(turn: Dict[str, str]) -> str:
+    return f"User: {turn['question']}\nAssistant: {turn['answer']}\n"
+
+
+def format_history(history: HistoryContext) -> str:
+    if not history.summary and not history.turns:
+        return "(no prior context)\n"
+    block = ""
+    if history.summary:
+        block += f"Summary of earlier conversation: {history.summary}\n"
+    for turn in history.turns:
+        block += _turn_text(turn)
+    return block
+
+
+async def load_history_context(conversation_id: str) -> HistoryContext:
+    """
+    Keyset-fetch the HISTORY_MAX_TURNS most recent turns (newest first, so
+    the cost doesn't grow with the conversation) and the stored summary,
+    then keep as many recent turns as fit HISTORY_TOKEN_BUDGET after the
+    summary. Turns still in the write-behind buffer count as the newest.
+    """
+    recent_sql = text("""
+        SELECT id, question, answer, created_at
+        FROM chat_history
+        WHERE conversation_id = :cid
+        ORDER BY created_at DESC, id DESC
+        LIMIT :n
+    """)
+    summary_sql = text("""
+        SELECT summary, summarized_id
+        FROM chat_summary
+        WHERE conversation_id = :cid
+    """)
+    unsaved = history_writer.pending(conversation_id)
+    with stage("history_read"):
+        async with get_session() as session:
+            rows = (await session.execute(recent_sql, {"cid": conversation_id, "n": settings.history_max_turns})).fetchall()
+            summary_row = (await session.execute(summary_sql, {"cid": conversation_id})).first()
+    note_stored_turns(conversation_id, len(rows))
+    unsaved = _unsaved_turns(unsaved, rows[0] if rows else None)
+    rows = ([(None, t.question, t.answer) for t in reversed(unsaved)] + [tuple(r[:3]) for r in rows])[:settings.history_max_turns]
+
+    history = HistoryContext()
+    budget = settings.history_token_budget
+    if summary_row is not None:
+        history.summary = truncate_tokens(summary_row.summary, settings.history_summary_max_tokens)
+        history.tokens = count_tokens(history.summary)
+    for row_id, question, answer in rows:
+        if summary_row is not None and row_id is not None and row_id <= summary_row.summarized_id:
+            break  # already folded into the summary
+        turn = {"question": question, "answer": answer}
+        cost = count_tokens(_turn_text(turn))
+        if history.tokens + cost > budget:
+            history.omitted = len(rows) - len(history.turns)
+            break
+        history.turns.append(turn)
+        history.tokens += cost
+    history.turns.reverse()
+    return history
+
+
+# SQLSTATE classes worth retrying as is: connection exception, transaction
+# rollback (serialization failure, deadlock), insufficient resources and
+# operator intervention (shutdown, statement timeout)
+_TRANSIENT_SQLSTATES = ("08", "40", "53", "57")
+
+
+def _transient(error: BaseException) -> bool:
+    """
+    Whether a failed write may succeed unchanged later: the connection or
+    server failed, not the rows (those raise e.g. 22021 for a NUL byte).
+    """
+    if isinstance(error, (OSError, asyncio.TimeoutError, exc.TimeoutError)):
+        return True
+    if isinstance(error, exc.DBAPIError):
+        if error.connection_invalidated:
+            return True
+        sqlstate = getattr(error.orig, "sqlstate", None) or ""
+        return sqlstate[:2] in _TRANSIENT_SQLSTATES
+    return False
+
+
+@dataclass
+class _Turn:
+    conversation_id: str
+    question: str
+    answer: str
+    created_at: datetime
+
+
+class HistoryWriter:
+    """
+    Write-behind buffer for chat_history.
+
+    New turns are kept in memory and written by one background task as a
+    single multi-row INSERT once `max_batch` are waiting or `interval`
+    seconds after the first one arrived, whichever comes first; batches are
+    written one at a time, so a conversation's turns keep their order. At
+    most `max_pending` unsaved turns are held: past that, append() waits for
+    a flush instead of letting the buffer grow. Readers in this worker see
+    unsaved turns through pending(), and aclose() writes out whatever is left.
+
+    A batch that fails for a transient reason (connection lost, server
+    restarting) goes back to the head of the buffer and is retried after
+    `retry_delay`. Any other failure is taken to be about the rows: the batch
+    is split in halves until the turn the database rejects is isolated, and
+    that turn is dropped with an error log, so it cannot hold up the rest.
+    """
+
+    def __init__(self, max_batch: int = 200, interval: float = 0.05, max_pending: int = 5000, retry_delay: float = 1.0):
+        self.max_batch = max_batch
+        self.interval = interval
+        self.max_pending = max_pending
+        self.retry_delay = retry_delay
+        self._buffer: List[_Turn] = []                  # not yet handed to a flush
+        self._pending: Dict[str, List[_Turn]] = {}      # unsaved (buffered or being written), per conversation
+        self._unsaved = 0
+        self._closing = False
+        self._worker: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None      # something is buffered
+        self._full: Optional[asyncio.Event] = None      # a whole batch is buffered
+        self._space: Optional[asyncio.Event] = None     # below max_pending again
+
+        self.appended = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.failures = 0
+        self.dropped = 0
+        self.backpressure_waits = 0
+        self._flush_times: Deque[float] = deque(maxlen=200)
+
+    def _ensure_worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._loop is not loop:
+            self._loop = loop
+            self._wake, self._full, self._space = asyncio.Event(), asyncio.Event(), asyncio.Event()
+            if self._buffer:
+                self._wake.set()
+            self._closing = False
+            # Fresh context: the worker outlives the request that starts it, so it
+            # must not record into that request's Server-Timing
+            self._worker = asyncio.create_task(self._run(), name="history-writer", context=contextvars.Context())
+
+    async def append(self, conversation_id: str, question: str, answer: str) -> None:
+        """
+        Queue a turn for saving; returns at once unless the buffer is full.
+        """
+        self._ensure_worker()
+        while self._unsaved >= self.max_pending:
+            self.backpressure_waits += 1
+            self._space.clear()
+            await self._space.wait()
+        turn = _Turn(conversation_id, question, answer, datetime.now(timezone.utc))
+        self._buffer.append(turn)
+        self._pending.setdefault(conversation_id, []).append(turn)
+        self._unsaved += 1
+        self.appended += 1
+        self._wake.set()
+        if len(self._buffer) >= self.max_batch:
+            self._full.set()
+
+    def pending(self, conversation_id: str) -> List[_Turn]:
+        """
+        This conversation's turns that may not be in the table yet, oldest first.
+        """
+        return list(self._pending.get(conversation_id, ()))
+
+    async def _run(self) -> None:
+        while True:
+            await self._wake.wait()
+            if len(self._buffer) < self.max_batch and not self._closing:
+                # Let the burst accumulate into one INSERT
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            batch, self._buffer = self._buffer[:self.max_batch], self._buffer[self.max_batch:]
+            if not self._buffer:
+                self._wake.clear()
+            if batch:
+                await self._write(batch)
+            if self._closing and not self._buffer:
+                return
+
+    async def _insert(self, batch: List[_Turn]) -> None:
+        sql = text("""
+            INSERT INTO chat_history (conversation_id, question, answer, created_at)
+            SELECT * FROM unnest(
+                CAST(:cids AS uuid[]), CAST(:questions AS text[]), CAST(:answers AS text[]), CAST(:created AS timestamptz[])
+            )
+        """)
+        async with get_session() as session:
+            await session.execute(sql, {
+                "cids": [t.conversation_id for t in batch],
+                "questions": [t.question for t in batch],
+                "answers": [t.answer for t in batch],
+                "created": [t.created_at for t in batch],
+            })
+            await session.commit()
+
+    async def _write(self, batch: List[_Turn]) -> None:
+        # Parts are written in order, so a conversation's turns keep theirs
+        parts = [batch]
+        while parts:
+            part = parts.pop(0)
+            start = time.perf_counter()
+            try:
+                await self._insert(part)
+            except Exception as e:
+                self.failures += 1
+                if not _transient(e):
+                    if len(part) > 1:
+                        mid = len(part) // 2
+                        parts[:0] = [part[:mid], part[mid:]]
+                        continue
+                    turn = part[0]
+                    self.dropped += 1
+                    logger.error(
+                        f"Dropping a chat turn the database rejects (conversation {turn.conversation_id}, "
+                        f"{turn.created_at.isoformat()}): {e}"
+                    )
+                    self._saved(part, written=False)
+                    continue
+                rest = part + [t for p in parts for t in p]
+                if self._closing:
+                    logger.error(f"Saving {len(rest)} chat turns at shutdown failed, they are lost: {e}")
+                    self._saved(rest, written=False)
+                    return
+                logger.error(f"Saving {len(rest)} chat turns failed, retrying in {self.retry_delay}s: {e}")
+                self._buffer[:0] = rest
+                self._wake.set()
+                await asyncio.sleep(self.retry_delay)
+                return
+            self._flush_times.append(time.perf_counter() - start)
+            observe("history_flush", self._flush_times[-1])
+            self.flushes += 1
+            self.rows_written += len(part)
+            self._saved(part)
+            logger.debug(f"Saved {len(part)} chat turns in one insert")
+
+    def _saved(self, batch: List[_Turn], written: bool = True) -> None:
+        counts: Dict[str, int] = {}
+        for turn in batch:
+            counts[turn.conversation_id] = counts.get(turn.conversation_id, 0) + 1
+        for cid, n in counts.items():
+            # Batches go out in order, so these are the conversation's oldest unsaved turns
+            turns = self._pending[cid]
+            del turns[:n]
+            if not turns:
+                del self._pending[cid]
+            if written:
+                turns_saved(cid, n)
+        self._unsaved -= len(batch)
+        if self._unsaved < self.max_pending:
+            self._space.set()
+
+    def stats(self) -> Dict[str, Any]:
+        times = np.array(self._flush_times) * 1e3 if self._flush_times else np.zeros(1)
+        return {
+            "unsaved": self._unsaved,
+            "max_pending": self.max_pending,
+            "appended": self.appended,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "rows_per_flush": self.rows_written / self.flushes if self.flushes else 0.0,
+            "failures": self.failures,
+            "dropped": self.dropped,
+            "backpressure_waits": self.backpressure_waits,
+            "flush_ms": {"p50": float(np.percentile(times, 50)), "p95": float(np.percentile(times, 95))},
+        }
+
+    async def aclose(self) -> None:
+        """
+        Write out every buffered turn and stop the worker.
+        """
+        if self._worker is None or self._worker.done():
+            return
+        self._closing = True
+        self._wake.set()
+        self._full.set()
+        await self._worker
+        self._worker = None
+
+
+history_writer: HistoryWriter = Lazy(  # type: ignore[assignment]
+    "history_writer",
+    lambda: HistoryWriter(
+        max_batch=settings.history_flush_batch,
+        interval=settings.history_flush_interval_ms / 1000,
+        max_pending=settings.history_buffer_max,
+    ),
+)
+
 
 async def append_history(conversation_id: str, question: str, answer: str) -> None:
     """
-    Insert the latest Q&A turn into chat_history.
+    Save the latest Q&A turn. It goes through the write-behind buffer, so
+    this returns before the row is written; reads in this worker see it
+    immediately.
     """
-    sql = text("""
-        INSERT INTO chat_history (conversation_id, question, answer)
-        VALUES (:cid, :q, :a)
+    with stage("history_write"):
+        await history_writer.append(conversation_id, question, answer)
+
+
+# --- rolling summary ------------------------------------------------------
+
+_SUMMARY_PROMPT = """You maintain a running summary of a conversation between a user and an assistant.
+Update the summary with the new turns below. Keep facts, names, numbers, decisions and open
+questions the user may refer back to; drop pleasantries. Answer with the summary only,
+at most {max_tokens} tokens.
+
+Current summary:
+{summary}
+
+New turns:
+{turns}
+"""
+
+_refresh_tasks: Dict[str, asyncio.Task] = {}
+
+# Per conversation, turns this worker still has to save before a summary
+# refresh can find HISTORY_SUMMARY_BATCH turns outside the recent window
+_MAX_TRACKED = 10000
+_turns_until_refresh: "OrderedDict[str, int]" = OrderedDict()
+
+
+def _track(conversation_id: str, turns: int) -> None:
+    _turns_until_refresh[conversation_id] = turns
+    _turns_until_refresh.move_to_end(conversation_id)
+    while len(_turns_until_refresh) > _MAX_TRACKED:
+        _turns_until_refresh.popitem(last=False)
+
+
+def note_stored_turns(conversation_id: str, stored: int) -> None:
+    """
+    Called with the number of stored turns load_history_context() read (at
+    most HISTORY_MAX_TURNS), for a conversation this worker has no count for
+    yet. Below a full window, the summary has nothing to fold until
+    HISTORY_MAX_TURNS + HISTORY_SUMMARY_BATCH turns exist; with a full one
+    older turns may be waiting, so the next saved turn triggers a check.
+    """
+    if conversation_id in _turns_until_refresh:
+        return
+    if stored < settings.history_max_turns:
+        _track(conversation_id, settings.history_max_turns + settings.history_summary_batch - stored)
+    else:
+        _track(conversation_id, 1)
+
+
+def turns_saved(conversation_id: str, count: int) -> None:
+    """
+    Count `count` newly saved turns and refresh the summary once enough have
+    accumulated, instead of querying for every flush.
+    """
+    if not settings.history_summary_enabled:
+        return
+    left = _turns_until_refresh.get(conversation_id, settings.history_summary_batch) - count
+    if left > 0:
+        _track(conversation_id, left)
+        return
+    _track(conversation_id, settings.history_summary_batch)
+    schedule_summary_refresh(conversation_id)
+
+
+async def _summarize(summary: Optional[str], turns: List[Any]) -> str:
+    turn_limit = max(64, settings.history_summary_max_tokens)
+    turns_text = "".join(
+        _turn_text({"question": truncate_tokens(t.question, turn_limit), "answer": truncate_tokens(t.answer, turn_limit)})
+        for t in turns
+    )
+    prompt = _SUMMARY_PROMPT.format(
+        max_tokens=settings.history_summary_max_tokens,
+        summary=summary or "(none yet)",
+        turns=turns_text,
+    )
+    return await llm_gateway.complete(
+        [{"role": "user", "content": prompt}],
+        model=settings.history_summary_model,
+        max_tokens=settings.history_summary_max_tokens,
+    )
+
+
+async def refresh_summary(conversation_id: str) -> int:
+    """
+    Fold turns that have left the recent-turn window into the stored summary.
+    Incremental: only turns after the summary's watermark are sent, together
+    with the current summary, and nothing happens until at least
+    HISTORY_SUMMARY_BATCH of them have accumulated. Returns turns folded.
+    """
+    boundary_sql = text("""
+        SELECT id
+        FROM chat_history
+        WHERE conversation_id = :cid
+        ORDER BY created_at DESC, id DESC
+        OFFSET :window LIMIT 1
+    """)
+    summary_sql = text("""
+        SELECT summary, summarized_id, turns_summarized
+        FROM chat_summary
+        WHERE conversation_id = :cid
+    """)
+    pending_sql = text("""
+        SELECT id, question, answer
+        FROM chat_history
+        WHERE conversation_id = :cid AND id > :after AND id <= :boundary
+        ORDER BY created_at, id
+        LIMIT :limit
+    """)
+    upsert_sql = text("""
+        INSERT INTO chat_summary (conversation_id, summary, summarized_id, turns_summarized, updated_at)
+        VALUES (:cid, :summary, :summarized_id, :turns, now())
+        ON CONFLICT (conversation_id) DO UPDATE
+        SET summary = EXCLUDED.summary,
+            summarized_id = EXCLUDED.summarized_id,
+            turns_summarized = EXCLUDED.turns_summarized,
+            updated_at = now()
+        WHERE chat_summary.summarized_id = :previous_id
     """)
     async with get_session() as session:
-        await session.execute(sql, {
+        # Newest turn that is outside the window of recent turns
+        boundary = (await session.execute(
+            boundary_sql, {"cid": conversation_id, "window": settings.history_max_turns - 1}
+        )).scalar()
+        if boundary is None:
+            return 0
+        current = (await session.execute(summary_sql, {"cid": conversation_id})).first()
+        after = current.summarized_id if current else 0
+        pending = (await session.execute(pending_sql, {
             "cid": conversation_id,
-            "q": question,
-            "a": answer
+            "after": after,
+            "boundary": boundary,
+            "limit": settings.history_summary_max_fold,
+        })).fetchall()
+    if len(pending) < settings.history_summary_batch:
+        return 0
+
+    summary = await _summarize(current.summary if current else None, pending)
+    async with get_session() as session:
+        result = await session.execute(upsert_sql, {
+            "cid": conversation_id,
+            "summary": summary,
+            "summarized_id": pending[-1].id,
+            "turns": (current.turns_summarized if current else 0) + len(pending),
+            "previous_id": after,
         })
         await session.commit()
+    if result.rowcount == 0:
+        # Another worker folded the same turns first
+        return 0
+    logger.info(f"Folded {len(pending)} turns into the summary of conversation {conversation_id}.")
+    return len(pending)
+
+
+def schedule_summary_refresh(conversation_id: str) -> None:
+    """
+    Refresh the summary in the background (at most one refresh per
+    conversation at a time in this worker), off the request's critical path.
+    """
+    if not settings.history_summary_enabled or conversation_id in _refresh_tasks:
+        return
+
+    async def run() -> None:
+        try:
+            await refresh_summary(conversation_id)
+        except Exception as e:
+            logger.error(f"Summary refresh failed for conversation {conversation_id}: {e}")
+        finally:
+            _refresh_tasks.pop(conversation_id, None)
+
+    _refresh_tasks[conversation_id] = asyncio.create_task(run(), context=contextvars.Context())
+
+
+async def stop_summary_refreshes() -> None:
+    tasks = list(_refresh_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,45 +1,450 @@
+import hashlib
+import importlib
+import multiprocessing
 import os
-from langchain_community.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from services.vector_store import vector_store
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, AsyncIterator, Awaitable, Dict, Iterable, List, Tuple
+from uuid import uuid4
+import numpy as np
+from sqlalchemy import text
 from services.models import PdfIngestion
 from services.db import get_session
-from concurrent.futures import ThreadPoolExecutor
+from services.chunk_writer import ChunkWriter
+from services import embeddings
+from services.answer_cache import answer_cache, answer_cache_sync
+from services.metrics import stage
+from services.ann_index import ann_index
+from services.container import resolve
+from services.quantized import compact_vectors
+from services.collections import collections, validate_collection
+from config import settings
 import asyncio
 import logging
 
+if TYPE_CHECKING:
+    # Annotations only: LangChain and pypdf are imported by the ingestion path, not on app startup
+    from langchain_core.documents import Document as LCDocument
+
 logger = logging.getLogger(__name__)
 PDF_DIR = os.getenv("PDF_DIR", "pdfs/")
-executor = ThreadPoolExecutor(max_workers=2)
 
-async def ingest_pdf(file_path: str) -> int:
-    logger.info("Starting PDF ingestion.")
+_DONE = None  # queue sentinel
+
+
+@dataclass
+class ChunkBatch:
+    chunks: List["LCDocument"]
+    vectors: np.ndarray | None = None
+
+
+_parse_pool: ProcessPoolExecutor | None = None
+
+def parse_pool() -> ProcessPoolExecutor | None:
+    """
+    Process pool for PDF text extraction (None when INGEST_PARSE_PROCESSES=0).
+    Parsing is pure-Python CPU work; in a separate process it doesn't compete
+    with request handling for the GIL.
+    """
+    global _parse_pool
+    if settings.ingest_parse_processes <= 0:
+        return None
+    if _parse_pool is None:
+        _parse_pool = ProcessPoolExecutor(
+            max_workers=settings.ingest_parse_processes,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _parse_pool
+
+def shutdown_parse_pool() -> None:
+    global _parse_pool
+    if _parse_pool is not None:
+        _parse_pool.shutdown(wait=False, cancel_futures=True)
+        _parse_pool = None
+
+
+async def iter_pages(file_path: str, source: str | None = None) -> AsyncIterator["LCDocument"]:
+    """
+    Yield one Document per PDF page. Text is extracted off the event loop in
+    ranges of INGEST_PARSE_PAGES_PER_TASK pages (in the process pool, or a
+    thread if disabled), with one range parsed ahead of the consumer, so the
+    extracted text of only a couple of ranges is held at a time. Each parser
+    keeps the PDF open (services/pdf_pages.py) and reads objects from the
+    file as pages need them, so the file is parsed once per parser rather
+    than once per range, and not loaded into memory as a whole.
+    """
+    from langchain_core.documents import Document as LCDocument
+    from services import pdf_pages
+
+    loop = asyncio.get_running_loop()
+    pool = parse_pool()
+    total = await loop.run_in_executor(pool, pdf_pages.count_pages, file_path)
+    step = max(1, settings.ingest_parse_pages_per_task)
+    ranges = iter([(start, min(start + step, total)) for start in range(0, total, step)])
+    pending: deque = deque()
+
+    def submit_next() -> None:
+        page_range = next(ranges, None)
+        if page_range is not None:
+            pending.append(loop.run_in_executor(pool, pdf_pages.extract_pages, file_path, *page_range))
+
+    submit_next()
+    submit_next()
+    while pending:
+        with stage("ingest_parse"):
+            parsed = await pending.popleft()
+        submit_next()
+        for page_number, text in parsed:
+            yield LCDocument(
+                page_content=text,
+                metadata={"source": source or file_path, "page": page_number, "total_pages": total},
+            )
+
+
+async def _run_stages(*stages: Awaitable[None]) -> None:
+    """
+    Run pipeline stages concurrently; if one fails, cancel the rest so no
+    stage stays blocked on a full queue.
+    """
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def chunk_hash(text: str) -> str:
+    """
+    Content hash stored in documents.content_hash (sha256 hex of the UTF-8 text,
+    same as Postgres' encode(sha256(convert_to(content, 'UTF8')), 'hex')).
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def file_sha256(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+async def lookup_embeddings(hashes: List[str], model: str) -> Dict[str, np.ndarray]:
+    """
+    Embeddings already stored for any of `hashes` with embedding model `model`,
+    keyed by content hash (the documents table doubles as the store). Text
+    embedded by another model is never reused.
+    """
+    if not hashes:
+        return {}
+    sql = text("""
+        SELECT DISTINCT ON (content_hash) content_hash, embedding
+        FROM documents
+        WHERE content_hash = ANY(:hashes)
+          AND metadata->>'embedding_model' = :model
+          AND embedding IS NOT NULL
+    """)
+    async with get_session() as session:
+        result = await session.execute(sql, {"hashes": hashes, "model": model})
+        return {r.content_hash: r.embedding for r in result.fetchall()}
+
+
+def plan_embeddings(hashes: List[str], known: Dict[str, np.ndarray]) -> Tuple[List[str], int]:
+    """
+    Split a batch of chunk hashes against the embeddings already stored:
+    returns the distinct hashes still to embed (first-seen order) and how many
+    chunks of the batch reuse a stored embedding.
+    """
+    missing = list(dict.fromkeys(h for h in hashes if h not in known))
+    return missing, sum(1 for h in hashes if h in known)
+
+
+class VersionDiff:
+    """
+    The rows stored for the previous version of a file, matched against the
+    chunks of the new one. A chunk with the same content hash on the same page
+    keeps its row (unchanged); rows left unmatched belong to content that no
+    longer exists.
+    """
+
+    def __init__(self, rows: Iterable[Tuple[Any, str, int | None]] = ()):
+        # (content_hash, page) -> ids of rows stored for the previous version
+        self._rows: Dict[Tuple[str, int | None], List[Any]] = defaultdict(list)
+        for row_id, digest, page in rows:
+            self._rows[(digest, page)].append(row_id)
+        self.kept: List[Any] = []
+
+    def __len__(self) -> int:
+        return sum(len(ids) for ids in self._rows.values())
+
+    def unchanged(self, previous_metadata: Dict[str, Any] | None, file_hash: str) -> bool:
+        """
+        True when the file is byte-identical to its last ingestion and that
+        ingestion's rows are still stored, so there is nothing to do.
+        """
+        return previous_metadata is not None and len(self) > 0 and previous_metadata.get("file_hash") == file_hash
+
+    def keep(self, digest: str, page: int | None) -> bool:
+        """
+        Claim a stored row for a chunk of the new version; False if the chunk
+        is new or changed and must be embedded.
+        """
+        ids = self._rows.get((digest, page))
+        if not ids:
+            return False
+        self.kept.append(ids.pop())
+        return True
+
+    def vanished(self) -> List[Any]:
+        """
+        Ids of the rows no chunk of the new version claimed.
+        """
+        return [row_id for ids in self._rows.values() for row_id in ids]
+
+
+@dataclass
+class IngestProgress:
+    """
+    Live counters of a running ingestion (read by the job runner).
+    """
+    total_pages: int = 0
+    pages_parsed: int = 0
+    chunks_embedded: int = 0
+    rows_written: int = 0
+    stage: str = "queued"
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "stage": self.stage,
+            "total_pages": self.total_pages,
+            "pages_parsed": self.pages_parsed,
+            "chunks_embedded": self.chunks_embedded,
+            "rows_written": self.rows_written,
+        }
+
+
+@dataclass
+class IngestResult:
+    pages: int = 0
+    inserted: int = 0      # rows written (includes reused)
+    reused: int = 0        # inserted rows whose embedding came from the hash store
+    unchanged: int = 0     # rows of a previous version kept as-is
+    deleted: int = 0       # rows of a previous version that vanished
+    skipped: bool = False  # identical file already ingested
+    ingestion_id: str | None = None
+
+    @property
+    def chunks(self) -> int:
+        return self.inserted + self.unchanged
+
+
+async def ingest_pdf(
+    file_path: str,
+    file_hash: str | None = None,
+    progress: IngestProgress | None = None,
+    collection: str | None = None,
+    source: str | None = None,
+) -> IngestResult:
     """
-    1) Chunk the PDF & push embeddings to Supabase.
-    2) Insert a new row into the Supabase Postgres 'Document' table via SQLModel.
+    Stream a PDF through a staged pipeline with bounded queues:
+
+        pages -> splitter -> batched embedding (N concurrent) -> batched insert
+
+    At most INGEST_QUEUE_SIZE batches wait between stages, so peak memory is
+    governed by the batch sizes rather than the size of the document. Chunk
+    rows are bulk-written with ChunkWriter and committed in one transaction
+    together with the 'pdf_ingestion' record.
+
+    Re-ingesting a file is incremental: chunks are identified by content hash
+    and page, so only new or changed chunks are embedded and inserted, and
+    chunks of the previous version that no longer appear are deleted.
+    Embeddings of text already stored anywhere are reused instead of
+    recomputed. Pass `progress` to observe per-stage counters while it runs.
+
+    Chunks go to `collection` (DEFAULT_COLLECTION if None), whose partition
+    is created on first use; a file is versioned per collection. Every
+    current chunk of the file ends up tagged with the new ingestion's id.
+
+    `source` names the document (metadata.source, and the filename it is
+    versioned by) when `file_path` is a private copy, e.g. an upload
+    stored for one job; it defaults to `file_path`.
     """
-    loader = PyPDFLoader(file_path)
-    docs = loader.load()
-    logger.info(f"Loaded {len(docs)} documents from PDF.")
+    source = source or file_path
+    collection = validate_collection(collection or settings.default_collection)
+    await collections.create(collection)
+
+    # The first ingestion in a worker imports LangChain; do that off the event loop
+    await asyncio.to_thread(importlib.import_module, "langchain.text_splitter")
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    logger.info("Starting PDF ingestion.")
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=settings.ingest_chunk_size,
+        chunk_overlap=settings.ingest_chunk_overlap,
+    )
+    embed_queue: asyncio.Queue = asyncio.Queue(maxsize=settings.ingest_queue_size)
+    write_queue: asyncio.Queue = asyncio.Queue(maxsize=settings.ingest_queue_size)
+    concurrency = max(1, settings.ingest_embed_concurrency)
+    invalidation = answer_cache.invalidation_scan() if answer_cache else None
+    model = embeddings.provider.model
+    result = IngestResult()
+    progress = progress or IngestProgress()
+    # Rows to mirror into the local ANN index after commit
+    index_ids: List[Any] = []
+    index_vectors: List[np.ndarray] = []
 
-    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    chunks = splitter.split_documents(docs)
-    logger.info(f"Split into {len(chunks)} chunks.")
+    async def read_and_split() -> None:
+        batch: List["LCDocument"] = []
+        async for page in iter_pages(file_path, source):
+            result.pages += 1
+            progress.total_pages = page.metadata["total_pages"]
+            progress.pages_parsed = result.pages
+            with stage("ingest_split"):
+                chunks = splitter.split_documents([page])
+            for chunk in chunks:
+                digest = chunk_hash(chunk.page_content)
+                if diff.keep(digest, chunk.metadata.get("page")):
+                    result.unchanged += 1
+                    continue
+                chunk.metadata["content_hash"] = digest
+                chunk.metadata["embedding_model"] = model
+                batch.append(chunk)
+                if len(batch) >= settings.ingest_embed_batch_size:
+                    await embed_queue.put(ChunkBatch(batch))
+                    batch = []
+        if batch:
+            await embed_queue.put(ChunkBatch(batch))
+        for _ in range(concurrency):
+            await embed_queue.put(_DONE)
 
-    # 1) Add embeddings to Supabase vector store
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(executor, vector_store.add_documents, chunks)
-    logger.info("Successfully added embeddings to Supabase vector store.")
+    async def embed() -> None:
+        while (batch := await embed_queue.get()) is not _DONE:
+            hashes = [c.metadata["content_hash"] for c in batch.chunks]
+            with stage("ingest_embed"):
+                known = await lookup_embeddings(list(set(hashes)), model)
+                missing, reused = plan_embeddings(hashes, known)
+                if missing:
+                    texts = {c.metadata["content_hash"]: c.page_content for c in batch.chunks}
+                    fresh = await embeddings.embed_documents([texts[h] for h in missing])
+                    known.update(zip(missing, fresh))
+            result.reused += reused
+            batch.vectors = np.stack([known[h] for h in hashes])
+            progress.chunks_embedded += len(hashes)
+            await write_queue.put(batch)
+        await write_queue.put(_DONE)
 
-    # 2) Record ingestion metadata in Postgres
-    filename = os.path.basename(file_path)
-    metadata = {"chunks": len(chunks), "path": file_path}
+    async def write(writer: ChunkWriter, chunks: List["LCDocument"], vectors: List[np.ndarray]) -> None:
+        with stage("ingest_write"):
+            ids = await writer.write(
+                [c.page_content for c in chunks],
+                [{k: v for k, v in c.metadata.items() if k != "content_hash"} for c in chunks],
+                vectors,
+                [c.metadata["content_hash"] for c in chunks],
+            )
+        if invalidation is not None:
+            invalidation.observe(vectors)
+        if ann_index:
+            index_ids.extend(ids)
+            index_vectors.extend(vectors)
+        result.inserted += len(chunks)
+        progress.rows_written = result.inserted
 
-    # Use the async session to create a Document row
+    async def insert(writer: ChunkWriter) -> None:
+        finished = 0
+        chunks: List["LCDocument"] = []
+        vectors: List[np.ndarray] = []
+        while finished < concurrency:
+            batch = await write_queue.get()
+            if batch is _DONE:
+                finished += 1
+                continue
+            chunks.extend(batch.chunks)
+            vectors.extend(batch.vectors)
+            if len(chunks) >= settings.ingest_insert_batch_size:
+                await write(writer, chunks, vectors)
+                chunks, vectors = [], []
+        if chunks:
+            await write(writer, chunks, vectors)
+
+    filename = os.path.basename(source)
+    if file_hash is None:
+        file_hash = await asyncio.to_thread(file_sha256, file_path)
+
+    ingestion_id = uuid4()
     async with get_session() as session:
-        doc = PdfIngestion(filename=filename, meta=metadata)
-        session.add(doc)
-        await session.commit()
-        logger.info("Inserted ingestion record into database.")
+        writer = ChunkWriter(
+            session,
+            method=settings.ingest_write_method,
+            compact=resolve(compact_vectors),
+            collection=collection,
+            ingestion_id=ingestion_id,
+        )
+        await writer.open(lock_key=f"ingest:{collection}:{filename}")
+
+        previous = await writer.fetch(
+            "SELECT id, metadata FROM pdf_ingestion WHERE filename = $1 AND collection = $2 "
+            "ORDER BY ingested_at DESC LIMIT 1",
+            filename, collection,
+        )
+        rows = await writer.fetch(
+            "SELECT id, content_hash, (metadata->>'page')::int AS page FROM documents "
+            "WHERE collection = $1 AND metadata->>'source' = $2",
+            collection, source,
+        )
+        diff = VersionDiff((row["id"], row["content_hash"], row["page"]) for row in rows)
+
+        progress.stage = "ingesting"
+        if diff.unchanged((previous[0]["metadata"] or {}) if previous else None, file_hash):
+            logger.info(f"{filename} is unchanged since the last ingestion; skipping.")
+            return IngestResult(unchanged=len(diff), skipped=True)
+
+        await _run_stages(read_and_split(), *(embed() for _ in range(concurrency)), insert(writer))
+        progress.stage = "committing"
+
+        # Whatever wasn't matched belongs to content that no longer exists
+        deleted_ids = diff.vanished()
+        result.deleted = await writer.delete(deleted_ids)
+        await writer.retag(diff.kept)
+        logger.info(
+            f"Ingested {result.pages} pages: {result.inserted} inserted ({result.reused} reused embeddings), "
+            f"{result.unchanged} unchanged, {result.deleted} deleted."
+        )
+
+        # Record ingestion metadata in the same transaction as the chunks
+        metadata = {
+            "chunks": result.chunks,
+            "pages": result.pages,
+            "path": source,
+            "file_hash": file_hash,
+            "inserted": result.inserted,
+            "reused": result.reused,
+            "unchanged": result.unchanged,
+            "deleted": result.deleted,
+        }
+        if previous:
+            metadata["previous_ingestion_id"] = str(previous[0]["id"])
+        record = PdfIngestion(id=ingestion_id, filename=filename, collection=collection, meta=metadata)
+        session.add(record)
+        with stage("ingest_commit"):
+            await session.commit()
+        result.ingestion_id = str(record.id)
+        if answer_cache_sync:
+            # Invalidated precisely below; the other workers' polls pick it up
+            answer_cache_sync.seen(result.ingestion_id)
+        progress.stage = "done"
+        logger.info("Committed chunks and ingestion record.")
+
+    if ann_index and (index_ids or deleted_ids):
+        await ann_index.apply(index_ids, np.stack(index_vectors) if index_vectors else np.empty((0, 0)), deleted_ids)
+
+    if invalidation is not None:
+        if result.deleted:
+            # Removed chunks may have been cited by any cached answer
+            invalidation.observe_all()
+        invalidation.apply()
 
-    return len(chunks)
\ No newline at end of file
+    return result
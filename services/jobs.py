@@ -0,0 +1,352 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+from sqlalchemy import text
+from services.db import get_session, orjson_serializer
+from services.ingest import IngestProgress, ingest_pdf, shutdown_parse_pool
+from services.models import IngestionJob
+from config import settings
+from services.container import Lazy
+
+logger = logging.getLogger(__name__)
+
+_JOB_COLUMNS = """
+    id, filename, path, source, collection, file_hash, status, cancel_requested, progress, result,
+    error, ingestion_id, created_at, updated_at, started_at, finished_at
+"""
+
+
+def _row_to_dict(row: Any) -> Dict[str, Any]:
+    job = dict(row._mapping)
+    job["id"] = str(job["id"])
+    if job["ingestion_id"] is not None:
+        job["ingestion_id"] = str(job["ingestion_id"])
+    for key in ("created_at", "updated_at", "started_at", "finished_at"):
+        if job[key] is not None:
+            job[key] = job[key].isoformat()
+    return job
+
+
+class IngestionJobManager:
+    """
+    Runs PDF ingestion in the background.
+
+    Jobs are rows in `ingestion_job`. A bounded pool of worker tasks claims
+    queued rows atomically (FOR UPDATE SKIP LOCKED), so several uvicorn
+    workers can share one queue and a restart simply picks up where it left
+    off: jobs whose runner stopped heart-beating are put back in the queue.
+    While a job runs its progress counters are flushed every
+    INGEST_PROGRESS_INTERVAL seconds, which doubles as the heartbeat and as
+    the point where cancellation requested from another worker is noticed.
+    """
+
+    def __init__(self, workers: int, poll_interval: float, progress_interval: float, stale_after: float):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.progress_interval = progress_interval
+        self.stale_after = stale_after
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self._running: Dict[str, asyncio.Task] = {}
+        self._cancelled: set[str] = set()
+        self._last_recovery = 0.0
+
+    # --- lifecycle -------------------------------------------------------
+
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        await self._recover()
+        self._tasks = [
+            asyncio.create_task(self._worker(n), name=f"ingestion-worker-{n}") for n in range(self.workers)
+        ]
+        logger.info(f"Started {self.workers} ingestion workers.")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        shutdown_parse_pool()
+
+    async def _recover(self) -> None:
+        self._last_recovery = time.monotonic()
+        try:
+            await self.requeue_stale()
+        except Exception as e:
+            logger.error(f"Failed to re-queue stale ingestion jobs: {e}")
+
+    async def requeue_stale(self) -> int:
+        """
+        Put running jobs whose worker stopped heart-beating back in the queue.
+        Their chunks were never committed, so they restart from scratch.
+        """
+        sql = text("""
+            UPDATE ingestion_job
+            SET status = 'queued', updated_at = now()
+            WHERE status = 'running' AND updated_at < now() - make_interval(secs => :stale)
+        """)
+        async with get_session() as session:
+            result = await session.execute(sql, {"stale": self.stale_after})
+            await session.commit()
+        if result.rowcount:
+            logger.warning(f"Re-queued {result.rowcount} interrupted ingestion jobs.")
+        return result.rowcount
+
+    # --- API -------------------------------------------------------------
+
+    async def submit(
+        self,
+        filename: str,
+        path: str,
+        file_hash: Optional[str] = None,
+        collection: Optional[str] = None,
+        source: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Queue the ingestion of `path`, which must stay unchanged until the
+        job finishes (uploads are stored under a name of their own). `source`
+        is the document's name; once the job succeeds the file is moved
+        there, and it is removed if the job fails or is cancelled.
+        """
+        async with get_session() as session:
+            job = IngestionJob(
+                filename=filename,
+                path=path,
+                source=source,
+                collection=collection or settings.default_collection,
+                file_hash=file_hash,
+            )
+            session.add(job)
+            await session.commit()
+            job_id = str(job.id)
+        self._wakeup.set()
+        return await self.get(job_id)
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        sql = text(f"SELECT {_JOB_COLUMNS} FROM ingestion_job WHERE id = :id")
+        async with get_session() as session:
+            row = (await session.execute(sql, {"id": UUID(job_id)})).first()
+        return _row_to_dict(row) if row else None
+
+    async def list(self, limit: int = 20) -> List[Dict[str, Any]]:
+        sql = text(f"SELECT {_JOB_COLUMNS} FROM ingestion_job ORDER BY created_at DESC LIMIT :limit")
+        async with get_session() as session:
+            rows = (await session.execute(sql, {"limit": limit})).fetchall()
+        return [_row_to_dict(r) for r in rows]
+
+    async def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Cancel a job: queued jobs are cancelled immediately; running ones are
+        flagged and stopped by whichever worker runs them (rolling back any
+        chunks written so far).
+        """
+        sql = text("""
+            UPDATE ingestion_job
+            SET cancel_requested = true,
+                status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END,
+                finished_at = CASE WHEN status = 'queued' THEN now() ELSE finished_at END,
+                updated_at = now()
+            WHERE id = :id AND status IN ('queued', 'running')
+            RETURNING id, path, source, status
+        """)
+        async with get_session() as session:
+            row = (await session.execute(sql, {"id": UUID(job_id)})).first()
+            await session.commit()
+        if row is not None and row.status == "cancelled":
+            # Was still queued: no worker will see it again
+            await self._release_file(dict(row._mapping), succeeded=False)
+        task = self._running.get(job_id)
+        if task is not None:
+            self._cancelled.add(job_id)
+            task.cancel()
+        return await self.get(job_id)
+
+    # --- workers ---------------------------------------------------------
+
+    async def _claim(self) -> Optional[Dict[str, Any]]:
+        sql = text(f"""
+            UPDATE ingestion_job
+            SET status = 'running', started_at = now(), updated_at = now(), progress = '{{}}'
+            WHERE id = (
+                SELECT id FROM ingestion_job
+                WHERE status = 'queued'
+                ORDER BY created_at
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING {_JOB_COLUMNS}
+        """)
+        async with get_session() as session:
+            row = (await session.execute(sql)).first()
+            await session.commit()
+        return _row_to_dict(row) if row else None
+
+    async def _worker(self, n: int) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                job = await self._claim()
+            except Exception as e:
+                logger.error(f"Ingestion worker {n}: failed to claim a job: {e}")
+                job = None
+            if job is None:
+                # Idle: also pick up jobs orphaned by a crashed worker elsewhere
+                if time.monotonic() - self._last_recovery > self.stale_after:
+                    await self._recover()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._run(job)
+            except Exception as e:
+                logger.error(f"Ingestion worker {n}: job {job['id']} bookkeeping failed: {e}")
+
+    async def _finish(self, job_id: str, status: str, *, result: Dict[str, Any] | None = None,
+                      error: str | None = None, ingestion_id: str | None = None,
+                      progress: Dict[str, Any] | None = None) -> None:
+        sql = text("""
+            UPDATE ingestion_job
+            SET status = :status, result = :result, error = :error, ingestion_id = :ingestion_id,
+                progress = :progress, finished_at = now(), updated_at = now()
+            WHERE id = :id
+        """)
+        async with get_session() as session:
+            await session.execute(sql, {
+                "id": UUID(job_id),
+                "status": status,
+                "result": _json(result or {}),
+                "error": error,
+                "ingestion_id": UUID(ingestion_id) if ingestion_id else None,
+                "progress": _json(progress or {}),
+            })
+            await session.commit()
+
+    async def _heartbeat(self, job_id: str, progress: IngestProgress, task: asyncio.Task) -> None:
+        sql = text("""
+            UPDATE ingestion_job SET progress = :progress, updated_at = now()
+            WHERE id = :id
+            RETURNING cancel_requested
+        """)
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            try:
+                async with get_session() as session:
+                    cancel = (await session.execute(sql, {"id": UUID(job_id), "progress": _json(progress.as_dict())})).scalar()
+                    await session.commit()
+            except Exception as e:
+                logger.warning(f"Ingestion job {job_id}: progress update failed: {e}")
+                continue
+            if cancel:
+                self._cancelled.add(job_id)
+                task.cancel()
+                return
+
+    async def _run(self, job: Dict[str, Any]) -> None:
+        job_id = job["id"]
+        if job["cancel_requested"]:
+            await self._finish(job_id, "cancelled")
+            await self._release_file(job, succeeded=False)
+            return
+        progress = IngestProgress()
+        ingest = asyncio.create_task(ingest_pdf(
+            job["path"],
+            file_hash=job["file_hash"],
+            progress=progress,
+            collection=job["collection"],
+            source=job["source"],
+        ))
+        self._running[job_id] = ingest
+        heartbeat = asyncio.create_task(self._heartbeat(job_id, progress, ingest))
+        logger.info(f"Ingestion job {job_id} ({job['filename']}) started.")
+        try:
+            result = await asyncio.shield(ingest)
+        except asyncio.CancelledError:
+            if job_id in self._cancelled:
+                await self._finish(job_id, "cancelled", progress=progress.as_dict())
+                await self._release_file(job, succeeded=False)
+                logger.info(f"Ingestion job {job_id} cancelled.")
+                return
+            # Worker shutting down: stop the ingestion and leave the job for
+            # another worker (or the next start) to pick up.
+            ingest.cancel()
+            await asyncio.gather(ingest, return_exceptions=True)
+            await self._requeue(job_id)
+            raise
+        except Exception as e:
+            logger.error(f"Ingestion job {job_id} failed: {e}")
+            await self._finish(job_id, "failed", error=str(e), progress=progress.as_dict())
+            await self._release_file(job, succeeded=False)
+            return
+        finally:
+            heartbeat.cancel()
+            self._running.pop(job_id, None)
+            self._cancelled.discard(job_id)
+        await self._finish(
+            job_id,
+            "succeeded",
+            result={
+                "skipped": result.skipped,
+                "pages": result.pages,
+                "inserted_count": result.inserted,
+                "reused_count": result.reused,
+                "unchanged_count": result.unchanged,
+                "deleted_count": result.deleted,
+            },
+            ingestion_id=result.ingestion_id,
+            progress=progress.as_dict(),
+        )
+        await self._release_file(job, succeeded=True)
+        logger.info(f"Ingestion job {job_id} finished: {result.inserted} chunks inserted.")
+
+    async def _release_file(self, job: Dict[str, Any], succeeded: bool) -> None:
+        """
+        A finished job's private copy of its upload: moved to the document's
+        source path when it succeeded (the latest ingested version, as before
+        uploads got their own names), removed otherwise.
+        """
+        path, source = job["path"], job["source"]
+        if not source or source == path:
+            return
+
+        def release() -> None:
+            if succeeded:
+                os.replace(path, source)
+            else:
+                os.unlink(path)
+
+        try:
+            await asyncio.to_thread(release)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Ingestion job {job['id']}: could not release {path}: {e}")
+
+    async def _requeue(self, job_id: str) -> None:
+        sql = text("UPDATE ingestion_job SET status = 'queued', updated_at = now() WHERE id = :id AND status = 'running'")
+        try:
+            async with get_session() as session:
+                await session.execute(sql, {"id": UUID(job_id)})
+                await session.commit()
+        except Exception as e:
+            logger.warning(f"Could not re-queue ingestion job {job_id}: {e}")
+
+
+def _json(value: Dict[str, Any]) -> str:
+    return orjson_serializer(value)
+
+
+job_manager: IngestionJobManager = Lazy(  # type: ignore[assignment]
+    "job_manager",
+    lambda: IngestionJobManager(
+        workers=settings.ingest_workers,
+        poll_interval=settings.ingest_job_poll_interval,
+        progress_interval=settings.ingest_progress_interval,
+        stale_after=settings.ingest_job_stale_after,
+    ),
+)
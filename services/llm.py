@@ -0,0 +1,301 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional
+import httpx
+import numpy as np
+import openai
+from openai import AsyncOpenAI
+from services.container import Lazy
+from services.metrics import record, stage
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+Messages = List[Dict[str, str]]
+
+# Samples needed before the p95 of completion latency is trusted for hedging
+_HEDGE_MIN_SAMPLES = 20
+
+
+def _retryable(error: BaseException) -> bool:
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError, openai.RateLimitError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def _retry_after(error: BaseException) -> Optional[float]:
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class LLMGateway:
+    """
+    The one way this app talks to the chat completions API.
+
+    - A single AsyncOpenAI client on a pooled httpx client, so requests reuse
+      keep-alive connections instead of opening a TLS connection each.
+    - A semaphore caps requests in flight per worker; time spent waiting for
+      it is recorded so saturation shows up in /v1/stats/llm.
+    - 429, 5xx, timeouts and connection errors are retried with full-jitter
+      exponential backoff (honouring Retry-After).
+    - A non-streaming call can be given a time budget covering its attempts
+      and backoff sleeps (not the wait for a slot): each attempt's timeout is
+      cut to what is left, and no retry starts once it is spent.
+    - Optionally, a non-streaming completion still running after the p95 of
+      recent latencies is hedged with a second identical request; whichever
+      answers first wins and the other is cancelled.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: Optional[str] = None,
+        max_concurrency: int = 32,
+        max_connections: int = 64,
+        timeout: float = 60.0,
+        max_retries: int = 3,
+        retry_base_delay: float = 0.5,
+        retry_max_delay: float = 8.0,
+        hedge: bool = False,
+        hedge_min_delay: float = 1.0,
+    ):
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(timeout, connect=10.0),
+        )
+        # Retries are ours (with metrics and jitter), not the SDK's
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=self.http_client, max_retries=0)
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+
+        self._queue_waits: Deque[float] = deque(maxlen=1000)
+        self._latencies: Deque[float] = deque(maxlen=200)
+        self.waiting = 0
+        self.in_flight = 0
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.hedges = 0
+        self.hedges_won = 0
+
+    # --- concurrency -----------------------------------------------------
+
+    async def _acquire(self) -> None:
+        self.waiting += 1
+        start = time.perf_counter()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self._queue_waits.append(time.perf_counter() - start)
+        self.in_flight += 1
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    async def _backoff(self, attempt: int, error: BaseException, remaining: Optional[float] = None) -> float:
+        """
+        Sleep before retry `attempt + 1` and return the delay; re-raises
+        `error` instead if the delay would use up the `remaining` budget.
+        """
+        delay = _retry_after(error)
+        if delay is None:
+            delay = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt))
+        if remaining is not None and delay >= remaining:
+            raise error
+        self.retries += 1
+        logger.warning(f"LLM request failed ({error.__class__.__name__}), retry {attempt + 1} in {delay:.2f}s")
+        await asyncio.sleep(delay)
+        return delay
+
+    # --- completions -----------------------------------------------------
+
+    async def _complete_once(self, params: Dict[str, Any], budget: Optional[float] = None) -> Any:
+        """
+        One completion with retries; the semaphore is held per attempt, not
+        across backoff sleeps. With a `budget`, attempts and sleeps together
+        stop once it is spent (time waiting for the semaphore is not counted).
+        """
+        attempt = 0
+        spent = 0.0
+        while True:
+            await self._acquire()
+            start = time.perf_counter()
+            try:
+                if budget is not None:
+                    left = max(budget - spent, 0.0)
+                    params = {**params, "timeout": httpx.Timeout(min(self.timeout, left), connect=min(10.0, left))}
+                response = await self.client.chat.completions.create(**params)
+                # Upstream latency only (no queueing), the basis of the hedge delay
+                self._latencies.append(time.perf_counter() - start)
+                return response
+            except Exception as e:
+                if not _retryable(e) or attempt >= self.max_retries:
+                    raise
+                error = e
+            finally:
+                spent += time.perf_counter() - start
+                self._release()
+            spent += await self._backoff(attempt, error, None if budget is None else budget - spent)
+            attempt += 1
+
+    def hedge_delay(self) -> Optional[float]:
+        if not self.hedge or len(self._latencies) < _HEDGE_MIN_SAMPLES:
+            return None
+        return max(self.hedge_min_delay, float(np.percentile(self._latencies, 95)))
+
+    async def complete(
+        self, messages: Messages, model: Optional[str] = None, budget: Optional[float] = None, **kwargs: Any
+    ) -> str:
+        """
+        Non-streaming chat completion; returns the message content. `budget`
+        caps the seconds spent on attempts and retries (see _complete_once);
+        when it runs out the last error (e.g. openai.APITimeoutError) is raised.
+        """
+        params = {"model": model or settings.openai_model, "messages": messages, **kwargs}
+        self.requests += 1
+        try:
+            with stage("llm_total"):
+                delay = self.hedge_delay()
+                if delay is None:
+                    response = await self._complete_once(params, budget)
+                else:
+                    response = await self._hedged(params, delay, budget)
+        except BaseException:
+            self.failures += 1
+            raise
+        return (response.choices[0].message.content or "").strip()
+
+    async def _hedged(self, params: Dict[str, Any], delay: float, budget: Optional[float] = None) -> Any:
+        primary = asyncio.create_task(self._complete_once(params, budget))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            # Hedge only if the primary is slow and there is a free slot for it
+            if not done and not self._semaphore.locked() and (budget is None or budget > delay):
+                self.hedges += 1
+                tasks.add(asyncio.create_task(self._complete_once(params, None if budget is None else budget - delay)))
+            error: Optional[BaseException] = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.hedges_won += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def stream(self, messages: Messages, model: Optional[str] = None, **kwargs: Any) -> AsyncIterator[str]:
+        """
+        Streaming chat completion yielding content deltas. Retries apply only
+        until the stream is open (nothing has been yielded yet). Closing the
+        generator closes the upstream response.
+        """
+        params = {"model": model or settings.openai_model, "messages": messages, "stream": True, **kwargs}
+        self.requests += 1
+        start = time.perf_counter()
+        first = True
+        attempt = 0
+        while True:
+            await self._acquire()
+            try:
+                stream = await self.client.chat.completions.create(**params)
+                break
+            except Exception as e:
+                # Give the slot back while backing off
+                self._release()
+                if not _retryable(e) or attempt >= self.max_retries:
+                    self.failures += 1
+                    raise
+                error = e
+            except BaseException:
+                self._release()
+                raise
+            await self._backoff(attempt, error)
+            attempt += 1
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content  # may be None
+                if delta:
+                    if first:
+                        first = False
+                        record("llm_ttft", time.perf_counter() - start)
+                    yield delta
+            record("llm_total", time.perf_counter() - start)
+        finally:
+            try:
+                # Shielded: a second cancellation while closing (e.g. shutdown)
+                # must not leave the upstream completion running
+                await asyncio.shield(stream.close())
+            finally:
+                self._release()
+
+    # --- lifecycle / stats -----------------------------------------------
+
+    def stats(self) -> Dict[str, Any]:
+        waits = np.array(self._queue_waits) * 1e3 if self._queue_waits else np.zeros(1)
+        latencies = np.array(self._latencies) * 1e3 if self._latencies else np.zeros(1)
+        delay = self.hedge_delay()
+        return {
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "requests": self.requests,
+            "retries": self.retries,
+            "failures": self.failures,
+            "queue_wait_ms": {
+                "p50": float(np.percentile(waits, 50)),
+                "p95": float(np.percentile(waits, 95)),
+                "max": float(waits.max()),
+            },
+            "upstream_latency_ms": {
+                "p50": float(np.percentile(latencies, 50)),
+                "p95": float(np.percentile(latencies, 95)),
+            },
+            "hedging": {
+                "enabled": self.hedge,
+                "delay_ms": delay * 1e3 if delay is not None else None,
+                "hedges": self.hedges,
+                "hedges_won": self.hedges_won,
+            },
+        }
+
+    async def aclose(self) -> None:
+        await self.http_client.aclose()
+
+
+llm_gateway: LLMGateway = Lazy(  # type: ignore[assignment]
+    "llm_gateway",
+    lambda: LLMGateway(
+        api_key=settings.openai_api_key,
+        base_url=settings.openai_base_url,
+        max_concurrency=settings.llm_max_concurrency,
+        max_connections=settings.llm_max_connections,
+        timeout=settings.llm_timeout,
+        max_retries=settings.llm_max_retries,
+        retry_base_delay=settings.llm_retry_base_delay,
+        retry_max_delay=settings.llm_retry_max_delay,
+        hedge=settings.llm_hedge_enabled,
+        hedge_min_delay=settings.llm_hedge_min_delay,
+    ),
+)
@@ -0,0 +1,211 @@
+"""
+Per-stage latency instrumentation.
+
+Every stage of a request (embedding, connection acquire, vector search,
+prompt building, LLM, history) and of ingestion is timed with `stage()` and
+observed in the `rag_stage_seconds` Prometheus histogram, served on
+GET /metrics. Stages of the current request are also collected so
+TimingMiddleware can send them as a `Server-Timing` header.
+
+Only METRICS_SAMPLE_RATE of requests are timed stage by stage; for the rest
+`stage()` costs one context variable lookup. Request totals are always
+recorded.
+
+Startup is tracked in `rag_startup_seconds`: import, lifespan and warm-up
+durations, and the process age when the worker became ready and when its
+first request completed.
+"""
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional, Sequence
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Gauge, Histogram, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+from starlette.datastructures import MutableHeaders
+from config import settings
+
+# Roughly log-spaced from 1 ms to 60 s: stages range from a cached embedding to a long completion
+_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+STAGE_SECONDS = Histogram(
+    "rag_stage_seconds",
+    "Time spent in each stage of request handling, history writes and ingestion",
+    ["stage"],
+    buckets=_BUCKETS,
+)
+REQUEST_SECONDS = Histogram(
+    "rag_http_request_seconds",
+    "HTTP request duration (streaming responses: until the last byte)",
+    ["method", "route", "status"],
+    buckets=_BUCKETS,
+)
+STARTUP_SECONDS = Gauge(
+    "rag_startup_seconds",
+    "Worker startup: import/lifespan/warm-up durations, process age when ready and after the first request",
+    ["phase"],
+)
+
+_UNSAMPLED: Dict[str, float] = {}
+# Stage durations of the current request; None outside requests (background work,
+# whose long-lived tasks start in a fresh contextvars.Context so they never inherit one)
+_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("stage_timings", default=None)
+
+
+def observe(name: str, seconds: float) -> None:
+    """
+    Record a stage duration in the histogram only (background work).
+    """
+    STAGE_SECONDS.labels(name).observe(seconds)
+
+
+def record(name: str, seconds: float) -> None:
+    """
+    Record a stage duration for the current request, if it is sampled.
+    Repeated stages (e.g. two queries) add up in Server-Timing.
+    """
+    timings = _timings.get()
+    if timings is _UNSAMPLED:
+        return
+    STAGE_SECONDS.labels(name).observe(seconds)
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    if _timings.get() is _UNSAMPLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def _process_start() -> float:
+    # perf_counter() value when this process started: its age from /proc
+    # (start time in clock ticks since boot), else now
+    try:
+        with open("/proc/self/stat") as f:
+            ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        age = time.clock_gettime(time.CLOCK_BOOTTIME) - ticks / os.sysconf("SC_CLK_TCK")
+        return time.perf_counter() - max(0.0, age)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.perf_counter()
+
+
+_started = _process_start()
+_startup: Dict[str, float] = {}
+_first_request_done = False
+
+
+def _after_fork_in_child() -> None:
+    global _started, _first_request_done
+    _started = time.perf_counter()
+    _first_request_done = False
+    for phase in ("lifespan", "ready", "first_request", "first_request_duration"):
+        _startup.pop(phase, None)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def process_age() -> float:
+    return time.perf_counter() - _started
+
+
+def startup_phase(name: str, seconds: float) -> None:
+    _startup[name] = seconds
+    STARTUP_SECONDS.labels(name).set(seconds)
+
+
+def startup_stats() -> Dict[str, float]:
+    """
+    Startup timings of this worker so far, in milliseconds.
+    """
+    return {name: round(seconds * 1e3, 1) for name, seconds in _startup.items()}
+
+
+def current_timings() -> Dict[str, float]:
+    """
+    Stage durations of the current request so far, in milliseconds.
+    """
+    timings = _timings.get()
+    if not timings:
+        return {}
+    return {name: round(seconds * 1e3, 1) for name, seconds in timings.items()}
+
+
+def server_timing(timings: Dict[str, float], total: float) -> str:
+    entries = [f"{name};dur={seconds * 1e3:.1f}" for name, seconds in timings.items()]
+    entries.append(f"app;dur={total * 1e3:.1f}")
+    return ", ".join(entries)
+
+
+class TimingMiddleware:
+    """
+    Pure ASGI middleware: decides whether a request is sampled, adds the
+    `Server-Timing` header (stages completed before the response starts, plus
+    `app`, the time to the first byte) and records the request duration by
+    route template. The end of the first request is recorded as the
+    `first_request` startup phase.
+    """
+
+    def __init__(self, app: Any, sample_rate: Optional[float] = None, probe_paths: Sequence[str] = ()):
+        self.app = app
+        # Built with the middleware stack on the first ASGI event, not on import
+        self.sample_rate = settings.metrics_sample_rate if sample_rate is None else sample_rate
+        # Requests that don't count as the first request (readiness probes)
+        self.probe_paths = frozenset(probe_paths)
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http" or scope["path"] == "/metrics":
+            await self.app(scope, receive, send)
+            return
+        sampled = self.sample_rate >= 1.0 or random.random() < self.sample_rate
+        timings: Dict[str, float] = {} if sampled else _UNSAMPLED
+        token = _timings.set(timings)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_timed(message: Dict[str, Any]) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if sampled:
+                    MutableHeaders(scope=message).append("Server-Timing", server_timing(timings, time.perf_counter() - start))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            _timings.reset(token)
+            elapsed = time.perf_counter() - start
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_SECONDS.labels(scope["method"], route, str(status)).observe(elapsed)
+            if not _first_request_done and scope["path"] not in self.probe_paths:
+                _first_request(elapsed)
+
+
+def _first_request(seconds: float) -> None:
+    global _first_request_done
+    _first_request_done = True
+    startup_phase("first_request", process_age())
+    startup_phase("first_request_duration", seconds)
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """
+    Prometheus exposition of this worker's metrics, or of all workers when
+    PROMETHEUS_MULTIPROC_DIR is set (prometheus_client multiprocess mode).
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -3,8 +3,8 @@ from typing import Any, Dict, List, Optional
 from uuid import UUID as PyUUID, uuid4
 from sqlmodel import SQLModel, Field
 from sqlalchemy.dialects.postgresql import UUID as PGUUID, JSONB
-from sqlalchemy import JSON, Column
-from pgvector.sqlalchemy import Vector
+from sqlalchemy import JSON, Column, Text
+from services.vectors import PgVector
 
 class PdfIngestion(SQLModel, table=True):
     """
@@ -19,6 +19,7 @@ class PdfIngestion(SQLModel, table=True):
     )
 
     filename: str
+    collection: str = Field(default="default", index=True)
 
     # 2) ingested_at: default to now() in Python.
     ingested_at: datetime = Field(default_factory=datetime.utcnow)
@@ -40,13 +41,67 @@ class Document(SQLModel, table=True):
         default_factory=uuid4,
         sa_column=Column(PGUUID(as_uuid=True), primary_key=True, nullable=False),
     )
+    # LIST partition key: each collection is its own partition (services/collections.py)
+    collection: str = Field(
+        default="default",
+        sa_column=Column("collection", Text, nullable=False, server_default="default"),
+    )
     content: str = Field(sa_column=Column("content", nullable=False))
-    # If your embedding column is PGVECTOR, SQLModel won’t know it natively,
-    # so you can read it as an ARRAY of floats (or JSONB) if that’s how it’s stored.
-    embedding: Optional[List[float]] = Field(
-        sa_column=Column("embedding", Vector(1536), nullable=True)
+    # pgvector column, (de)serialized by the binary asyncpg codec registered in
+    # services/db.py; values are float32 numpy arrays.
+    embedding: Optional[Any] = Field(
+        sa_column=Column("embedding", PgVector(1536), nullable=True)
     )
     meta: Dict[str, Any] = Field(
         default_factory=dict,
         sa_column=Column("metadata", JSONB, nullable=False),
-    )
\ No newline at end of file
+    )
+    # sha256 hex of `content`; used to skip unchanged chunks on re-ingestion
+    # and to reuse embeddings of identical text across documents.
+    content_hash: Optional[str] = Field(
+        default=None,
+        sa_column=Column("content_hash", Text, nullable=True, index=True),
+    )
+    # pdf_ingestion row of the latest ingestion that contained this chunk
+    ingestion_id: Optional[PyUUID] = Field(
+        default=None,
+        sa_column=Column("ingestion_id", PGUUID(as_uuid=True), nullable=True),
+    )
+
+
+class IngestionJob(SQLModel, table=True):
+    """
+    A queued/running/finished background ingestion, stored alongside
+    pdf_ingestion so jobs survive restarts.
+    """
+    __tablename__ = "ingestion_job"
+
+    id: PyUUID = Field(
+        default_factory=uuid4,
+        sa_column=Column(PGUUID(as_uuid=True), primary_key=True, nullable=False),
+    )
+    filename: str
+    path: str  # the job's own copy of the upload
+    source: Optional[str] = None  # metadata.source of its chunks; None = path
+    collection: str = "default"
+    file_hash: Optional[str] = None
+    # queued | running | succeeded | failed | cancelled
+    status: str = Field(default="queued", index=True)
+    cancel_requested: bool = False
+    progress: Dict[str, Any] = Field(
+        default_factory=dict,
+        sa_column=Column("progress", JSON, nullable=False),
+    )
+    result: Dict[str, Any] = Field(
+        default_factory=dict,
+        sa_column=Column("result", JSON, nullable=False),
+    )
+    error: Optional[str] = None
+    ingestion_id: Optional[PyUUID] = Field(
+        default=None,
+        sa_column=Column("ingestion_id", PGUUID(as_uuid=True), nullable=True),
+    )
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
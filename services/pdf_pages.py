@@ -0,0 +1,60 @@
+"""
+PDF text extraction run inside the ingestion process pool.
+
+Kept free of app imports (config, DB, LangChain) so spawned worker processes
+start quickly and never touch the parent's clients.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import BinaryIO, List, Tuple
+from pypdf import PdfReader
+
+# Readers kept open per process, so the ranges of one job don't each re-read
+# and re-parse the file
+_MAX_OPEN = 2
+_open: "OrderedDict[Tuple[str, int, int], Tuple[BinaryIO, PdfReader, threading.Lock]]" = OrderedDict()
+_open_lock = threading.Lock()
+
+
+def _reader(file_path: str) -> Tuple[PdfReader, threading.Lock]:
+    """
+    This process's reader for `file_path`, keyed by path, mtime and size so
+    a replaced file is opened afresh. The reader works on an open file
+    handle, reading objects as pages need them instead of loading the whole
+    file into memory. Its lock serializes use when ranges run in threads.
+    """
+    stat = os.stat(file_path)
+    key = (file_path, stat.st_mtime_ns, stat.st_size)
+    with _open_lock:
+        if key in _open:
+            _open.move_to_end(key)
+            _, reader, lock = _open[key]
+            return reader, lock
+        handle = open(file_path, "rb")
+        try:
+            reader = PdfReader(handle)
+        except BaseException:
+            handle.close()
+            raise
+        _open[key] = (handle, reader, threading.Lock())
+        while len(_open) > _MAX_OPEN:
+            # Not closed here: a thread may still be extracting from it. The
+            # handle is closed once the last reference goes away.
+            _open.popitem(last=False)
+        return reader, _open[key][2]
+
+
+def count_pages(file_path: str) -> int:
+    reader, lock = _reader(file_path)
+    with lock:
+        return len(reader.pages)
+
+
+def extract_pages(file_path: str, start: int, stop: int) -> List[Tuple[int, str]]:
+    """
+    Extract text of pages [start, stop) as (page_number, text) pairs.
+    """
+    reader, lock = _reader(file_path)
+    with lock:
+        return [(n, reader.pages[n].extract_text() or "") for n in range(start, stop)]
@@ -0,0 +1,316 @@
+"""
+Compact copies of the embeddings for two-phase retrieval (VECTOR_COMPACT).
+
+Next to the full `embedding vector(1536)` a row can carry a half-precision
+copy (`embedding_half halfvec(1536)`, 2 bytes per dimension) or a binary
+quantized one (`embedding_bit bit(1536)`, one bit per dimension, set where
+the value is positive). Search then runs in two phases: the index on the
+compact column over-fetches `VECTOR_RERANK_FACTOR * k` candidates, and
+exact cosine distance on the full vectors of just those rows picks the top
+k. The compact index is 2x (halfvec) or 32x (binary) smaller than one on
+the full vectors, so it stays in memory on much larger tables.
+
+Chunk rows get their compact value when ingestion writes them; rows stored
+before VECTOR_COMPACT was set are filled in by the backfill command, which
+then builds the compact index if it is missing. Rows without a compact value
+can't be found by the candidate phase, so until none are left search uses
+the full vectors; each worker notices the backfill finishing by itself.
+
+    python -m services.quantized backfill [--type binary] [--batch-size 2000]
+    python -m services.quantized status [--type binary]
+
+Needs pgvector >= 0.7 (halfvec, binary_quantize, bit_hamming_ops).
+"""
+import asyncio
+import logging
+import time
+from functools import cached_property
+from typing import Any, Dict, List, Optional, Sequence
+import numpy as np
+from sqlalchemy import text
+from services.container import Lazy
+from services.db import engine
+from services.vector_index import VectorIndexManager
+from services.vectors import as_float32, binary_quantize
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Column, SQL type, index operator class, distance operator, and the
+# expression turning a full `vector` ({v}) into the compact type
+_TYPES: Dict[str, Dict[str, str]] = {
+    "halfvec": {
+        "column": "embedding_half",
+        "type": "halfvec({dims})",
+        "opclass": "halfvec_cosine_ops",
+        "operator": "<=>",
+        "quantize": "CAST({v} AS halfvec({dims}))",
+    },
+    "binary": {
+        "column": "embedding_bit",
+        "type": "bit({dims})",
+        "opclass": "bit_hamming_ops",
+        "operator": "<~>",
+        "quantize": "CAST(binary_quantize({v}) AS bit({dims}))",
+    },
+}
+# Hamming distance ranks much more coarsely than float16 cosine, so binary
+# needs a far deeper candidate list for the same recall (benchmarks/bench_quantized.py)
+DEFAULT_RERANK_FACTOR = {"halfvec": 2, "binary": 16}
+# How often search re-checks for rows without a compact value while there are some
+_COVERAGE_RECHECK_SECONDS = 30.0
+
+
+class CompactVectors:
+    """
+    One compact representation of documents.embedding: its column, the SQL
+    for the candidate phase, values for new rows, backfill and its index.
+    """
+
+    def __init__(self, kind: str, dims: int, table: str = "documents", rerank_factor: int = 0):
+        if kind not in _TYPES:
+            raise ValueError(f"Unknown compact vector type: {kind}")
+        spec = _TYPES[kind]
+        self.kind = kind
+        self.dims = dims
+        self.table = table
+        self.column = spec["column"]
+        self.sql_type = spec["type"].format(dims=dims)
+        self.operator = spec["operator"]
+        self._quantize = spec["quantize"]
+        self.opclass = spec["opclass"]
+        self.rerank_factor = max(1, rerank_factor or DEFAULT_RERANK_FACTOR[kind])
+        # Every row with an embedding has its compact value. Ingestion writes
+        # the value with each row, so once true it stays true.
+        self.complete = False
+        self._checked_at = float("-inf")
+
+    @cached_property
+    def index(self) -> VectorIndexManager:
+        return VectorIndexManager(self.table, self.column, opclass=self.opclass)
+
+    # --- search ----------------------------------------------------------
+
+    def quantize_sql(self, vector_sql: str) -> str:
+        return self._quantize.format(v=vector_sql, dims=self.dims)
+
+    def distance_sql(self, vector_sql: str) -> str:
+        """
+        Compact distance from each row to the query vector `vector_sql` (a
+        `vector` expression), for the candidate phase's ORDER BY.
+        """
+        return f"{self.column} {self.operator} {self.quantize_sql(vector_sql)}"
+
+    def candidates(self, k: int) -> int:
+        return k * self.rerank_factor
+
+    async def searchable(self) -> bool:
+        """
+        Whether search can run on the compact column, i.e. no row is missing
+        its value. While some are, this is re-checked every
+        _COVERAGE_RECHECK_SECONDS and callers search the full vectors.
+        """
+        if not self.complete and time.monotonic() - self._checked_at > _COVERAGE_RECHECK_SECONDS:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Could not check {self.table}.{self.column} coverage: {e}")
+        return self.complete
+
+    def search_sql(self, vec: str, where: str = "TRUE") -> str:
+        """
+        Two-phase search for the query vector `vec` (a SQL `vector`
+        expression): :n candidates by compact distance among the rows
+        matching `where`, reranked by exact cosine distance on the full
+        vectors down to :k rows of (id, content, metadata, embedding).
+        """
+        return f"""
+            SELECT id, content, metadata, embedding
+            FROM (
+                SELECT id, content, metadata, embedding
+                FROM {self.table}
+                WHERE {where}
+                ORDER BY {self.distance_sql(vec)}
+                LIMIT :n
+            ) candidates
+            ORDER BY embedding <=> {vec}
+            LIMIT :k
+        """
+
+    # --- writes ----------------------------------------------------------
+
+    def values(self, vectors: np.ndarray | Sequence[np.ndarray]) -> List[Any]:
+        """
+        Column values for newly written rows (binary COPY / INSERT parameters).
+        """
+        if self.kind == "binary":
+            return [binary_quantize(v) for v in vectors]
+        return [as_float32(v) for v in vectors]  # encoded by the halfvec codec
+
+    async def ensure_column(self) -> None:
+        """
+        Add the nullable compact column if it doesn't exist (no table rewrite).
+        """
+        async with engine.begin() as conn:
+            await conn.execute(text(
+                f"ALTER TABLE {self.table} ADD COLUMN IF NOT EXISTS {self.column} {self.sql_type}"
+            ))
+
+    async def column_exists(self) -> bool:
+        sql = text("""
+            SELECT 1 FROM pg_attribute
+            WHERE attrelid = CAST(:table AS regclass) AND attname = :column AND NOT attisdropped
+        """)
+        async with engine.connect() as conn:
+            return (await conn.execute(sql, {"table": self.table, "column": self.column})).scalar() is not None
+
+    async def coverage(self) -> Dict[str, int]:
+        sql = text(f"""
+            SELECT count(*) FILTER (WHERE embedding IS NOT NULL) AS rows,
+                   count(*) FILTER (WHERE embedding IS NOT NULL AND {self.column} IS NULL) AS missing
+            FROM {self.table}
+        """)
+        async with engine.connect() as conn:
+            r = (await conn.execute(sql)).first()
+        self._set_complete(r.missing == 0)
+        return {"rows": int(r.rows), "missing": int(r.missing)}
+
+    async def refresh(self) -> bool:
+        """
+        Re-read whether any row still lacks its compact value (stops at the
+        first one, unlike coverage()).
+        """
+        sql = text(f"""
+            SELECT EXISTS (SELECT 1 FROM {self.table} WHERE embedding IS NOT NULL AND {self.column} IS NULL)
+        """)
+        # Set first, so concurrent searches don't all re-check
+        self._checked_at = time.monotonic()
+        async with engine.connect() as conn:
+            missing = (await conn.execute(sql)).scalar()
+        self._set_complete(not missing)
+        return self.complete
+
+    def _set_complete(self, complete: bool) -> None:
+        self._checked_at = time.monotonic()
+        if complete and not self.complete:
+            logger.info(f"{self.table}.{self.column} is filled in; searching it in two phases.")
+        self.complete = complete
+
+    async def ensure(self) -> None:
+        """
+        Called on startup: add the column if needed, check coverage and look
+        up the compact index. Until the backfill has filled every row, search
+        uses the full vectors and the index is only inspected; it is
+        auto-created (VECTOR_INDEX_AUTO_CREATE) once there is nothing left
+        to backfill.
+        """
+        try:
+            await self.ensure_column()
+            complete = await self.refresh()
+        except Exception as e:
+            logger.error(f"Could not set up {self.table}.{self.column} (needs pgvector >= 0.7): {e}")
+            return
+        if not complete:
+            logger.warning(
+                f"Some {self.table} rows have no {self.column} yet; searching the full vectors until "
+                f"`python -m services.quantized backfill --type {self.kind}` has filled them."
+            )
+            await self.index.inspect()
+            return
+        await self.index.ensure()
+
+    async def backfill(self, batch_size: int = 2000, build_index: bool = True) -> Dict[str, Any]:
+        """
+        Fill the compact column for rows that don't have it, in id order and
+        one short transaction per batch so ingestion and reads keep going.
+        Then ANALYZE and, with `build_index`, build the compact index if the
+        table has none yet (after the fill: one bulk build is much faster than
+        inserting every backfilled row into a live HNSW graph).
+        """
+        await self.ensure_column()
+        sql = text(f"""
+            WITH batch AS (
+                SELECT id FROM {self.table}
+                WHERE id > :after AND {self.column} IS NULL AND embedding IS NOT NULL
+                ORDER BY id
+                LIMIT :n
+            )
+            UPDATE {self.table} d SET {self.column} = {self.quantize_sql("d.embedding")}
+            FROM batch
+            WHERE d.id = batch.id
+            RETURNING d.id
+        """)
+        start = time.perf_counter()
+        after, updated = "00000000-0000-0000-0000-000000000000", 0
+        while True:
+            async with engine.begin() as conn:
+                ids = (await conn.execute(sql, {"after": after, "n": batch_size})).scalars().all()
+            if not ids:
+                break
+            # Python UUIDs order like Postgres uuids (bytewise)
+            after = max(ids)
+            updated += len(ids)
+            logger.info(f"Backfilled {updated} rows of {self.table}.{self.column}")
+        async with engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            await conn.execute(text(f"ANALYZE {self.table}"))
+        result: Dict[str, Any] = {"updated": updated, "seconds": round(time.perf_counter() - start, 2)}
+        await self.index.inspect()
+        if build_index and self.index.active_method is None and self.index.index_type != "none":
+            result["index"] = await self.index.rebuild()
+        return result
+
+    async def status(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {"type": self.kind, "column": self.column, "rerank_factor": self.rerank_factor}
+        if not await self.column_exists():
+            return {**result, "column_exists": False, "search": "full"}
+        health = await self.index.health()
+        coverage = await self.coverage()
+        return {
+            **result,
+            "column_exists": True,
+            **coverage,
+            # "full" until every row has its compact value
+            "search": "two_phase" if coverage["missing"] == 0 else "full",
+            "index": {key: health[key] for key in ("status", "warnings", "indexes", "building", "last_error")},
+        }
+
+
+# Falsy unless VECTOR_COMPACT is "halfvec" or "binary"
+compact_vectors: Optional[CompactVectors] = Lazy(  # type: ignore[assignment]
+    "compact_vectors",
+    lambda: CompactVectors(
+        settings.vector_compact,
+        settings.embedding_dimensions,
+        rerank_factor=settings.vector_rerank_factor,
+    )
+    if settings.vector_compact != "none"
+    else None,
+)
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Compact embedding columns (python -m services.quantized backfill)")
+    parser.add_argument("command", choices=["backfill", "status"])
+    parser.add_argument("--type", choices=sorted(_TYPES), help="default: VECTOR_COMPACT")
+    parser.add_argument("--batch-size", type=int, default=2000)
+    parser.add_argument("--no-index", action="store_true", help="backfill only; don't build the compact index")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    kind = args.type or settings.vector_compact
+    if kind == "none":
+        parser.error("pass --type or set VECTOR_COMPACT")
+    compact = CompactVectors(kind, settings.embedding_dimensions, rerank_factor=settings.vector_rerank_factor)
+
+    async def run() -> Dict[str, Any]:
+        try:
+            if args.command == "backfill":
+                return await compact.backfill(args.batch_size, build_index=not args.no_index)
+            return await compact.status()
+        finally:
+            await engine.dispose()
+
+    print(json.dumps(asyncio.run(run()), indent=2, default=str))
@@ -1,158 +1,413 @@
 
-from typing import List, Tuple, Dict, Any, AsyncGenerator
+from typing import List, Optional, Tuple, Dict, Any, AsyncGenerator, AsyncIterator
 from fastapi import HTTPException
-from openai import AsyncOpenAI
+import numpy as np
 from sqlalchemy import text
 from services.db import get_session
-from langchain_openai import OpenAIEmbeddings
-import openai
+from services.embeddings import embed_queries, embed_query
+from services.vectors import vector_array
+from services.answer_cache import answer_cache
+from services.ann_index import ann_index
+from services.vector_index import vector_index
+from services.quantized import compact_vectors
+from services.collections import SearchFilters, collections
+from services.history import HistoryContext, format_history
+from services.context import context_packer
+from services.llm import llm_gateway
+from services.metrics import stage
+from services.singleflight import SingleFlight, StreamSingleFlight, question_key
 from config import settings
 import logging
 import asyncio
+from dataclasses import dataclass, replace
 
 
 logger = logging.getLogger(__name__)
 
-openai.api_key = settings.openai_api_key
-embedding_model = OpenAIEmbeddings(
-    model=settings.embedding_model,
-    openai_api_key=settings.openai_api_key
-)
+# Identical questions in flight at the same time share one pipeline run
+query_flights = SingleFlight()
+stream_flights = StreamSingleFlight()
 
-client = AsyncOpenAI(api_key=settings.openai_api_key)
+def _filters_rows(filters: SearchFilters) -> bool:
+    # On a partitioned table a collection alone just prunes partitions
+    return filters.filters_rows or (filters.collection is not None and not collections.partitioned)
 
-def to_pgvector_literal(vec: list[float]) -> str:
-    return f"[{','.join(f'{x:.6f}' for x in vec)}]"
-
-async def retrieve_top_docs(question: str, k: int = 5) -> List[Dict[str,Any]]:
-    q_vec = embedding_model.embed_query(question)
-    ql = to_pgvector_literal(q_vec)
-    sql = text("""
+async def _pgvector_search(
+    q_vec: np.ndarray, k: int, mode: Optional[str] = None, filters: Optional[SearchFilters] = None
+) -> List[Dict[str, Any]]:
+    filters = filters or SearchFilters()
+    where, params = filters.where()
+    if compact_vectors and await compact_vectors.searchable():
+        per_query = compact_vectors.search_sql("CAST(:q AS vector)", where)
+        index, params["n"] = compact_vectors.index, compact_vectors.candidates(k)
+    else:
+        per_query = f"""
+            SELECT id, content, metadata, embedding
+            FROM documents
+            WHERE {where}
+            ORDER BY embedding <=> :q
+            LIMIT :k
+        """
+        index = vector_index
+    sql = text(f"""
         SELECT id, content, metadata, 1 - (embedding <=> :q) AS similarity
-        FROM documents
-        ORDER BY embedding <=> :q
-        LIMIT :k
+        FROM ({per_query}) d
+        ORDER BY similarity DESC
     """)
+    params.update(q=q_vec, k=k)
+
+    async def run(session):
+        # ef_search / probes for the requested recall/latency mode, this transaction only
+        await index.apply_search_params(session, mode, params.get("n", k), filtered=_filters_rows(filters))
+        return await session.execute(sql, params)
+
     async with get_session() as session:
         try:
-            res = await asyncio.wait_for(session.execute(sql, {"q": ql, "k": k}), timeout=10.0)
+            with stage("db_acquire"):
+                await asyncio.wait_for(session.connection(), timeout=10.0)
+            with stage("vector_search"):
+                res = await asyncio.wait_for(run(session), timeout=10.0)
         except asyncio.TimeoutError:
-            raise HTTPException(504, "DB query timed out")
-    rows = res.fetchall()
+            logger.error("Database query timed out — connection may be stale.")
+            raise HTTPException(status_code=504, detail="Database query timed out.")
     return [
-        {"content": r.content, "metadata": r.metadata, "similarity": float(r.similarity)}
-        for r in rows
+        {"id": str(r.id), "content": r.content, "metadata": r.metadata, "similarity": float(r.similarity)}
+        for r in res.fetchall()
     ]
 
-async def stream_answer(
-    question: str,
-    history: List[Dict[str,str]],
-) -> AsyncGenerator[str,None]:
+async def _ann_search(q_vec: np.ndarray, k: int) -> List[Dict[str, Any]]:
+    with stage("vector_search"):
+        hits = await ann_index.search(q_vec, k)
+    if not hits:
+        return []
+    # The index only knows ids; fetch the rows by primary key
+    sql = text("SELECT id, content, metadata FROM documents WHERE id = ANY(:ids)")
+    async with get_session() as session:
+        try:
+            with stage("db_acquire"):
+                await asyncio.wait_for(session.connection(), timeout=10.0)
+            with stage("db_fetch"):
+                res = await asyncio.wait_for(session.execute(sql, {"ids": [i for i, _ in hits]}), timeout=10.0)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="Database query timed out.")
+    rows = {r.id: r for r in res.fetchall()}
+    return [
+        {"id": str(i), "content": rows[i].content, "metadata": rows[i].metadata, "similarity": sim}
+        for i, sim in hits
+        if i in rows
+    ]
+
+async def search_documents(
+    q_vec: np.ndarray, k: int, mode: Optional[str] = None, filters: Optional[SearchFilters] = None
+) -> List[Dict[str, Any]]:
     """
-    1. retrieve top docs
-    2. build prompt including history
-    3. fire off OpenAI streaming chat
-    4. yield each token as soon as it arrives
+    Top-k chunks for a query vector as {id, content, metadata, similarity},
+    from the local ANN index when RETRIEVAL_BACKEND=ann and it is built,
+    otherwise from pgvector (using its index, tuned for `mode`, if one exists;
+    with VECTOR_COMPACT, candidates from the compact index reranked exactly,
+    once every row has its compact value).
+    Searches with `filters` always go to pgvector, where the filters are
+    part of the query (and a collection prunes it to one partition).
     """
-    logger.info("Embedding & retrieving docs")
-    docs = await retrieve_top_docs(question)
-    ctx = "\n\n---\n\n".join(d["content"] for d in docs)
-
-    # build history block
-    hist_block = ""
-    if history:
-        for turn in history:
-            hist_block += f"User: {turn['question']}\nAssistant: {turn['answer']}\n"
+    if ann_index and not filters:
+        if ann_index.ready:
+            return await _ann_search(q_vec, k)
+        ann_index.fallbacks += 1
+    return await _pgvector_search(q_vec, k, mode, filters)
+
+async def _pgvector_search_batch(
+    q_vecs: np.ndarray, k: int, mode: Optional[str] = None, filters: Optional[SearchFilters] = None
+) -> List[List[Dict[str, Any]]]:
+    # One statement for all questions: each array element drives an index scan via LATERAL
+    filters = filters or SearchFilters()
+    where, params = filters.where()
+    params.update(qs=vector_array(q_vecs), k=k)
+    if compact_vectors and await compact_vectors.searchable():
+        per_question = compact_vectors.search_sql("q.vec", where)
+        index, params["n"] = compact_vectors.index, compact_vectors.candidates(k)
     else:
-        hist_block = "(no prior context)\n"
-
-    prompt = (
-        f"You are a helpful assistant.\n\n"
-        f"Conversation so far:\n{hist_block}\n"
-        f"Context from documents:\n{ctx}\n\n"
-        f"Question: {question}\n"
-        f"Answer:"
+        per_question = f"""
+            SELECT id, content, metadata, embedding
+            FROM documents
+            WHERE {where}
+            ORDER BY embedding <=> q.vec
+            LIMIT :k
+        """
+        index = vector_index
+    sql = text(f"""
+        SELECT q.ord, d.id, d.content, d.metadata, 1 - (d.embedding <=> q.vec) AS similarity
+        FROM unnest(CAST(:qs AS vector[])) WITH ORDINALITY AS q(vec, ord)
+        CROSS JOIN LATERAL ({per_question}) d
+        ORDER BY q.ord, similarity DESC
+    """)
+
+    async def run(session):
+        await index.apply_search_params(session, mode, params.get("n", k), filtered=_filters_rows(filters))
+        return await session.execute(sql, params)
+
+    async with get_session() as session:
+        try:
+            with stage("db_acquire"):
+                await asyncio.wait_for(session.connection(), timeout=10.0)
+            with stage("vector_search"):
+                res = await asyncio.wait_for(run(session), timeout=10.0 + 0.05 * len(q_vecs))
+        except asyncio.TimeoutError:
+            logger.error("Batch retrieval query timed out.")
+            raise HTTPException(status_code=504, detail="Database query timed out.")
+    results: List[List[Dict[str, Any]]] = [[] for _ in range(len(q_vecs))]
+    for r in res.fetchall():
+        results[r.ord - 1].append(
+            {"id": str(r.id), "content": r.content, "metadata": r.metadata, "similarity": float(r.similarity)}
+        )
+    return results
+
+async def _ann_search_batch(q_vecs: np.ndarray, k: int) -> List[List[Dict[str, Any]]]:
+    with stage("vector_search"):
+        hits = await asyncio.gather(*(ann_index.search(q, k) for q in q_vecs))
+    ids = list({i for found in hits for i, _ in found})
+    if not ids:
+        return [[] for _ in hits]
+    # One primary-key fetch for the union of all hits
+    sql = text("SELECT id, content, metadata FROM documents WHERE id = ANY(:ids)")
+    async with get_session() as session:
+        try:
+            with stage("db_acquire"):
+                await asyncio.wait_for(session.connection(), timeout=10.0)
+            with stage("db_fetch"):
+                res = await asyncio.wait_for(session.execute(sql, {"ids": ids}), timeout=10.0)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="Database query timed out.")
+    rows = {r.id: r for r in res.fetchall()}
+    return [
+        [
+            {"id": str(i), "content": rows[i].content, "metadata": rows[i].metadata, "similarity": sim}
+            for i, sim in found
+            if i in rows
+        ]
+        for found in hits
+    ]
+
+async def search_documents_batch(
+    q_vecs: np.ndarray, k: int, mode: Optional[str] = None, filters: Optional[SearchFilters] = None
+) -> List[List[Dict[str, Any]]]:
+    """
+    search_documents for many query vectors at once, in one database round trip.
+    """
+    if len(q_vecs) == 0:
+        return []
+    if ann_index and not filters:
+        if ann_index.ready:
+            return await _ann_search_batch(q_vecs, k)
+        ann_index.fallbacks += 1
+    return await _pgvector_search_batch(q_vecs, k, mode, filters)
+
+async def retrieve_top_docs(
+    question: str,
+    k: int | None = None,
+    mode: Optional[str] = None,
+    filters: Optional[SearchFilters] = None,
+) -> List[Dict[str,Any]]:
+    with stage("embed"):
+        q_vec = await embed_query(question)
+    return await search_documents(q_vec, k or settings.top_k, mode, filters)
+
+@dataclass
+class AnswerStream:
+    """
+    A streaming answer whose retrieval is done: the sources it is based on,
+    context packing numbers, and the LLM deltas still to come.
+    """
+    sources: List[Dict[str, Any]]
+    context_stats: Dict[str, int]
+    deltas: AsyncIterator[str]
+
+async def prepare_answer_stream(
+    question: str,
+    history: HistoryContext,
+    search_mode: Optional[str] = None,
+    filters: Optional[SearchFilters] = None,
+) -> AnswerStream:
+    """
+    1. retrieve top docs (within `filters`)
+    2. build prompt including the summary and recent turns of the conversation
+    3. open the OpenAI streaming chat (deltas are pulled by the caller)
+
+    With QUERY_COALESCING_ENABLED, concurrent requests for the same question,
+    search mode, filters and prompt history share one run: later ones replay
+    the deltas produced so far, then follow the live stream.
+    """
+    if not settings.query_coalescing_enabled:
+        return await _prepare_answer_stream(question, history, search_mode, filters)
+
+    async def open_stream() -> Tuple[AnswerStream, AsyncIterator[str]]:
+        answer = await _prepare_answer_stream(question, history, search_mode, filters)
+        return answer, answer.deltas
+
+    key = question_key(
+        question,
+        search_mode or settings.vector_search_mode,
+        settings.top_k,
+        filters.key() if filters else "",
+        format_history(history),
     )
+    answer, deltas = await stream_flights.join(key, open_stream)
+    return replace(answer, deltas=deltas)
 
-    # call OpenAI in streaming mode
-    stream = await client.chat.completions.create(
-        model=settings.openai_model,
-        messages=[{"role":"user","content":prompt}],
-        stream=True
+async def _prepare_answer_stream(
+    question: str,
+    history: HistoryContext,
+    search_mode: Optional[str] = None,
+    filters: Optional[SearchFilters] = None,
+) -> AnswerStream:
+    docs = await retrieve_top_docs(question, mode=search_mode, filters=filters)
+    with stage("prompt_build"):
+        packed = context_packer.pack(docs)
+
+        # build history block
+        hist_block = format_history(history)
+
+        prompt = (
+            f"You are a helpful assistant.\n\n"
+            f"Conversation so far:\n{hist_block}\n"
+            f"Context from documents:\n{packed.text}\n\n"
+            f"Question: {question}\n"
+            f"Answer:"
+        )
+
+    return AnswerStream(
+        sources=[{"id": d["id"], "similarity": d["similarity"], "metadata": d["metadata"]} for d in docs],
+        context_stats={"tokens": packed.tokens, "tokens_saved": packed.tokens_saved, "segments": packed.segments},
+        # call OpenAI in streaming mode through the shared gateway
+        deltas=llm_gateway.stream([{"role": "user", "content": prompt}]),
     )
 
-    full_answer = ""
-    async for chunk in stream:
-        content_delta = chunk.choices[0].delta.content  # may be None
-        if content_delta:
-            full_answer += content_delta
-            yield content_delta 
+async def stream_answer(
+    question: str,
+    history: HistoryContext,
+    search_mode: Optional[str] = None,
+    filters: Optional[SearchFilters] = None,
+) -> AsyncGenerator[str,None]:
+    """
+    Yield each token as soon as it arrives (see prepare_answer_stream).
+    """
+    answer = await prepare_answer_stream(question, history, search_mode, filters)
+    async for content_delta in answer.deltas:
+        yield content_delta
+
+async def answer_question(
+    question: str, search_mode: Optional[str] = None, filters: Optional[SearchFilters] = None
+) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    Answer with its source docs, retrieved within `filters`. With
+    QUERY_COALESCING_ENABLED, concurrent calls for the same question (case
+    and whitespace aside), search mode, filters and TOP_K share one run; a
+    failure is raised to all of them.
+    """
+    if not settings.query_coalescing_enabled:
+        return await _answer_question(question, search_mode, filters)
+    key = question_key(
+        question, search_mode or settings.vector_search_mode, settings.top_k, filters.key() if filters else ""
+    )
+    return await query_flights.run(key, lambda: _answer_question(question, search_mode, filters))
 
-async def answer_question(question: str) -> Tuple[str, List[Dict[str, Any]]]:
-    logger.info("✅ Starting to embed query")
+async def _answer_question(
+    question: str, search_mode: Optional[str] = None, filters: Optional[SearchFilters] = None
+) -> Tuple[str, List[Dict[str, Any]]]:
+    scope = filters.key() if filters else ""
     # Step 1: Embed the question
-    q_vector = embedding_model.embed_query(question)
-    logger.info("✅ Finished embedding query")
-    # Step 2: Query top-5 similar documents from Supabase
-    sql = text("""
-        SELECT id, content, metadata, 1 - (embedding <=> :q) AS similarity
-        FROM documents
-        ORDER BY embedding <=> :q
-        LIMIT 5
-    """)
+    with stage("embed"):
+        q_vector = await embed_query(question)
 
-    q_vector_str = to_pgvector_literal(q_vector)
+    # Reuse the answer to a near-identical question, skipping retrieval and the LLM
+    if answer_cache:
+        with stage("answer_cache"):
+            cached = answer_cache.lookup(q_vector, scope)
+        if cached is not None:
+            logger.debug("Answer cache hit")
+            return cached
 
-    logger.info("✅ Starting to fetch documents from DB")
-    async with get_session() as session:
-        try:
-            result = await asyncio.wait_for(
-                session.execute(sql, {"q": q_vector_str}),
-                timeout=10.0
-            )
-            rows = result.fetchall()
-        except asyncio.TimeoutError:
-            logger.error("Database query timed out — connection may be stale.")
-            raise HTTPException(status_code=504, detail="Database query timed out.")
+    # Step 2: Query the TOP_K most similar documents
+    rows = await search_documents(q_vector, settings.top_k, search_mode, filters)
+
+    # Steps 3-4: pack the context and generate the answer
+    answer, top_docs = await _generate_answer(question, rows)
 
-    logger.info("✅ Fetched documents from DB")
+    if answer_cache:
+        answer_cache.store(q_vector, answer, top_docs, k=settings.top_k, scope=scope)
 
-    # Step 3: Construct context string for the LLM
-    context_blocks = []
+    return answer, top_docs
+
+async def _generate_answer(question: str, rows: List[Dict[str, Any]]) -> Tuple[str, List[Dict[str, Any]]]:
+    # Step 3: Construct context string for the LLM (overlap merged, within CONTEXT_TOKEN_BUDGET)
     top_docs = []
 
     for row in rows:
-        context_blocks.append(row.content)
         top_docs.append({
-            "id": str(row.id),
-            "similarity": float(row.similarity),
-            "metadata": row.metadata
+            "id": row["id"],
+            "similarity": row["similarity"],
+            "metadata": row["metadata"]
         })
 
-    logger.info("✅ Constructed context block")
-
-    context = "\n\n---\n\n".join(context_blocks)
-    prompt = f"Use the following context to answer the question:\n\n{context}\n\nQuestion: {question}\nAnswer:"
-
-    # Step 4: Generate answer via OpenAI ChatCompletion (sync call in async context)
-    # Wrap blocking call with asyncio to avoid hanging the event loop
-    from openai import OpenAI
-    client = OpenAI(api_key=settings.openai_api_key)
-    logger.info("✅ Prompt ready, calling OpenAI")
-
-    async def run_completion(prompt: str, timeout: float = 20.0):
-        return await asyncio.wait_for(
-            asyncio.to_thread(
-                lambda: client.chat.completions.create(
-                    model=settings.openai_model,
-                    messages=[{"role": "user", "content": prompt}]
-                )
-            ),
-            timeout=timeout
-        )
-
-    response = await run_completion(prompt)
-    logger.info("✅ Got response from OpenAI")
-    answer = response.choices[0].message.content.strip()
+    with stage("prompt_build"):
+        context = context_packer.pack(rows).text
+        prompt = f"Use the following context to answer the question:\n\n{context}\n\nQuestion: {question}\nAnswer:"
 
+    # Step 4: Generate answer via the shared async LLM gateway (pooled connections, retries
+    # within LLM_ANSWER_BUDGET; queueing for a slot is not counted)
+    answer = await llm_gateway.complete(
+        [{"role": "user", "content": prompt}], budget=settings.llm_answer_budget
+    )
     return answer, top_docs
+
+async def answer_questions(
+    questions: List[str], search_mode: Optional[str] = None, filters: Optional[SearchFilters] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Batch version of answer_question. All questions are embedded together
+    and retrieved in one SQL statement before this returns (so failures there
+    surface as a normal error); the returned iterator then yields one result
+    per question, {index, question, answer, source_docs} or {index, question,
+    error}, in completion order, with at most QUERY_BATCH_CONCURRENCY
+    completions running.
+    """
+    scope = filters.key() if filters else ""
+    with stage("embed"):
+        q_vectors = await embed_queries(questions)
+
+    cached: Dict[int, Tuple[str, List[Dict[str, Any]]]] = {}
+    if answer_cache:
+        for i, vector in enumerate(q_vectors):
+            hit = answer_cache.lookup(vector, scope)
+            if hit is not None:
+                cached[i] = hit
+    pending = [i for i in range(len(questions)) if i not in cached]
+    retrieved = await search_documents_batch(q_vectors[pending], settings.top_k, search_mode, filters)
+    logger.info(f"Batch of {len(questions)} questions: {len(cached)} cached, {len(pending)} retrieved")
+
+    async def results() -> AsyncIterator[Dict[str, Any]]:
+        for i, (answer, sources) in cached.items():
+            yield {"index": i, "question": questions[i], "answer": answer, "source_docs": sources, "cached": True}
+
+        limit = asyncio.Semaphore(settings.query_batch_concurrency)
+
+        async def one(i: int, rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+            async with limit:
+                try:
+                    answer, sources = await _generate_answer(questions[i], rows)
+                except Exception as e:
+                    logger.error(f"Batch question {i} failed: {e!r}")
+                    return {"index": i, "question": questions[i], "error": str(e) or e.__class__.__name__}
+            if answer_cache:
+                answer_cache.store(q_vectors[i], answer, sources, k=settings.top_k, scope=scope)
+            return {"index": i, "question": questions[i], "answer": answer, "source_docs": sources}
+
+        tasks = [asyncio.create_task(one(i, rows)) for i, rows in zip(pending, retrieved)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            # Client went away: stop the completions still queued or running
+            for task in tasks:
+                task.cancel()
+
+    return results()
@@ -0,0 +1,269 @@
+"""
+Single-flight coalescing of identical in-flight requests.
+
+When a question trends, many identical requests arrive within the same
+second. The first one (the leader) runs the pipeline; duplicates that
+arrive while it runs await the same result instead of running their own
+embedding, search and completion. Nothing outlives the flight: repeats
+after it finishes run again (or hit the answer cache).
+
+The work runs in its own task, so a leader whose client disconnects doesn't
+take the followers' answer with it; it is cancelled only once every caller
+has gone. A failure is raised to everyone waiting at that moment, and the
+next request starts a fresh flight.
+"""
+import asyncio
+import hashlib
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Generic, List, Optional, Tuple, TypeVar
+import orjson
+from services.metrics import stage
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+M = TypeVar("M")
+
+
+def question_key(question: str, *params: Any) -> str:
+    """
+    Flight key for a question: case and whitespace are normalized, `params`
+    (search mode, k, history...) must match exactly.
+    """
+    normalized = " ".join(question.split()).casefold()
+    return hashlib.sha256(orjson.dumps([normalized, *params])).hexdigest()
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one run of `fn`.
+    """
+
+    def __init__(self) -> None:
+        self._flights: Dict[str, _Flight] = {}
+        self.leaders = 0
+        self.followers = 0
+        self.failures = 0
+        self.abandoned = 0  # flights cancelled because every caller left
+
+    async def run(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _Flight(asyncio.create_task(fn()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda task: self._finished(key, flight))
+            self.leaders += 1
+        else:
+            self.followers += 1
+        flight.waiters += 1
+        try:
+            if leader:
+                return await asyncio.shield(flight.task)
+            with stage("coalesced_wait"):
+                return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if not flight.task.done() and flight.waiters == 1:
+                # The last caller left: nobody wants the result any more
+                self._forget(key, flight)
+                flight.task.cancel()
+                self.abandoned += 1
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _finished(self, key: str, flight: _Flight) -> None:
+        self._forget(key, flight)
+        if not flight.task.cancelled() and flight.task.exception() is not None:
+            self.failures += 1
+
+    def _forget(self, key: str, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "failures": self.failures,
+            "abandoned": self.abandoned,
+        }
+
+
+class _StreamFlight(Generic[M, T]):
+    def __init__(self) -> None:
+        self.opening: Optional[asyncio.Task] = None
+        self.pump: Optional[asyncio.Task] = None
+        self.items: List[T] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+
+    def notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def changed(self) -> None:
+        await self._changed.wait()
+
+
+class _Subscription(Generic[T]):
+    """
+    One subscriber's iterator over a stream flight: replays the buffered
+    items, then follows live. Not an async generator, because closing a
+    generator that was never started skips its cleanup; this leaves the
+    flight on aclose(), exhaustion, an error or garbage collection, whether
+    or not it was ever read.
+    """
+
+    def __init__(self, flights: "StreamSingleFlight", key: str, flight: _StreamFlight) -> None:
+        self._flights = flights
+        self._key = key
+        self._flight = flight
+        self._position = 0
+        self._left = False
+
+    def __aiter__(self) -> "_Subscription[T]":
+        return self
+
+    async def __anext__(self) -> T:
+        flight = self._flight
+        try:
+            while not self._left:
+                if self._position < len(flight.items):
+                    self._position += 1
+                    return flight.items[self._position - 1]
+                if flight.error is not None:
+                    raise flight.error
+                if flight.done:
+                    break
+                await flight.changed()
+        except BaseException:
+            self._leave()
+            raise
+        self._leave()
+        raise StopAsyncIteration
+
+    async def aclose(self) -> None:
+        self._leave()
+
+    def _leave(self) -> None:
+        if not self._left:
+            self._left = True
+            self._flights._leave(self._key, self._flight)
+
+    def __del__(self) -> None:
+        self._leave()
+
+
+class StreamSingleFlight:
+    """
+    Single flight for streamed results. The leader opens the stream (e.g.
+    retrieval, prompt and the upstream request) and gets `(meta, source)`;
+    everyone joining the flight gets the same `meta` and an iterator over
+    the same items. Items are kept in a replay buffer, so a late joiner first
+    receives everything produced so far and then follows live. The key
+    stays joinable until the stream ends.
+    """
+
+    def __init__(self) -> None:
+        self._flights: Dict[str, _StreamFlight] = {}
+        self.leaders = 0
+        self.followers = 0
+        self.late_joins = 0  # joined after the first item was produced
+        self.failures = 0
+        self.abandoned = 0
+
+    async def join(
+        self,
+        key: str,
+        open_stream: Callable[[], Awaitable[Tuple[M, AsyncIterator[T]]]],
+    ) -> Tuple[M, AsyncIterator[T]]:
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _StreamFlight()
+            flight.opening = asyncio.create_task(self._open(key, flight, open_stream))
+            self._flights[key] = flight
+            self.leaders += 1
+        else:
+            self.followers += 1
+            self.late_joins += bool(flight.items)
+        flight.subscribers += 1
+        try:
+            meta = await asyncio.shield(flight.opening)
+        except BaseException:
+            self._leave(key, flight)
+            raise
+        return meta, _Subscription(self, key, flight)
+
+    async def _open(
+        self,
+        key: str,
+        flight: _StreamFlight,
+        open_stream: Callable[[], Awaitable[Tuple[M, AsyncIterator[T]]]],
+    ) -> M:
+        try:
+            meta, source = await open_stream()
+        except BaseException as e:
+            flight.done = True
+            self._forget(key, flight)
+            if not isinstance(e, asyncio.CancelledError):
+                self.failures += 1
+            raise
+        # Read upstream right away, whatever pace the subscribers go at
+        flight.pump = asyncio.create_task(self._pump(key, flight, source))
+        return meta
+
+    async def _pump(self, key: str, flight: _StreamFlight, source: AsyncIterator[T]) -> None:
+        try:
+            async for item in source:
+                flight.items.append(item)
+                flight.notify()
+        except asyncio.CancelledError:
+            # Normally nobody is left to tell; otherwise (shutdown) don't end their streams as if complete
+            flight.error = RuntimeError("coalesced stream was cancelled")
+            raise
+        except Exception as e:
+            flight.error = e
+            self.failures += 1
+            logger.error(f"Coalesced stream failed for {flight.subscribers} subscriber(s): {e!r}")
+        finally:
+            flight.done = True
+            flight.notify()
+            self._forget(key, flight)
+            aclose = getattr(source, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    def _leave(self, key: str, flight: _StreamFlight) -> None:
+        flight.subscribers -= 1
+        if flight.subscribers == 0 and not flight.done:
+            # Nobody is listening any more: stop the upstream work
+            self._forget(key, flight)
+            flight.opening.cancel()
+            if flight.pump is not None:
+                flight.pump.cancel()
+            self.abandoned += 1
+
+    def _forget(self, key: str, flight: _StreamFlight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "late_joins": self.late_joins,
+            "failures": self.failures,
+            "abandoned": self.abandoned,
+            "subscribers": sum(f.subscribers for f in self._flights.values()),
+        }
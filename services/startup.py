@@ -0,0 +1,89 @@
+"""
+Startup warm-up and readiness.
+
+`warm_up()` runs in the app's lifespan before the worker reports ready: it
+builds the lazy services, opens pooled DB connections, sends one embeddings
+request and loads the vector index (or the compact one), so the first
+requests don't pay for any of it. Every step is best effort: a failure is logged and the worker
+still becomes ready (requests then warm things up themselves).
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+from services import embeddings
+from services.ann_index import ann_index
+from services.container import build_all, built_services
+from services.db import warm_up_pool
+from services.metrics import process_age, startup_phase, startup_stats
+from services.quantized import compact_vectors
+from services.vector_index import vector_index
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Readiness:
+    """
+    Whether this worker should receive traffic, and what its warm-up did.
+    """
+
+    def __init__(self) -> None:
+        self.ready = False
+        self.warmup: Dict[str, Any] = {}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "startup_ms": startup_stats(),
+            "warmup": self.warmup,
+            "services": built_services(),
+        }
+
+
+readiness = Readiness()
+
+
+async def _step(name: str, run: Callable[[], Awaitable[Any]]) -> None:
+    start = time.perf_counter()
+    try:
+        result = await run()
+    except Exception as e:
+        logger.warning(f"Warm-up step {name} failed: {e!r}")
+        result = f"failed: {e!r}"
+    elapsed = time.perf_counter() - start
+    startup_phase(f"warmup_{name}", elapsed)
+    readiness.warmup[name] = {"ms": round(elapsed * 1e3, 1), "result": result}
+
+
+async def _services() -> Dict[str, float]:
+    return build_all()
+
+
+async def _embedding() -> Optional[int]:
+    if not settings.warmup_embedding:
+        return None
+    vectors = await asyncio.wait_for(embeddings.provider.embed(["warm-up"]), timeout=10.0)
+    return len(vectors[0])
+
+
+async def _index() -> Dict[str, Any]:
+    if ann_index:
+        # Maps the current index version (None until one is built)
+        return {"ann_ready": ann_index.ready}
+    # With VECTOR_COMPACT searches only walk the compact index
+    index = compact_vectors.index if compact_vectors else vector_index
+    return {"pg_prewarm_blocks": await index.prewarm()}
+
+
+async def warm_up() -> None:
+    start = time.perf_counter()
+    if settings.warmup_enabled:
+        await _step("services", _services)
+        await _step("db_pool", warm_up_pool)
+        await _step("embedding", _embedding)
+        await _step("index", _index)
+        startup_phase("warmup", time.perf_counter() - start)
+    readiness.ready = True
+    startup_phase("ready", process_age())
+    logger.info(f"Ready {process_age():.2f} s after process start ({startup_stats()}).")
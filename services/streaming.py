@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import time
+from typing import Any, AsyncIterator, Optional
+import orjson
+from services.history import HistoryContext, append_history
+from services.metrics import current_timings
+from services.query import prepare_answer_stream
+from services.collections import SearchFilters
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+class _Failed:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+async def coalesce(deltas: AsyncIterator[str], max_chars: int, max_delay: float) -> AsyncIterator[str]:
+    """
+    Re-chunk a stream of tiny deltas into frames of about `max_chars`, or
+    whatever arrived within `max_delay` seconds of the first buffered delta.
+    The very first delta goes out alone so time-to-first-token is unchanged.
+
+    The source is read by a separate task so a frame can be flushed on time
+    even while upstream is quiet. Closing this generator (e.g. the client
+    disconnected) cancels that task, which closes the upstream stream.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump() -> None:
+        try:
+            async for delta in deltas:
+                queue.put_nowait(delta)
+            queue.put_nowait(_END)
+        except Exception as e:
+            queue.put_nowait(_Failed(e))
+
+    reader = asyncio.create_task(pump())
+    try:
+        parts: list[str] = []
+        size = 0
+        deadline = 0.0
+        first = True
+        while True:
+            if not queue.empty():
+                item = queue.get_nowait()
+            elif not parts:
+                item = await queue.get()
+            else:
+                try:
+                    item = await asyncio.wait_for(queue.get(), max(0.0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    yield "".join(parts)
+                    parts, size = [], 0
+                    continue
+            if item is _END:
+                break
+            if isinstance(item, _Failed):
+                raise item.error
+            if first:
+                first = False
+                yield item
+                continue
+            if not parts:
+                deadline = loop.time() + max_delay
+            parts.append(item)
+            size += len(item)
+            if size >= max_chars:
+                yield "".join(parts)
+                parts, size = [], 0
+        if parts:
+            yield "".join(parts)
+    finally:
+        reader.cancel()
+        # wait(), not gather(): if we are being cancelled ourselves, gather would
+        # keep cancelling the reader and interrupt its upstream cleanup
+        await asyncio.wait({reader})
+
+
+def sse_event(event: str, data: Any) -> bytes:
+    """
+    One Server-Sent Events frame; data is JSON so newlines in tokens are safe.
+    """
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n\n"
+
+
+def _ms(start: float) -> float:
+    return round((time.perf_counter() - start) * 1e3, 1)
+
+
+async def stream_text(
+    question: str,
+    history: HistoryContext,
+    conversation_id: str,
+    search_mode: Optional[str] = None,
+    filters: Optional[SearchFilters] = None,
+) -> AsyncIterator[str]:
+    """
+    Plain-text stream of answer frames; the completed turn goes to the
+    write-behind history buffer once the answer is complete.
+    """
+    answer = await prepare_answer_stream(question, history, search_mode, filters)
+    parts: list[str] = []
+    async for frame in coalesce(answer.deltas, settings.stream_coalesce_chars, settings.stream_coalesce_ms / 1000):
+        parts.append(frame)
+        yield frame
+    await append_history(conversation_id, question, "".join(parts))
+
+
+async def stream_sse(
+    question: str,
+    history: HistoryContext,
+    conversation_id: str,
+    search_mode: Optional[str] = None,
+    filters: Optional[SearchFilters] = None,
+) -> AsyncIterator[bytes]:
+    """
+    SSE stream: `meta`, then `sources` and `timing` (retrieval) once documents
+    are retrieved, coalesced `token` frames with a `timing` event at the first
+    token, and `done` with totals and per-stage timings (or `error`).
+    """
+    start = time.perf_counter()
+    yield sse_event("meta", {"conversation_id": conversation_id})
+    parts: list[str] = []
+    frames = 0
+    try:
+        answer = await prepare_answer_stream(question, history, search_mode, filters)
+        yield sse_event("sources", answer.sources)
+        yield sse_event("timing", {"stage": "retrieval", "ms": _ms(start), "context": answer.context_stats})
+        async for frame in coalesce(answer.deltas, settings.stream_coalesce_chars, settings.stream_coalesce_ms / 1000):
+            if not parts:
+                yield sse_event("timing", {"stage": "first_token", "ms": _ms(start)})
+            parts.append(frame)
+            frames += 1
+            yield sse_event("token", {"text": frame})
+    except Exception as e:
+        logger.error(f"Streaming answer failed: {e!r}")
+        yield sse_event("error", {"detail": str(e) or e.__class__.__name__})
+        return
+    full_answer = "".join(parts)
+    await append_history(conversation_id, question, full_answer)
+    yield sse_event("done", {
+        "total_ms": _ms(start),
+        "frames": frames,
+        "chars": len(full_answer),
+        "stages": current_timings(),  # ms per stage, as Server-Timing can't carry them after the headers
+    })
@@ -0,0 +1,49 @@
+import logging
+from functools import lru_cache
+from typing import Any, Optional
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Rough English average, used when no tiktoken encoding can be loaded
+_CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=1)
+def _encoding() -> Optional[Any]:
+    """
+    tiktoken encoding of OPENAI_MODEL, loaded once. tiktoken downloads BPE
+    files on first use; when that isn't possible we fall back to estimating.
+    """
+    try:
+        import tiktoken
+
+        try:
+            return tiktoken.encoding_for_model(settings.openai_model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(f"tiktoken unavailable ({e}); estimating tokens as chars/{_CHARS_PER_TOKEN}.")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    enc = _encoding()
+    if enc is None:
+        return (len(text) + _CHARS_PER_TOKEN - 1) // _CHARS_PER_TOKEN
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """
+    Cut `text` to at most `max_tokens` tokens.
+    """
+    if max_tokens <= 0:
+        return ""
+    enc = _encoding()
+    if enc is None:
+        return text[: max_tokens * _CHARS_PER_TOKEN]
+    tokens = enc.encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else enc.decode(tokens[:max_tokens])
@@ -0,0 +1,231 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+from dataclasses import dataclass, field
+from typing import List, Optional
+from uuid import uuid4
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.requests import Request
+
+logger = logging.getLogger(__name__)
+
+PDF_MAGIC = b"%PDF-"
+# The PDF spec lets readers accept the header anywhere in the first 1 KiB
+MAGIC_WINDOW = 1024
+# Each upload gets its own file here, read by its ingestion job only
+UPLOAD_SUBDIR = ".uploads"
+# File data goes to disk from a thread in blocks of about this size, rather
+# than one thread hop per network chunk
+WRITE_BUFFER_BYTES = 1 << 20
+
+
+class UploadError(Exception):
+    """
+    Upload rejected; `status_code` is the HTTP status to answer with.
+    """
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+@dataclass
+class SavedUpload:
+    filename: str
+    path: str    # this upload's own file, never replaced by a later upload
+    source: str  # <directory>/<filename>: the document's name in metadata.source
+    size: int
+    sha256: str
+
+
+@dataclass
+class _Part:
+    """
+    State of the multipart body while it streams through the parser.
+    """
+    headers: dict = field(default_factory=dict)
+    header_field: bytes = b""
+    header_value: bytes = b""
+    is_file: bool = False
+    filename: Optional[str] = None
+    pending: List[bytes] = field(default_factory=list)
+    done: bool = False
+
+
+def safe_filename(name: str) -> str:
+    """
+    Strip directories (both separators) so the client can't write outside
+    the upload directory.
+    """
+    name = os.path.basename(name.replace("\\", "/")).strip()
+    if name in ("", ".", ".."):
+        raise UploadError(400, "Missing file name")
+    return name
+
+
+class _PdfSink:
+    """
+    Temp file in the destination directory that the upload is streamed
+    into, hashing and size-checking each chunk on the way and writing it
+    out in WRITE_BUFFER_BYTES blocks.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.digest = hashlib.sha256()
+        self.head = b""
+        self.checked = False
+        fd, self.tmp_path = tempfile.mkstemp(dir=directory, prefix=".upload-", suffix=".part")
+        os.fchmod(fd, 0o644)  # mkstemp creates 0600; keep what open() used to give
+        self.file = os.fdopen(fd, "wb")
+        self._buffer = bytearray()
+
+    def _check_magic(self) -> None:
+        if PDF_MAGIC not in self.head:
+            raise UploadError(415, "File is not a PDF")
+        self.checked = True
+
+    async def write(self, data: bytes) -> None:
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise UploadError(413, f"File exceeds the {self.max_bytes} byte upload limit")
+        if not self.checked:
+            self.head += data[: MAGIC_WINDOW - len(self.head)]
+            if len(self.head) >= MAGIC_WINDOW:
+                self._check_magic()
+        self.digest.update(data)
+        self._buffer += data
+        if len(self._buffer) >= WRITE_BUFFER_BYTES:
+            block, self._buffer = self._buffer, bytearray()
+            await asyncio.to_thread(self.file.write, block)
+
+    async def commit(self, path: str) -> None:
+        if not self.checked:
+            self._check_magic()
+
+        def finish() -> None:
+            self.file.write(self._buffer)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            os.replace(self.tmp_path, path)
+
+        await asyncio.to_thread(finish)
+
+    async def discard(self) -> None:
+        def remove() -> None:
+            self.file.close()
+            try:
+                os.unlink(self.tmp_path)
+            except FileNotFoundError:
+                pass
+
+        await asyncio.to_thread(remove)
+
+
+async def save_pdf_upload(request: Request, directory: str, max_bytes: int, field_name: str = "file") -> SavedUpload:
+    """
+    Stream a multipart/form-data PDF upload straight from the socket to
+    `directory`, without buffering the body in memory or in a spool file.
+
+    Each received chunk is fed to the multipart parser, and the file part's
+    bytes are hashed and appended to a temp file next to the destination.
+    The request is rejected as soon as it is known to be too large (by
+    Content-Length, or while streaming) or when the first KiB has no PDF
+    header. On success the temp file is renamed to a name of its own under
+    `<directory>/.uploads/`, so a queued or running job keeps reading the
+    version it was given when the same filename is uploaded again. The
+    document is still known as `<directory>/<filename>` (`source`).
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise UploadError(400, "Expected a multipart/form-data upload")
+    length = request.headers.get("content-length")
+    # Leave some room for the multipart framing around the file
+    if length is not None and length.isdigit() and int(length) > max_bytes + 64 * 1024:
+        raise UploadError(413, f"File exceeds the {max_bytes} byte upload limit")
+
+    os.makedirs(directory, exist_ok=True)
+    part = _Part()
+    target: Optional[_Part] = None
+
+    def on_part_begin() -> None:
+        nonlocal part
+        part = _Part()
+
+    def on_header_field(data: bytes, start: int, end: int) -> None:
+        part.header_field += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int) -> None:
+        part.header_value += data[start:end]
+
+    def on_header_end() -> None:
+        part.headers[part.header_field.lower()] = part.header_value
+        part.header_field = part.header_value = b""
+
+    def on_headers_finished() -> None:
+        nonlocal target
+        _, disposition = parse_options_header(part.headers.get(b"content-disposition", b""))
+        name = disposition.get(b"name", b"").decode("utf-8", "replace")
+        if name == field_name and b"filename" in disposition and target is None:
+            part.is_file = True
+            part.filename = disposition[b"filename"].decode("utf-8", "replace")
+            target = part
+
+    def on_part_data(data: bytes, start: int, end: int) -> None:
+        if part.is_file:
+            part.pending.append(data[start:end])
+
+    def on_part_end() -> None:
+        part.done = True
+
+    parser = MultipartParser(params[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+
+    sink: Optional[_PdfSink] = None
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if target is None:
+                continue
+            if sink is None:
+                filename = safe_filename(target.filename or "")
+                if not filename.lower().endswith(".pdf"):
+                    raise UploadError(400, "Only PDF files are supported")
+                sink = _PdfSink(directory, max_bytes)
+            # Hand over what the parser produced for this chunk; the sink
+            # holds at most about WRITE_BUFFER_BYTES before writing
+            pending, target.pending = target.pending, []
+            for data in pending:
+                await sink.write(data)
+        parser.finalize()
+        if target is None or sink is None:
+            raise UploadError(400, f"No file in form field '{field_name}'")
+        if not target.done:
+            raise UploadError(400, "Upload ended before the file was complete")
+        os.makedirs(os.path.join(directory, UPLOAD_SUBDIR), exist_ok=True)
+        path = os.path.join(directory, UPLOAD_SUBDIR, f"{uuid4().hex}-{filename}")
+        await sink.commit(path)
+    except BaseException:
+        if sink is not None:
+            await sink.discard()
+        raise
+    logger.info(f"Stored upload {filename} ({sink.size} bytes) at {path}")
+    return SavedUpload(
+        filename=filename,
+        path=path,
+        source=os.path.join(directory, filename),
+        size=sink.size,
+        sha256=sink.digest.hexdigest(),
+    )
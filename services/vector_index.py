@@ -0,0 +1,520 @@
+import asyncio
+import logging
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from sqlalchemy import text
+from sqlmodel.ext.asyncio.session import AsyncSession
+from services.db import engine, maintenance_engine
+from config import settings
+from services.container import Lazy
+
+logger = logging.getLogger(__name__)
+
+# Per-request search effort. hnsw.ef_search is the candidate list size (never
+# below k); ivfflat probes are a fraction of the index's lists.
+SEARCH_MODES: Dict[str, Dict[str, float]] = {
+    "fast": {"ef_search": 20, "probes_fraction": 0.01},
+    "balanced": {"ef_search": 40, "probes_fraction": 0.05},
+    "accurate": {"ef_search": 200, "probes_fraction": 0.2},
+}
+
+_VECTOR_METHODS = ("hnsw", "ivfflat")
+
+# How long a worker trusts its view of the live index before re-reading the
+# catalog: an index built or swapped by another worker shows up within this
+_RECHECK_SECONDS = 60.0
+_RECHECK_MISSING_SECONDS = 5.0
+
+
+class IndexBuildInProgress(RuntimeError):
+    """
+    Another worker holds the build lock for this index.
+    """
+
+
+def recommended_lists(rows: int) -> int:
+    """
+    pgvector's guidance for IVFFlat: rows / 1000 up to 1M rows, sqrt(rows) above.
+    """
+    if rows <= 1_000_000:
+        return max(1, rows // 1000)
+    return int(math.sqrt(rows))
+
+
+class VectorIndexManager:
+    """
+    Creates, rebuilds and inspects the pgvector index on documents.embedding
+    (or another vector column, e.g. a compact copy), and applies per-request
+    search parameters.
+
+    Index DDL runs with CREATE/DROP INDEX CONCURRENTLY on an autocommit
+    connection so reads and ingestion keep going while an index builds; a
+    rebuild builds the replacement under a temporary name and swaps it in.
+    It uses unpooled connections of the maintenance engine (DB_MAINTENANCE_URL):
+    the build lock and SET values are session state, which must neither be
+    split across server connections by a transaction-mode pooler nor
+    outlive the build on a connection that then serves queries.
+
+    On a partitioned table (collections, services/collections.py) the index
+    is a partitioned index with one child index per partition. Postgres
+    can't build those concurrently in one statement, so the parent is
+    created ON ONLY the table and each partition's index is built
+    concurrently and then attached; partitions created later get theirs
+    automatically when they are attached.
+    """
+
+    def __init__(self, table: str = "documents", column: str = "embedding", opclass: str = "vector_cosine_ops"):
+        self.table = table
+        self.column = column
+        self.opclass = opclass
+        self.index_type = settings.vector_index_type
+        self.name = f"{table}_{column}_{self.index_type}_idx"
+        # Method and IVFFlat lists of the live index, refreshed by inspect() and
+        # periodically by apply_search_params()
+        self.active_method: Optional[str] = None
+        self.active_lists: Optional[int] = None
+        self.partitioned = False
+        self.pgvector_version: Optional[Tuple[int, ...]] = None
+        self._checked_at = float("-inf")
+        self._task: Optional[asyncio.Task] = None
+        self.last_error: Optional[str] = None
+
+    # --- inspection ------------------------------------------------------
+
+    async def inspect(self) -> List[Dict[str, Any]]:
+        sql = text("""
+            SELECT c.relname AS name, am.amname AS method, i.indisvalid AS valid, i.indisready AS ready,
+                   -- A partitioned index has no storage of its own: sum its partitions' indexes
+                   coalesce((SELECT sum(pg_relation_size(t.relid)) FROM pg_partition_tree(c.oid) t),
+                            pg_relation_size(c.oid))::bigint AS size_bytes,
+                   c.reloptions AS options, pg_get_indexdef(c.oid) AS definition
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            JOIN pg_am am ON am.oid = c.relam
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+            WHERE i.indrelid = CAST(:table AS regclass) AND am.amname = ANY(:methods) AND a.attname = :column
+            ORDER BY c.relname
+        """)
+        about = text("""
+            SELECT c.relkind = 'p' AS partitioned,
+                   (SELECT extversion FROM pg_extension WHERE extname = 'vector') AS pgvector
+            FROM pg_class c
+            WHERE c.oid = CAST(:table AS regclass)
+        """)
+        params = {"table": self.table, "methods": list(_VECTOR_METHODS), "column": self.column}
+        async with engine.connect() as conn:
+            rows = (await conn.execute(sql, params)).fetchall()
+            table = (await conn.execute(about, {"table": self.table})).first()
+        self.partitioned = bool(table.partitioned)
+        if table.pgvector:
+            self.pgvector_version = tuple(int(p) for p in table.pgvector.split(".") if p.isdigit())
+        indexes = []
+        for r in rows:
+            options = dict(o.split("=", 1) for o in (r.options or []))
+            indexes.append({
+                "name": r.name,
+                "method": r.method,
+                "valid": r.valid,
+                "ready": r.ready,
+                "size_bytes": r.size_bytes,
+                "options": options,
+                "definition": r.definition,
+            })
+        live = [i for i in indexes if i["valid"]]
+        self.active_method = live[0]["method"] if live else None
+        self.active_lists = int(live[0]["options"].get("lists", 100)) if live and self.active_method == "ivfflat" else None
+        self._checked_at = time.monotonic()
+        return indexes
+
+    async def _recheck(self, session: AsyncSession) -> None:
+        """
+        Refresh active_method/active_lists/pgvector_version from the catalog
+        in the caller's transaction, once they are older than the recheck
+        interval: the index may have been created or replaced by another
+        worker since this one looked (e.g. it started before the index existed).
+        """
+        sql = text("""
+            SELECT (SELECT extversion FROM pg_extension WHERE extname = 'vector') AS pgvector,
+                   live.method, live.options
+            FROM (SELECT 1) one
+            LEFT JOIN LATERAL (
+                SELECT am.amname AS method, c.reloptions AS options
+                FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indexrelid
+                JOIN pg_am am ON am.oid = c.relam
+                JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+                WHERE i.indrelid = CAST(:table AS regclass) AND am.amname = ANY(:methods)
+                  AND a.attname = :column AND i.indisvalid
+                ORDER BY c.relname
+                LIMIT 1
+            ) live ON true
+        """)
+        # Set first, so concurrent requests don't all re-read
+        self._checked_at = time.monotonic()
+        row = (await session.execute(
+            sql, {"table": self.table, "methods": list(_VECTOR_METHODS), "column": self.column}
+        )).first()
+        if row.pgvector:
+            self.pgvector_version = tuple(int(p) for p in row.pgvector.split(".") if p.isdigit())
+        options = dict(o.split("=", 1) for o in (row.options or []))
+        if row.method != self.active_method:
+            logger.info(f"Vector index on {self.table}.{self.column} is now {row.method or 'missing'}.")
+        self.active_method = row.method
+        self.active_lists = int(options.get("lists", 100)) if row.method == "ivfflat" else None
+
+    async def health(self) -> Dict[str, Any]:
+        indexes = await self.inspect()
+        # Summed over the partitions of a partitioned table
+        sql = text("""
+            SELECT sum(greatest(c.reltuples, 0))::bigint AS estimated_rows,
+                   sum(pg_relation_size(c.oid))::bigint AS table_bytes,
+                   sum(s.n_live_tup)::bigint AS live_rows, sum(s.n_dead_tup)::bigint AS dead_rows,
+                   max(s.last_analyze) AS last_analyze, max(s.last_autoanalyze) AS last_autoanalyze
+            FROM pg_class c
+            LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+            WHERE c.oid = ANY(CAST(:leaves AS oid[]))
+        """)
+        async with engine.connect() as conn:
+            leaves = [oid for oid, _ in await self._leaves(conn, self.table)]
+            t = (await conn.execute(sql, {"leaves": leaves})).first()
+            building = self.building or await self._building_elsewhere(conn)
+        rows = max(int(t.live_rows or 0), int(t.estimated_rows or 0), 0)
+
+        warnings: List[str] = []
+        if any(not i["valid"] for i in indexes):
+            warnings.append("invalid index left by an interrupted concurrent build; rebuild to replace it")
+        if self.active_method is None:
+            status = "building" if building else "missing"
+        elif self.index_type != "none" and self.active_method != self.index_type:
+            status = "mismatch"
+            warnings.append(f"live index is {self.active_method}, VECTOR_INDEX_TYPE is {self.index_type}")
+        else:
+            status = "ok"
+        # Partitions get lists sized for their own rows at build time
+        if self.active_method == "ivfflat" and self.active_lists and not self.partitioned:
+            wanted = recommended_lists(rows)
+            if wanted > 2 * self.active_lists or wanted < self.active_lists / 2:
+                warnings.append(f"ivfflat has {self.active_lists} lists, {wanted} suit {rows} rows; rebuild")
+        return {
+            "status": status,
+            "warnings": warnings,
+            "configured": self.configured_params(rows),
+            "indexes": indexes,
+            "table": {
+                "partitioned": self.partitioned,
+                "partitions": len(leaves) if self.partitioned else None,
+                "rows": rows,
+                "dead_rows": t.dead_rows,
+                "size_bytes": t.table_bytes,
+                "last_analyze": (t.last_analyze or t.last_autoanalyze).isoformat()
+                if (t.last_analyze or t.last_autoanalyze) else None,
+            },
+            "building": building,
+            "last_error": self.last_error,
+            "default_search_mode": settings.vector_search_mode,
+        }
+
+    def configured_params(self, rows: int = 0) -> Dict[str, Any]:
+        if self.index_type == "hnsw":
+            return {"type": "hnsw", "m": settings.vector_index_m, "ef_construction": settings.vector_index_ef_construction}
+        if self.index_type == "ivfflat":
+            return {"type": "ivfflat", "lists": settings.vector_index_lists or recommended_lists(rows)}
+        return {"type": "none"}
+
+    # --- DDL -------------------------------------------------------------
+
+    @property
+    def building(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def _lock_key(self) -> str:
+        return f"vector_index:{self.table}.{self.column}"
+
+    async def _building_elsewhere(self, conn: Any) -> bool:
+        """
+        Whether some session holds the build lock (pg_advisory_lock of a
+        bigint key shows up split into classid/objid).
+        """
+        sql = text("""
+            SELECT EXISTS (
+                SELECT 1 FROM pg_locks
+                WHERE locktype = 'advisory' AND granted AND objsubid = 1
+                  AND database = (SELECT oid FROM pg_database WHERE datname = current_database())
+                  AND classid = CAST((CAST(hashtext(:key) AS bigint) >> 32) & 4294967295 AS oid)
+                  AND objid = CAST(CAST(hashtext(:key) AS bigint) & 4294967295 AS oid)
+            )
+        """)
+        return bool((await conn.execute(sql, {"key": self._lock_key})).scalar())
+
+    @staticmethod
+    async def _leaves(conn: Any, relation: str) -> List[Tuple[int, str]]:
+        """
+        (oid, name) of the partitions holding the rows of a table or index:
+        itself unless it is partitioned.
+        """
+        sql = text("""
+            SELECT c.oid, c.relname
+            FROM pg_partition_tree(CAST(:rel AS regclass)) t
+            JOIN pg_class c ON c.oid = t.relid
+            WHERE t.isleaf
+            ORDER BY c.relname
+        """)
+        rows = (await conn.execute(sql, {"rel": relation})).fetchall()
+        if rows:
+            return [(r.oid, r.relname) for r in rows]
+        oid = (await conn.execute(text("SELECT CAST(CAST(:rel AS regclass) AS oid)"), {"rel": relation})).scalar()
+        return [(oid, relation)]
+
+    async def _row_count(self, conn: Any, table: str) -> int:
+        return int((await conn.execute(text(f"SELECT count(*) FROM {table}"))).scalar())
+
+    async def _with_clause(self, conn: Any, table: str) -> str:
+        params = self.configured_params(await self._row_count(conn, table) if self.index_type == "ivfflat" else 0)
+        if params["type"] == "hnsw":
+            return f"m = {int(params['m'])}, ef_construction = {int(params['ef_construction'])}"
+        return f"lists = {int(params['lists'])}"
+
+    def _ddl(self, name: str, table: str, with_clause: str, concurrently: bool = True, only: bool = False) -> str:
+        return (
+            f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}{name} ON {'ONLY ' if only else ''}{table} "
+            f"USING {self.index_type} ({self.column} {self.opclass}) WITH ({with_clause})"
+        )
+
+    @asynccontextmanager
+    async def _maintenance_connection(self) -> AsyncIterator[Any]:
+        """
+        An autocommit connection of its own for index DDL, closed afterwards.
+        """
+        if not maintenance_engine:
+            raise RuntimeError(
+                "vector index builds need a direct or session-mode connection: "
+                "set DB_MAINTENANCE_URL when DB_PGBOUNCER_MODE=transaction"
+            )
+        async with maintenance_engine.connect() as conn:
+            yield await conn.execution_options(isolation_level="AUTOCOMMIT")
+
+    async def _drop(self, conn: Any, name: str) -> None:
+        """
+        Drop an index if it exists. Partitioned indexes can't be dropped
+        concurrently; that takes a short exclusive lock on the table, waited
+        for at most 10s.
+        """
+        partitioned = (await conn.execute(
+            text("SELECT relkind = 'I' FROM pg_class WHERE oid = to_regclass(:name)"), {"name": name}
+        )).scalar()
+        if partitioned:
+            await conn.execute(text("SET lock_timeout = '10s'"))
+            try:
+                await conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+            finally:
+                await conn.execute(text("RESET lock_timeout"))
+        else:
+            await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+    async def _build(self, name: str) -> None:
+        async with self._maintenance_connection() as conn:
+            # For this session only: the connection is closed after the build
+            await conn.execute(text("SELECT set_config('maintenance_work_mem', :v, false)"),
+                               {"v": settings.vector_index_maintenance_work_mem})
+            try:
+                if self.partitioned:
+                    await self._build_partitioned(conn, name)
+                else:
+                    ddl = self._ddl(name, self.table, await self._with_clause(conn, self.table))
+                    logger.info(f"Building vector index: {ddl}")
+                    await conn.execute(text(ddl))
+            except BaseException:
+                # A failed concurrent build leaves an INVALID index behind
+                await self._drop(conn, name)
+                raise
+
+    async def _build_partitioned(self, conn: Any, name: str) -> None:
+        leaves = await self._leaves(conn, self.table)
+        clauses = {oid: await self._with_clause(conn, table) for oid, table in leaves}
+        # The parent's options only matter for partitions attached later (and
+        # ivfflat probes); take them from the largest partition
+        parent_clause = max(clauses.values(), key=lambda c: int(c.rsplit("=", 1)[-1])) if clauses else (
+            await self._with_clause(conn, self.table)
+        )
+        ddl = self._ddl(name, self.table, parent_clause, concurrently=False, only=True)
+        logger.info(f"Building partitioned vector index: {ddl}")
+        await conn.execute(text("SET lock_timeout = '10s'"))
+        try:
+            await conn.execute(text(ddl))
+        finally:
+            await conn.execute(text("RESET lock_timeout"))
+        missing = text("""
+            SELECT c.oid, c.relname
+            FROM pg_partition_tree(CAST(:table AS regclass)) t
+            JOIN pg_class c ON c.oid = t.relid
+            WHERE t.isleaf AND NOT EXISTS (
+                SELECT 1 FROM pg_partition_tree(CAST(:index AS regclass)) p
+                JOIN pg_index i ON i.indexrelid = p.relid
+                WHERE i.indrelid = c.oid
+            )
+        """)
+        # Partitions attached during the build already got a child index; repeat until none is missing
+        while leaves := (await conn.execute(missing, {"table": self.table, "index": name})).fetchall():
+            for oid, table in leaves:
+                child = f"{name}_p{oid}"
+                await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {child}"))
+                clause = clauses.get(oid) or await self._with_clause(conn, table)
+                try:
+                    await conn.execute(text(self._ddl(child, table, clause)))
+                except BaseException:
+                    await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {child}"))
+                    raise
+                await conn.execute(text(f"ALTER INDEX {name} ATTACH PARTITION {child}"))
+                logger.info(f"Built vector index {child} on partition {table}.")
+
+    async def rebuild(self) -> Dict[str, Any]:
+        """
+        Build the configured index under a temporary name, then drop the old
+        vector indexes on the column and rename the new one into place.
+        Serialized across workers with an advisory lock.
+        """
+        if self.index_type == "none":
+            raise ValueError("VECTOR_INDEX_TYPE is 'none'")
+        lock_key = self._lock_key
+        async with self._maintenance_connection() as lock_conn:
+            locked = (await lock_conn.execute(
+                text("SELECT pg_try_advisory_lock(hashtext(:key))"), {"key": lock_key}
+            )).scalar()
+            if not locked:
+                raise IndexBuildInProgress("another worker is already building the vector index")
+            try:
+                temp = f"{self.name}_new"
+                await self.inspect()
+                async with self._maintenance_connection() as conn:
+                    await self._drop(conn, temp)
+                await self._build(temp)
+                old = [i["name"] for i in await self.inspect() if i["name"] != temp]
+                async with self._maintenance_connection() as conn:
+                    for name in old:
+                        await self._drop(conn, name)
+                    await conn.execute(text(f"ALTER INDEX {temp} RENAME TO {self.name}"))
+                    if self.partitioned:
+                        # Keep partition index names in step, so the next rebuild's temp names are free
+                        for oid, child in await self._leaves(conn, self.name):
+                            if child.startswith(f"{temp}_p"):
+                                await conn.execute(text(f"ALTER INDEX {child} RENAME TO {self.name}_p{child[len(temp) + 2:]}"))
+                    await conn.execute(text(f"ANALYZE {self.table}"))
+            finally:
+                await lock_conn.execute(
+                    text("SELECT pg_advisory_unlock(hashtext(:key))"), {"key": lock_key}
+                )
+        await self.inspect()
+        logger.info(f"Vector index {self.name} rebuilt ({self.active_method}).")
+        return {"name": self.name, "replaced": old}
+
+    def start_rebuild(self) -> bool:
+        """
+        Rebuild in the background; False if this worker is already building.
+        """
+        if self.building:
+            return False
+        self.last_error = None
+        self._task = asyncio.create_task(self.rebuild())
+
+        def done(task: asyncio.Task) -> None:
+            if task.cancelled() or task.exception() is None:
+                return
+            if isinstance(task.exception(), IndexBuildInProgress):
+                # Every worker tries on startup; one of them wins
+                logger.info(f"Vector index {self.name} is being built by another worker.")
+                return
+            self.last_error = str(task.exception())
+            logger.error(f"Vector index build failed: {task.exception()}")
+
+        self._task.add_done_callback(done)
+        return True
+
+    async def ensure(self) -> None:
+        """
+        Called on startup: look up the live index and, if there is none and
+        VECTOR_INDEX_AUTO_CREATE is set, build one in the background.
+        """
+        try:
+            await self.inspect()
+        except Exception as e:
+            logger.error(f"Could not inspect vector indexes: {e}")
+            return
+        if self.active_method is None and self.index_type != "none" and settings.vector_index_auto_create:
+            if not maintenance_engine:
+                logger.warning(
+                    f"No vector index on {self.table}.{self.column}, and none is built through a "
+                    f"transaction-mode pooler; set DB_MAINTENANCE_URL to a direct connection."
+                )
+                return
+            logger.info(f"No vector index on {self.table}.{self.column}; creating {self.index_type}.")
+            self.start_rebuild()
+
+    async def prewarm(self) -> Optional[int]:
+        """
+        Load the live vector index into Postgres shared buffers with
+        pg_prewarm, when that extension is installed, so the first searches
+        after a restart don't read it from disk. Returns the blocks loaded.
+        """
+        names = [i["name"] for i in await self.inspect() if i["valid"]]
+        if not names:
+            return None
+        async with engine.connect() as conn:
+            installed = (await conn.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_prewarm'"))).scalar()
+            if not installed:
+                return None
+            blocks = 0
+            for name in names:
+                # Per partition for a partitioned index
+                for oid, _ in await self._leaves(conn, name):
+                    res = await conn.execute(text("SELECT pg_prewarm(CAST(:oid AS oid))"), {"oid": oid})
+                    blocks += int(res.scalar())
+        return blocks
+
+    async def stop(self) -> None:
+        if self.building:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    # --- per-request tuning ----------------------------------------------
+
+    async def apply_search_params(
+        self, session: AsyncSession, mode: Optional[str], k: int, filtered: bool = False
+    ) -> None:
+        """
+        SET LOCAL the search effort for `mode` in the session's transaction.
+        A no-op when no vector index exists (the query is an exact scan).
+        What exists is re-read from the catalog every minute, and every few
+        seconds while there is no index.
+
+        With `filtered` (a WHERE clause that may reject rows the index
+        returns), pgvector >= 0.8 keeps scanning the index until k rows pass
+        (iterative scans) instead of returning fewer than k; results are
+        re-sorted by the caller, so ivfflat may use the relaxed order.
+        """
+        recheck = _RECHECK_MISSING_SECONDS if self.active_method is None else _RECHECK_SECONDS
+        if time.monotonic() - self._checked_at > recheck:
+            await self._recheck(session)
+        if self.active_method is None:
+            return
+        effort = SEARCH_MODES[mode or settings.vector_search_mode]
+        if self.active_method == "hnsw":
+            name, value = "hnsw.ef_search", max(int(effort["ef_search"]), k)
+        else:
+            name, value = "ivfflat.probes", max(1, round((self.active_lists or 100) * effort["probes_fraction"]))
+        params = {"name": name, "value": str(value)}
+        if filtered and self.pgvector_version and self.pgvector_version >= (0, 8):
+            # One round trip for both settings
+            sql = "SELECT set_config(:name, :value, true), set_config(:iter_name, :iter_value, true)"
+            params.update(
+                iter_name=f"{self.active_method}.iterative_scan",
+                iter_value="strict_order" if self.active_method == "hnsw" else "relaxed_order",
+            )
+        else:
+            sql = "SELECT set_config(:name, :value, true)"
+        await session.execute(text(sql), params)
+
+
+vector_index: VectorIndexManager = Lazy("vector_index", VectorIndexManager)  # type: ignore[assignment]
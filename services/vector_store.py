@@ -1,23 +1,40 @@
-from supabase import create_client
-from langchain_community.vectorstores import SupabaseVectorStore
-from langchain_openai import OpenAIEmbeddings
+from services.container import Lazy, resolve
 from config import settings
 
-# 1) Build a Supabase client from your URL and Key
-supabase_client = create_client(
-    settings.supabase_url,   # e.g. "https://abcd1234.supabase.co"
-    settings.supabase_key    # service_role or anon key
-)
-
-# 2) Initialize OpenAI embeddings
-embeddings = OpenAIEmbeddings(
-    model=settings.embedding_model,
-    openai_api_key=settings.openai_api_key,
-)
-
-# 3) Now pass the client into SupabaseVectorStore
-vector_store = SupabaseVectorStore(
-    client=supabase_client,
-    embedding=embeddings,
-    table_name=settings.supabase_table,  # e.g. "documents"
-)
\ No newline at end of file
+# Built on first use: importing this module doesn't load LangChain or connect to Supabase
+
+
+def _supabase_client():
+    from supabase import create_client
+
+    # 1) Build a Supabase client from your URL and Key
+    return create_client(
+        settings.supabase_url,   # e.g. "https://abcd1234.supabase.co"
+        settings.supabase_key    # service_role or anon key
+    )
+
+
+def _embeddings():
+    from langchain_openai import OpenAIEmbeddings
+
+    # 2) Initialize OpenAI embeddings
+    return OpenAIEmbeddings(
+        model=settings.embedding_model,
+        openai_api_key=settings.openai_api_key,
+    )
+
+
+def _vector_store():
+    from langchain_community.vectorstores import SupabaseVectorStore
+
+    # 3) Now pass the client into SupabaseVectorStore
+    return SupabaseVectorStore(
+        client=resolve(supabase_client),
+        embedding=resolve(embeddings),
+        table_name=settings.supabase_table,  # e.g. "documents"
+    )
+
+
+supabase_client = Lazy("supabase_client", _supabase_client)
+embeddings = Lazy("langchain_embeddings", _embeddings)
+vector_store = Lazy("vector_store", _vector_store)
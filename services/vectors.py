@@ -0,0 +1,144 @@
+import struct
+from typing import Any, Sequence
+import numpy as np
+from asyncpg import BitString
+from sqlalchemy.types import UserDefinedType
+
+# pgvector's binary wire format: uint16 dims, uint16 unused, then big-endian float32s
+_HEADER = struct.Struct(">HH")
+_WIRE_DTYPE = np.dtype(">f4")
+# halfvec (pgvector >= 0.7) uses the same header with big-endian float16s
+_HALF_WIRE_DTYPE = np.dtype(">f2")
+
+def _check(arr: np.ndarray) -> None:
+    # The same rules pgvector applies on input, raised before the round trip
+    if arr.ndim != 1:
+        raise ValueError("expected a 1-d vector")
+    if arr.shape[0] == 0:
+        raise ValueError("vector must have at least 1 dimension")
+    if not np.isfinite(arr).all():
+        raise ValueError("NaN and infinite values are not allowed in a vector")
+
+def as_float32(vector: Sequence[float] | np.ndarray) -> np.ndarray:
+    """
+    View/convert any vector-like value as a contiguous float32 array.
+    """
+    return np.ascontiguousarray(vector, dtype=np.float32)
+
+def encode_vector(vector: Sequence[float] | np.ndarray | bytes) -> bytes:
+    """
+    Encode to pgvector's binary format straight from a float32 buffer
+    (one vectorized byteswap, no per-element formatting). Already encoded
+    bytes (see vector_array) pass through.
+    """
+    if isinstance(vector, (bytes, bytearray, memoryview)):
+        return bytes(vector)
+    arr = np.asarray(vector, dtype=_WIRE_DTYPE)
+    _check(arr)
+    return _HEADER.pack(arr.shape[0], 0) + arr.tobytes()
+
+def vector_array(vectors: Sequence[Sequence[float] | np.ndarray]) -> list[bytes]:
+    """
+    Bind value for a `vector[]` parameter. asyncpg would treat numpy rows
+    as a nested array dimension, so each vector goes in pre-encoded.
+    """
+    return [encode_vector(v) for v in vectors]
+
+def decode_vector(data: bytes | memoryview) -> np.ndarray:
+    """
+    Decode pgvector's binary format into a native float32 array.
+    """
+    dims, _ = _HEADER.unpack_from(data)
+    return np.frombuffer(data, dtype=_WIRE_DTYPE, count=dims, offset=_HEADER.size).astype(np.float32)
+
+def encode_halfvec(vector: Sequence[float] | np.ndarray) -> bytes:
+    """
+    Encode to pgvector's binary `halfvec` format (float16, rounded from
+    float32; values beyond float16's range are rejected as infinite).
+    """
+    with np.errstate(over="ignore"):
+        arr = np.asarray(vector, dtype=_HALF_WIRE_DTYPE)
+    _check(arr)
+    return _HEADER.pack(arr.shape[0], 0) + arr.tobytes()
+
+def decode_halfvec(data: bytes | memoryview) -> np.ndarray:
+    """
+    Decode pgvector's binary `halfvec` format into a float32 array.
+    """
+    dims, _ = _HEADER.unpack_from(data)
+    return np.frombuffer(data, dtype=_HALF_WIRE_DTYPE, count=dims, offset=_HEADER.size).astype(np.float32)
+
+def binary_quantize(vector: Sequence[float] | np.ndarray) -> BitString:
+    """
+    One bit per dimension, set where the value is positive: the same as
+    pgvector's binary_quantize(), as a value for a `bit(n)` column.
+    """
+    arr = np.asarray(vector, dtype=np.float32)
+    return BitString.frombytes(np.packbits(arr > 0).tobytes(), bitlength=arr.shape[0])
+
+def to_pgvector_literal(vec: Sequence[float]) -> str:
+    """
+    Text literal form ('[0.1,0.2,...]'). Kept for comparison in
+    benchmarks/bench_vector_encoding.py; queries use the binary codec.
+    """
+    return f"[{','.join(f'{x:.6f}' for x in vec)}]"
+
+async def vector_schema(conn: Any) -> str:
+    """
+    Schema pgvector's types live in: the extension's schema, which is
+    `extensions` rather than `public` on Supabase.
+    """
+    schema = await conn.fetchval(
+        "SELECT n.nspname FROM pg_extension e JOIN pg_namespace n ON n.oid = e.extnamespace "
+        "WHERE e.extname = 'vector'"
+    )
+    return schema or "public"
+
+async def register_vector_codec(conn: Any, schema: str | None = None, halfvec: bool = False) -> None:
+    """
+    Register the binary `vector` codec on a raw asyncpg connection, and the
+    `halfvec` one with `halfvec=True` (skipped if pgvector is older than 0.7).
+    The types are looked up in the extension's schema unless `schema` is given.
+    """
+    if schema is None:
+        schema = await vector_schema(conn)
+    await conn.set_type_codec(
+        "vector",
+        schema=schema,
+        encoder=encode_vector,
+        decoder=decode_vector,
+        format="binary",
+    )
+    if halfvec:
+        try:
+            await conn.set_type_codec(
+                "halfvec",
+                schema=schema,
+                encoder=encode_halfvec,
+                decoder=decode_halfvec,
+                format="binary",
+            )
+        except ValueError:
+            pass  # unknown type: nothing can use it on this server either
+
+
+class PgVector(UserDefinedType):
+    """
+    SQLAlchemy column type for pgvector `vector(n)` that hands values to the
+    asyncpg binary codec untouched (pgvector.sqlalchemy.Vector converts to and
+    from text instead). Values come back as float32 numpy arrays.
+    """
+    cache_ok = True
+
+    def __init__(self, dim: int | None = None):
+        super().__init__()
+        self.dim = dim
+
+    def get_col_spec(self, **kw: Any) -> str:
+        return "VECTOR" if self.dim is None else f"VECTOR({self.dim})"
+
+    def bind_processor(self, dialect):
+        return None
+
+    def result_processor(self, dialect, coltype):
+        return None
@@ -0,0 +1,196 @@
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from services import answer_cache as answer_cache_module
+from services.answer_cache import AnswerCacheSync, SemanticAnswerCache
+
+DIMS = 16
+
+
+def _unit(i: int) -> np.ndarray:
+    v = np.zeros(DIMS, dtype=np.float32)
+    v[i] = 1.0
+    return v
+
+
+def _near(i: int, j: int, weight: float = 0.1) -> np.ndarray:
+    # Mostly axis i with a little of axis j: cosine ~0.995 with _unit(i)
+    return _unit(i) + weight * _unit(j)
+
+
+def _docs(similarity: float = 0.8, k: int = 2) -> list:
+    return [{"id": str(n), "similarity": similarity} for n in range(k)]
+
+
+def _cache(**kwargs) -> SemanticAnswerCache:
+    return SemanticAnswerCache(**{"threshold": 0.95, "max_entries": 4, "ttl": 3600.0, **kwargs})
+
+
+def test_hit_above_threshold():
+    cache = _cache()
+    cache.store(_unit(0), "answer 0", _docs(), k=2)
+    assert cache.lookup(_near(0, 1)) == ("answer 0", _docs())
+    assert cache.stats()["hits"] == 1
+
+
+def test_miss_below_threshold():
+    cache = _cache()
+    cache.store(_unit(0), "answer 0", _docs(), k=2)
+    assert cache.lookup(_unit(0) + _unit(1)) is None  # cosine ~0.71
+    assert cache.stats()["misses"] == 1
+
+
+def test_no_hit_in_another_scope():
+    cache = _cache()
+    cache.store(_unit(0), "manuals answer", _docs(), k=2, scope="collection=manuals")
+    assert cache.lookup(_unit(0), scope="collection=hr") is None
+    assert cache.lookup(_unit(0)) is None
+    assert cache.lookup(_unit(0), scope="collection=manuals") is not None
+
+
+def test_expired_entry_is_dropped():
+    cache = _cache(ttl=0.0)
+    cache.store(_unit(0), "answer 0", _docs(), k=2)
+    assert cache.lookup(_unit(0)) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_eviction_removes_the_least_used_entry():
+    cache = _cache(max_entries=3)
+    for i in range(3):
+        cache.store(_unit(i), f"answer {i}", _docs(), k=2)
+    cache.lookup(_unit(0))
+    cache.lookup(_unit(2))
+    cache.store(_unit(3), "answer 3", _docs(), k=2)
+    assert cache.lookup(_unit(1)) is None
+    assert [cache.lookup(_unit(i))[0] for i in (0, 2, 3)] == ["answer 0", "answer 2", "answer 3"]
+    assert cache.stats()["evictions"] == 1
+
+
+def test_eviction_prefers_the_oldest_among_equally_used():
+    cache = _cache(max_entries=2)
+    cache.store(_unit(0), "answer 0", _docs(), k=2)
+    cache.store(_unit(1), "answer 1", _docs(), k=2)
+    cache.store(_unit(2), "answer 2", _docs(), k=2)
+    assert cache.lookup(_unit(0)) is None
+    assert cache.lookup(_unit(1))[0] == "answer 1"
+
+
+def test_scan_drops_only_answers_a_new_chunk_could_change():
+    cache = _cache()
+    cache.store(_unit(0), "answer 0", _docs(similarity=0.8), k=2)
+    cache.store(_unit(1), "answer 1", _docs(similarity=0.8), k=2)
+    scan = cache.invalidation_scan()
+    # Closer to question 0 than its weakest source (0.8), far from question 1
+    scan.observe([_near(0, 2, 0.2)])
+    assert scan.apply() == 1
+    assert cache.lookup(_unit(0)) is None
+    assert cache.lookup(_unit(1))[0] == "answer 1"
+
+
+def test_unfilled_top_k_is_always_invalidated():
+    cache = _cache()
+    cache.store(_unit(0), "answer 0", _docs(k=1), k=2)
+    assert cache.invalidate([_unit(5)]) == 1
+
+
+def test_answer_cached_during_ingestion_is_dropped():
+    cache = _cache()
+    cache.store(_unit(0), "before", _docs(), k=2)
+    scan = cache.invalidation_scan()
+    scan.observe([_unit(5)])
+    # Answered while the ingestion ran: it never saw the new chunks
+    cache.store(_unit(1), "during", _docs(), k=2)
+    assert scan.apply() == 1
+    assert cache.lookup(_unit(0))[0] == "before"
+    assert cache.lookup(_unit(1)) is None
+
+
+def test_invalidate_without_vectors_clears_everything():
+    cache = _cache()
+    cache.store(_unit(0), "answer 0", _docs(), k=2)
+    cache.store(_unit(1), "answer 1", _docs(), k=2, scope="collection=hr")
+    assert cache.invalidate() == 2
+    assert cache.stats()["entries"] == 0
+
+
+def test_invalidate_collections_keeps_other_collections():
+    cache = _cache()
+    cache.store(_unit(0), "unscoped", _docs(), k=2)
+    cache.store(_unit(1), "hr", _docs(), k=2, scope="collection=hr")
+    cache.store(_unit(2), "manuals", _docs(), k=2, scope="collection=manuals&source=a.pdf")
+    assert cache.invalidate_collections(["manuals"]) == 2
+    assert cache.lookup(_unit(1), scope="collection=hr")[0] == "hr"
+
+
+# --- AnswerCacheSync ------------------------------------------------------
+
+class _FakeSession:
+    def __init__(self, rows):
+        self.rows = rows
+        self.params = None
+
+    async def execute(self, sql, params):
+        self.params = params
+        return SimpleNamespace(fetchall=lambda: self.rows)
+
+
+def _poll_rows(monkeypatch, *ingestions):
+    """
+    Make the next polls see `ingestions` as (id, collection) pairs.
+    """
+    now = datetime.now(timezone.utc)
+    rows = [SimpleNamespace(now=now, id=i, collection=c) for i, c in ingestions] or [
+        SimpleNamespace(now=now, id=None, collection=None)
+    ]
+    session = _FakeSession(rows)
+
+    @asynccontextmanager
+    async def get_session():
+        yield session
+
+    monkeypatch.setattr(answer_cache_module, "get_session", get_session)
+    return session
+
+
+@pytest.mark.anyio
+async def test_sync_skips_this_workers_ingestions(monkeypatch):
+    cache = _cache()
+    cache.store(_unit(0), "manuals", _docs(), k=2, scope="collection=manuals")
+    sync = AnswerCacheSync(cache, interval=1.0)
+    sync.seen("own-1")
+    _poll_rows(monkeypatch, ("own-1", "manuals"))
+    assert await sync.poll() == 0
+    assert cache.lookup(_unit(0), scope="collection=manuals") is not None
+
+
+@pytest.mark.anyio
+async def test_sync_invalidates_for_other_workers_ingestions_once(monkeypatch):
+    cache = _cache()
+    cache.store(_unit(0), "manuals", _docs(), k=2, scope="collection=manuals")
+    cache.store(_unit(1), "hr", _docs(), k=2, scope="collection=hr")
+    sync = AnswerCacheSync(cache, interval=1.0)
+    session = _poll_rows(monkeypatch, ("remote-1", "manuals"))
+    assert await sync.poll() == 1
+    assert cache.lookup(_unit(1), scope="collection=hr")[0] == "hr"
+    assert sync.stats()["remote_ingestions"] == 1
+
+    # The next poll overlaps the window: the same ingestion is not handled twice
+    cache.store(_unit(0), "manuals again", _docs(), k=2, scope="collection=manuals")
+    session = _poll_rows(monkeypatch, ("remote-1", "manuals"))
+    assert await sync.poll() == 0
+    assert session.params["since"] is not None
+    assert cache.lookup(_unit(0), scope="collection=manuals")[0] == "manuals again"
+
+
+@pytest.mark.anyio
+async def test_sync_poll_without_ingestions(monkeypatch):
+    cache = _cache()
+    cache.store(_unit(0), "answer", _docs(), k=2)
+    sync = AnswerCacheSync(cache, interval=1.0)
+    session = _poll_rows(monkeypatch)
+    assert await sync.poll() == 0
+    assert session.params["since"] is None
+    assert sync.stats()["polls"] == 1
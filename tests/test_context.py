@@ -0,0 +1,100 @@
+from services.context import SEPARATOR, ContextPacker, _merge_group, _overlap
+from services.tokens import count_tokens
+
+# Long enough that suffix/prefix matches count as splitter overlap
+OVERLAP = "the pump must be primed before the first start. "
+A = "Section 4 covers installation of the unit. " + OVERLAP
+B = OVERLAP + "Open the valve slowly and check the gauge."
+
+
+def _doc(id: str, content: str, similarity: float, source: str = "manual.pdf", page: int = 1) -> dict:
+    return {"id": id, "content": content, "similarity": similarity, "metadata": {"source": source, "page": page}}
+
+
+def test_overlap_at_splitter_boundary():
+    assert _overlap(A, B, max_chars=200) == len(OVERLAP)
+
+
+def test_overlap_needs_a_minimum_length():
+    assert _overlap("ends with the pump", "the pump starts", max_chars=200) == 0
+
+
+def test_overlap_only_searches_the_tail():
+    assert _overlap(A, B, max_chars=len(OVERLAP) - 1) == 0
+
+
+def test_no_overlap_between_unrelated_chunks():
+    assert _overlap(A, "A completely different paragraph about billing.", max_chars=200) == 0
+
+
+def test_merge_stitches_overlapping_chunks_in_either_order():
+    for docs in ([_doc("a", A, 0.9), _doc("b", B, 0.7)], [_doc("b", B, 0.7), _doc("a", A, 0.9)]):
+        [(text, similarity, ids)] = _merge_group(docs, max_overlap=200)
+        assert text == A + B[len(OVERLAP):]
+        assert similarity == 0.9
+        assert sorted(ids) == ["a", "b"]
+
+
+def test_merge_folds_a_fully_contained_chunk():
+    tail = "Open the valve slowly"
+    [(text, similarity, ids)] = _merge_group([_doc("a", B, 0.5), _doc("t", tail, 0.8)], max_overlap=200)
+    assert text == B
+    assert similarity == 0.8
+    assert sorted(ids) == ["a", "t"]
+
+
+def test_pack_merges_same_page_and_drops_exact_duplicates():
+    packer = ContextPacker(token_budget=1000, max_overlap=200)
+    packed = packer.pack([
+        _doc("a", A, 0.9),
+        _doc("b", B, 0.8),
+        _doc("dup", A, 0.85, source="other.pdf"),
+    ])
+    assert packed.text == A + B[len(OVERLAP):]
+    assert packed.segments == 1
+    assert packed.chunks == 3
+    assert packed.dropped == 0
+    assert packed.tokens < packed.raw_tokens
+    assert packer.stats()["requests"] == 1
+
+
+def test_pack_keeps_other_pages_apart_in_similarity_order():
+    packer = ContextPacker(token_budget=1000, max_overlap=200)
+    packed = packer.pack([_doc("a", A, 0.6, page=1), _doc("b", B, 0.9, page=2)])
+    assert packed.text == B + SEPARATOR + A
+    assert packed.doc_ids == ["b", "a"]
+
+
+def test_budget_truncates_the_best_segment():
+    text = "word " * 400
+    packed = ContextPacker(token_budget=50, max_overlap=200).pack([_doc("a", text, 0.9)])
+    assert packed.segments == 1
+    assert 0 < packed.tokens <= 50
+    assert text.startswith(packed.text)
+    assert packed.text != text
+
+
+def test_small_remainder_is_dropped_not_truncated():
+    first = "alpha " * 60
+    second = "beta " * 60
+    budget = count_tokens(first) + count_tokens(SEPARATOR) + 10  # less than _MIN_TAIL_TOKENS left
+    packed = ContextPacker(token_budget=budget, max_overlap=200).pack([
+        _doc("a", first, 0.9, page=1),
+        _doc("b", second, 0.5, page=2),
+    ])
+    assert packed.text == first
+    assert packed.dropped == 1
+    assert packed.doc_ids == ["a"]
+
+
+def test_larger_remainder_gets_a_truncated_segment():
+    first = "alpha " * 60
+    second = "beta " * 200
+    budget = count_tokens(first) + count_tokens(SEPARATOR) + 60
+    packed = ContextPacker(token_budget=budget, max_overlap=200).pack([
+        _doc("a", first, 0.9, page=1),
+        _doc("b", second, 0.5, page=2),
+    ])
+    assert packed.segments == 2
+    assert packed.tokens <= budget
+    assert packed.text.startswith(first + SEPARATOR + "beta")
@@ -0,0 +1,184 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from sqlalchemy import exc
+from services import history, metrics
+from services.history import HistoryWriter
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+def refreshes(monkeypatch):
+    """
+    Conversations a summary refresh was scheduled for, in order.
+    """
+    scheduled = []
+    monkeypatch.setattr(history, "schedule_summary_refresh", scheduled.append)
+    monkeypatch.setattr(history, "_turns_until_refresh", history.OrderedDict())
+    return scheduled
+
+
+def _writer(**kwargs) -> HistoryWriter:
+    """
+    A writer whose inserts are recorded in `writer.batches` instead of the DB.
+    """
+    writer = HistoryWriter(**kwargs)
+    writer.batches = []
+
+    async def insert(batch):
+        writer.batches.append([t.answer for t in batch])
+
+    writer._insert = insert
+    return writer
+
+
+def _data_error() -> exc.DBAPIError:
+    # What asyncpg's CharacterNotInRepertoireError (a NUL byte in text) becomes
+    return exc.DBAPIError("INSERT INTO chat_history ...", {}, SimpleNamespace(sqlstate="22021"))
+
+
+async def test_flushes_when_batch_is_full():
+    writer = _writer(max_batch=3, interval=60.0)
+    for i in range(3):
+        await writer.append("c1", "q", f"a{i}")
+    await asyncio.sleep(0.05)
+    assert writer.batches == [["a0", "a1", "a2"]]
+    assert writer.pending("c1") == []
+    await writer.aclose()
+
+
+async def test_flushes_after_interval():
+    writer = _writer(max_batch=100, interval=0.05)
+    await writer.append("c1", "q", "a0")
+    await writer.append("c2", "q", "a1")
+    await asyncio.sleep(0.01)
+    assert writer.batches == []
+    assert [t.answer for t in writer.pending("c1")] == ["a0"]
+    await asyncio.sleep(0.1)
+    assert writer.batches == [["a0", "a1"]]
+    await writer.aclose()
+
+
+async def test_aclose_writes_what_is_buffered():
+    writer = _writer(max_batch=100, interval=60.0)
+    await writer.append("c1", "q", "a0")
+    await writer.aclose()
+    assert writer.batches == [["a0"]]
+
+
+async def test_append_waits_when_max_pending_is_reached():
+    writer = _writer(max_batch=2, interval=0.0, max_pending=2)
+    release = asyncio.Event()
+    record = writer._insert
+
+    async def slow_insert(batch):
+        await release.wait()
+        await record(batch)
+
+    writer._insert = slow_insert
+    await writer.append("c1", "q", "a0")
+    await writer.append("c1", "q", "a1")
+    third = asyncio.create_task(writer.append("c1", "q", "a2"))
+    await asyncio.sleep(0.05)
+    assert not third.done()
+    assert writer.stats()["backpressure_waits"] == 1
+    release.set()
+    await asyncio.wait_for(third, 1.0)
+    await writer.aclose()
+    assert writer.batches == [["a0", "a1"], ["a2"]]
+    assert writer.stats()["unsaved"] == 0
+
+
+async def test_rejected_turn_is_dropped_and_later_turns_are_saved():
+    writer = _writer(max_batch=4, interval=60.0, retry_delay=0.01)
+    record = writer._insert
+
+    async def insert(batch):
+        if any("\x00" in t.answer for t in batch):
+            raise _data_error()
+        await record(batch)
+
+    writer._insert = insert
+    for answer in ["a0", "a1", "bad\x00", "a3"]:
+        await writer.append("c1", "q", answer)
+    await asyncio.sleep(0.05)
+    await writer.append("c1", "q", "a4")
+    await writer.aclose()
+    # Halves in order: [a0, a1], then [bad, a3] split into [bad] (dropped) and [a3]
+    assert writer.batches == [["a0", "a1"], ["a3"], ["a4"]]
+    stats = writer.stats()
+    assert stats["dropped"] == 1
+    assert stats["rows_written"] == 4
+    assert stats["unsaved"] == 0
+    assert writer.pending("c1") == []
+
+
+async def test_transient_failure_is_retried_in_order():
+    writer = _writer(max_batch=2, interval=60.0, retry_delay=0.01)
+    record = writer._insert
+    failures = [ConnectionResetError("connection reset")]
+
+    async def insert(batch):
+        if failures:
+            raise failures.pop()
+        await record(batch)
+
+    writer._insert = insert
+    await writer.append("c1", "q", "a0")
+    await writer.append("c1", "q", "a1")
+    await asyncio.sleep(0.1)
+    await writer.aclose()
+    assert writer.batches == [["a0", "a1"]]
+    assert writer.stats()["failures"] == 1
+    assert writer.stats()["dropped"] == 0
+
+
+async def test_summary_refresh_waits_for_a_full_window_plus_a_batch(monkeypatch, refreshes):
+    monkeypatch.setattr(history.settings, "history_max_turns", 3)
+    monkeypatch.setattr(history.settings, "history_summary_batch", 2)
+    monkeypatch.setattr(history.settings, "history_summary_enabled", True)
+    history.note_stored_turns("c1", 1)
+    writer = _writer(max_batch=1, interval=0.0)
+    for i in range(3):
+        await writer.append("c1", "q", f"a{i}")
+        await asyncio.sleep(0.01)
+    assert refreshes == []
+    # 1 stored + 4 saved = window of 3 + batch of 2: worth a refresh
+    await writer.append("c1", "q", "a3")
+    await asyncio.sleep(0.01)
+    assert refreshes == ["c1"]
+    # Then one check per batch of new turns
+    await writer.append("c1", "q", "a4")
+    await asyncio.sleep(0.01)
+    assert refreshes == ["c1"]
+    await writer.append("c1", "q", "a5")
+    await writer.aclose()
+    assert refreshes == ["c1", "c1"]
+
+
+async def test_full_window_checks_summary_on_next_save(monkeypatch, refreshes):
+    monkeypatch.setattr(history.settings, "history_summary_enabled", True)
+    history.note_stored_turns("c1", history.settings.history_max_turns)
+    writer = _writer(max_batch=1, interval=0.0)
+    await writer.append("c1", "q", "a0")
+    await writer.aclose()
+    assert refreshes == ["c1"]
+
+
+async def test_worker_does_not_inherit_the_request_timings():
+    writer = _writer(max_batch=1, interval=60.0)
+    seen = []
+
+    async def insert(batch):
+        seen.append(metrics._timings.get())
+
+    writer._insert = insert
+    token = metrics._timings.set({})  # as inside a sampled request
+    try:
+        await writer.append("c1", "q", "a0")
+    finally:
+        metrics._timings.reset(token)
+    await asyncio.sleep(0.05)
+    assert seen == [None]
+    await writer.aclose()
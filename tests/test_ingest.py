@@ -0,0 +1,132 @@
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from services import ingest
+from services.ingest import VersionDiff, chunk_hash, lookup_embeddings, plan_embeddings
+
+pytestmark = pytest.mark.anyio
+
+
+def _diff() -> VersionDiff:
+    # Previous version: "a" on pages 1 and 2 (and twice on page 1), "b" on page 1
+    return VersionDiff([
+        (1, chunk_hash("a"), 1),
+        (2, chunk_hash("a"), 1),
+        (3, chunk_hash("a"), 2),
+        (4, chunk_hash("b"), 1),
+    ])
+
+
+def test_chunk_hash_is_sha256_of_utf8():
+    assert chunk_hash("abc") == "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad"
+
+
+def test_unchanged_file_is_skipped():
+    diff = _diff()
+    assert diff.unchanged({"file_hash": "f1"}, "f1")
+    assert len(diff) == 4
+
+
+def test_changed_file_is_not_skipped():
+    assert not _diff().unchanged({"file_hash": "f1"}, "f2")
+
+
+def test_not_skipped_without_previous_ingestion_or_rows():
+    assert not _diff().unchanged(None, "f1")
+    assert not _diff().unchanged({}, "f1")
+    # Same file, but its rows are gone (e.g. deleted by hand): ingest again
+    assert not VersionDiff().unchanged({"file_hash": "f1"}, "f1")
+
+
+def test_unchanged_chunks_keep_their_rows():
+    diff = _diff()
+    assert diff.keep(chunk_hash("a"), 2)
+    assert diff.keep(chunk_hash("b"), 1)
+    assert diff.kept == [3, 4]
+
+
+def test_changed_chunks_are_embedded():
+    diff = _diff()
+    assert not diff.keep(chunk_hash("a, edited"), 1)
+    # Same text on another page is a different chunk
+    assert not diff.keep(chunk_hash("b"), 2)
+    assert diff.kept == []
+
+
+def test_duplicate_chunks_each_claim_one_row():
+    diff = _diff()
+    assert diff.keep(chunk_hash("a"), 1)
+    assert diff.keep(chunk_hash("a"), 1)
+    assert not diff.keep(chunk_hash("a"), 1)
+    assert sorted(diff.kept) == [1, 2]
+
+
+def test_vanished_chunks_are_deleted():
+    diff = _diff()
+    diff.keep(chunk_hash("a"), 1)
+    diff.keep(chunk_hash("b"), 1)
+    assert sorted(diff.kept + diff.vanished()) == [1, 2, 3, 4]
+    assert len(diff.vanished()) == 2
+    assert 3 in diff.vanished()
+
+
+def test_plan_embeddings_reuses_known_hashes():
+    known = {"h1": np.ones(3, dtype=np.float32)}
+    missing, reused = plan_embeddings(["h1", "h2", "h1", "h3", "h2"], known)
+    assert missing == ["h2", "h3"]
+    assert reused == 2
+
+
+def test_plan_embeddings_nothing_known():
+    assert plan_embeddings(["h1", "h1"], {}) == (["h1"], 0)
+
+
+@pytest.fixture
+def store(monkeypatch):
+    """
+    The documents table as (content_hash, embedding_model, embedding) rows,
+    queried the way lookup_embeddings' SQL filters them.
+    """
+    rows = [
+        (chunk_hash("shared"), "model-a", np.full(3, 1.0, dtype=np.float32)),
+        (chunk_hash("other"), "model-b", np.full(3, 2.0, dtype=np.float32)),
+    ]
+    calls = []
+
+    class Session:
+        async def execute(self, sql, params):
+            calls.append(params)
+            assert "metadata->>'embedding_model' = :model" in str(sql)
+            found = [
+                SimpleNamespace(content_hash=h, embedding=e)
+                for h, m, e in rows
+                if h in params["hashes"] and m == params["model"]
+            ]
+            return SimpleNamespace(fetchall=lambda: found)
+
+    @asynccontextmanager
+    async def get_session():
+        yield Session()
+
+    monkeypatch.setattr(ingest, "get_session", get_session)
+    return calls
+
+
+async def test_reuse_across_files_for_same_model(store):
+    found = await lookup_embeddings([chunk_hash("shared"), chunk_hash("new")], "model-a")
+    assert list(found) == [chunk_hash("shared")]
+    missing, reused = plan_embeddings([chunk_hash("shared"), chunk_hash("new")], found)
+    assert missing == [chunk_hash("new")]
+    assert reused == 1
+
+
+async def test_no_reuse_across_models(store):
+    found = await lookup_embeddings([chunk_hash("shared"), chunk_hash("other")], "model-b")
+    assert list(found) == [chunk_hash("other")]
+    assert store[-1]["model"] == "model-b"
+
+
+async def test_lookup_without_hashes_skips_the_query(store):
+    assert await lookup_embeddings([], "model-a") == {}
+    assert store == []
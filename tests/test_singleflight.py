@@ -0,0 +1,190 @@
+import asyncio
+import pytest
+from services.singleflight import SingleFlight, StreamSingleFlight, question_key
+
+pytestmark = pytest.mark.anyio
+
+
+def test_question_key_normalizes_case_and_whitespace():
+    assert question_key("What is  RAG?", "hybrid") == question_key(" what is rag? ", "hybrid")
+    assert question_key("What is RAG?", "hybrid") != question_key("What is RAG?", "vector")
+
+
+# --- SingleFlight ---------------------------------------------------------
+
+class _Work:
+    """
+    A call that blocks until released, counting runs and cancellations.
+    """
+
+    def __init__(self) -> None:
+        self.release = asyncio.Event()
+        self.runs = 0
+        self.cancelled = False
+
+    async def __call__(self) -> str:
+        self.runs += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        return "answer"
+
+
+async def test_concurrent_calls_share_one_run():
+    flights, work = SingleFlight(), _Work()
+    callers = [asyncio.create_task(flights.run("k", work)) for _ in range(3)]
+    await asyncio.sleep(0)
+    work.release.set()
+    assert await asyncio.gather(*callers) == ["answer"] * 3
+    assert work.runs == 1
+    assert flights.stats() == {"in_flight": 0, "leaders": 1, "followers": 2, "failures": 0, "abandoned": 0}
+
+
+async def test_follower_survives_leader_disconnect():
+    flights, work = SingleFlight(), _Work()
+    leader = asyncio.create_task(flights.run("k", work))
+    await asyncio.sleep(0)
+    follower = asyncio.create_task(flights.run("k", work))
+    await asyncio.sleep(0)
+    leader.cancel()
+    await asyncio.sleep(0)
+    assert not work.cancelled
+    work.release.set()
+    assert await follower == "answer"
+    assert leader.cancelled()
+    assert flights.abandoned == 0
+
+
+async def test_last_waiter_leaving_cancels_the_flight():
+    flights, work = SingleFlight(), _Work()
+    callers = [asyncio.create_task(flights.run("k", work)) for _ in range(2)]
+    await asyncio.sleep(0.01)
+    callers[0].cancel()
+    await asyncio.sleep(0)
+    assert not work.cancelled
+    callers[1].cancel()
+    await asyncio.gather(*callers, return_exceptions=True)
+    await asyncio.sleep(0)
+    assert work.cancelled
+    assert flights.stats()["abandoned"] == 1
+    assert flights.stats()["in_flight"] == 0
+
+
+async def test_failure_reaches_every_waiter_and_next_call_runs_again():
+    flights = SingleFlight()
+    calls = 0
+
+    async def fail() -> str:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream down")
+
+    results = await asyncio.gather(flights.run("k", fail), flights.run("k", fail), return_exceptions=True)
+    assert [type(r) for r in results] == [ValueError, ValueError]
+    assert calls == 1
+    with pytest.raises(ValueError):
+        await flights.run("k", fail)
+    assert calls == 2
+    assert flights.failures == 2
+
+
+# --- StreamSingleFlight ---------------------------------------------------
+
+class _Source:
+    """
+    An upstream stream that yields items as the test pushes them.
+    """
+
+    def __init__(self) -> None:
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.opens = 0
+        self.closed = False
+
+    async def open(self):
+        self.opens += 1
+        return "meta", self._items()
+
+    async def _items(self):
+        try:
+            while True:
+                item = await self.queue.get()
+                if item is None:
+                    return
+                yield item
+        finally:
+            self.closed = True
+
+    async def push(self, *items) -> None:
+        for item in items:
+            self.queue.put_nowait(item)
+        await asyncio.sleep(0.01)  # let the pump buffer them
+
+
+async def _take(stream, n: int) -> list:
+    return [await stream.__anext__() for _ in range(n)]
+
+
+async def test_late_joiner_replays_buffered_items():
+    flights, source = StreamSingleFlight(), _Source()
+    meta, first = await flights.join("k", source.open)
+    assert meta == "meta"
+    await source.push("a", "b")
+    assert await _take(first, 2) == ["a", "b"]
+
+    meta, late = await flights.join("k", source.open)
+    assert meta == "meta"
+    await source.push("c", None)
+    assert [item async for item in late] == ["a", "b", "c"]
+    assert [item async for item in first] == ["c"]
+    assert source.opens == 1
+    assert flights.stats()["late_joins"] == 1
+    assert flights.stats()["in_flight"] == 0
+
+
+async def test_stream_follower_survives_leader_disconnect():
+    flights, source = StreamSingleFlight(), _Source()
+    _, leader = await flights.join("k", source.open)
+    _, follower = await flights.join("k", source.open)
+    await source.push("a")
+    assert await _take(leader, 1) == ["a"]
+    await leader.aclose()
+    await source.push("b", None)
+    assert [item async for item in follower] == ["a", "b"]
+    assert flights.abandoned == 0
+
+
+async def test_last_subscriber_leaving_stops_the_upstream():
+    flights, source = StreamSingleFlight(), _Source()
+    _, first = await flights.join("k", source.open)
+    _, second = await flights.join("k", source.open)
+    await source.push("a")
+    await first.aclose()
+    assert not source.closed
+    await second.aclose()
+    await asyncio.sleep(0.01)
+    assert source.closed
+    assert flights.stats()["abandoned"] == 1
+    # The key is free again: the next join opens a new stream
+    await flights.join("k", source.open)
+    assert source.opens == 2
+
+
+async def test_stream_error_is_raised_to_subscribers():
+    flights = StreamSingleFlight()
+
+    async def open_stream():
+        async def items():
+            yield "a"
+            raise RuntimeError("upstream broke")
+        return "meta", items()
+
+    _, stream = await flights.join("k", open_stream)
+    received = []
+    with pytest.raises(RuntimeError, match="upstream broke"):
+        async for item in stream:
+            received.append(item)
+    assert received == ["a"]
+    assert flights.failures == 1
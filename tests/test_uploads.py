@@ -0,0 +1,149 @@
+import hashlib
+import os
+import pytest
+from starlette.requests import ClientDisconnect, Request
+from services import uploads
+from services.uploads import UPLOAD_SUBDIR, UploadError, save_pdf_upload
+
+pytestmark = pytest.mark.anyio
+
+BOUNDARY = "----test-boundary"
+PDF = b"%PDF-1.7\n" + bytes(range(256)) * 64 + b"\n%%EOF\n"
+
+
+def _body(content: bytes, filename: str = "manual.pdf", field: str = "file") -> bytes:
+    return (
+        f"--{BOUNDARY}\r\n"
+        f'Content-Disposition: form-data; name="collection"\r\n\r\nmanuals\r\n'
+        f"--{BOUNDARY}\r\n"
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        f"Content-Type: application/pdf\r\n\r\n"
+    ).encode() + content + f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+def _request(body: bytes, chunk_size: int = 1000, content_length: int | None = None, disconnect_after: int | None = None):
+    """
+    A request whose body arrives in `chunk_size` pieces, like from the socket.
+    Records how many pieces were read in `request.reads`.
+    """
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+    reads = []
+
+    async def receive():
+        n = len(reads)
+        reads.append(n)
+        if disconnect_after is not None and n >= disconnect_after:
+            return {"type": "http.disconnect"}
+        return {"type": "http.request", "body": chunks[n], "more_body": n < len(chunks) - 1}
+
+    headers = [(b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode())]
+    length = len(body) if content_length is None else content_length
+    headers.append((b"content-length", str(length).encode()))
+    request = Request({"type": "http", "method": "POST", "headers": headers}, receive)
+    request.reads = reads
+    return request
+
+
+def _leftovers(directory) -> list:
+    return sorted(
+        os.path.relpath(os.path.join(root, name), directory)
+        for root, _, files in os.walk(directory)
+        for name in files
+    )
+
+
+async def test_saves_under_a_unique_name_in_uploads(tmp_path):
+    saved = await save_pdf_upload(_request(_body(PDF)), str(tmp_path), max_bytes=1 << 20)
+    assert saved.filename == "manual.pdf"
+    assert os.path.dirname(saved.path) == str(tmp_path / UPLOAD_SUBDIR)
+    assert os.path.basename(saved.path).endswith("-manual.pdf")
+    assert saved.source == str(tmp_path / "manual.pdf")
+    assert saved.size == len(PDF)
+    assert saved.sha256 == hashlib.sha256(PDF).hexdigest()
+    with open(saved.path, "rb") as f:
+        assert f.read() == PDF
+    assert _leftovers(tmp_path) == [os.path.relpath(saved.path, tmp_path)]
+
+
+async def test_same_filename_gets_a_new_file(tmp_path):
+    first = await save_pdf_upload(_request(_body(PDF)), str(tmp_path), max_bytes=1 << 20)
+    second = await save_pdf_upload(_request(_body(PDF + b"v2")), str(tmp_path), max_bytes=1 << 20)
+    assert first.path != second.path
+    assert first.source == second.source
+    assert os.path.getsize(first.path) == len(PDF)
+
+
+async def test_filename_directories_are_stripped(tmp_path):
+    saved = await save_pdf_upload(_request(_body(PDF, filename="../../etc\\evil.pdf")), str(tmp_path), max_bytes=1 << 20)
+    assert saved.filename == "evil.pdf"
+    assert saved.path.startswith(str(tmp_path / UPLOAD_SUBDIR))
+
+
+async def test_content_length_over_limit_is_rejected_before_reading(tmp_path):
+    request = _request(_body(PDF), content_length=10 << 20)
+    with pytest.raises(UploadError) as e:
+        await save_pdf_upload(request, str(tmp_path), max_bytes=1 << 20)
+    assert e.value.status_code == 413
+    assert request.reads == []
+
+
+async def test_oversize_while_streaming_removes_the_partial_file(tmp_path):
+    big = PDF + b"x" * (200 << 10)
+    # Content-Length understated: only streaming can catch it
+    request = _request(_body(big), content_length=1000)
+    with pytest.raises(UploadError) as e:
+        await save_pdf_upload(request, str(tmp_path), max_bytes=100 << 10)
+    assert e.value.status_code == 413
+    assert len(request.reads) < len(_body(big)) // 1000
+    assert _leftovers(tmp_path) == []
+
+
+async def test_not_a_pdf_is_rejected(tmp_path):
+    with pytest.raises(UploadError) as e:
+        await save_pdf_upload(_request(_body(b"<html>" + b"x" * 4096)), str(tmp_path), max_bytes=1 << 20)
+    assert e.value.status_code == 415
+    assert _leftovers(tmp_path) == []
+
+
+async def test_small_non_pdf_is_rejected_at_commit(tmp_path):
+    with pytest.raises(UploadError) as e:
+        await save_pdf_upload(_request(_body(b"hello")), str(tmp_path), max_bytes=1 << 20)
+    assert e.value.status_code == 415
+    assert _leftovers(tmp_path) == []
+
+
+async def test_wrong_extension_is_rejected(tmp_path):
+    with pytest.raises(UploadError) as e:
+        await save_pdf_upload(_request(_body(PDF, filename="manual.docx")), str(tmp_path), max_bytes=1 << 20)
+    assert e.value.status_code == 400
+
+
+async def test_missing_file_field_is_rejected(tmp_path):
+    with pytest.raises(UploadError) as e:
+        await save_pdf_upload(_request(_body(PDF, field="attachment")), str(tmp_path), max_bytes=1 << 20)
+    assert e.value.status_code == 400
+    assert _leftovers(tmp_path) == []
+
+
+async def test_client_disconnect_removes_the_partial_file(tmp_path):
+    request = _request(_body(PDF), disconnect_after=5)
+    with pytest.raises(ClientDisconnect):
+        await save_pdf_upload(request, str(tmp_path), max_bytes=1 << 20)
+    assert _leftovers(tmp_path) == []
+
+
+async def test_writes_are_batched(tmp_path, monkeypatch):
+    writes = []
+    to_thread = uploads.asyncio.to_thread
+
+    async def counting_to_thread(fn, *args):
+        writes.append(fn)
+        return await to_thread(fn, *args)
+
+    monkeypatch.setattr(uploads.asyncio, "to_thread", counting_to_thread)
+    content = PDF + os.urandom(3 << 20)
+    saved = await save_pdf_upload(_request(_body(content), chunk_size=64 << 10), str(tmp_path), max_bytes=8 << 20)
+    # ~50 network chunks, 3 full blocks plus the final write at commit
+    assert len(writes) <= 4
+    with open(saved.path, "rb") as f:
+        assert f.read() == content
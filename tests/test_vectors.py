@@ -0,0 +1,71 @@
+import struct
+import numpy as np
+import pytest
+from services.vectors import (
+    binary_quantize,
+    decode_halfvec,
+    decode_vector,
+    encode_halfvec,
+    encode_vector,
+    vector_array,
+)
+
+
+def test_vector_round_trip():
+    vec = np.random.default_rng(0).standard_normal(1536).astype(np.float32)
+    decoded = decode_vector(encode_vector(vec))
+    assert decoded.dtype == np.float32
+    np.testing.assert_array_equal(decoded, vec)
+
+
+def test_vector_wire_format():
+    data = encode_vector([1.0, -2.5])
+    # uint16 dims, uint16 unused, then big-endian float32s
+    assert data == struct.pack(">HHff", 2, 0, 1.0, -2.5)
+    assert decode_vector(memoryview(data)).tolist() == [1.0, -2.5]
+
+
+def test_vector_accepts_lists_and_passes_encoded_bytes_through():
+    data = encode_vector([0.5, 0.25, 0.125])
+    assert encode_vector(data) == data
+    assert vector_array([[0.5, 0.25, 0.125], np.array([1, 2, 3])]) == [data, encode_vector([1.0, 2.0, 3.0])]
+
+
+def test_halfvec_round_trip():
+    vec = np.random.default_rng(1).standard_normal(1536).astype(np.float32)
+    data = encode_halfvec(vec)
+    assert struct.unpack_from(">HH", data) == (1536, 0)
+    assert len(data) == 4 + 2 * 1536
+    np.testing.assert_allclose(decode_halfvec(data), vec, rtol=1e-3, atol=1e-4)
+    assert decode_halfvec(data).dtype == np.float32
+
+
+def test_halfvec_wire_format():
+    assert encode_halfvec([1.0, -2.0]) == b"\x00\x02\x00\x00" + np.array([1.0, -2.0], dtype=">f2").tobytes()
+
+
+@pytest.mark.parametrize("encode", [encode_vector, encode_halfvec])
+@pytest.mark.parametrize("bad", [[], [1.0, float("nan")], [float("inf")], [[1.0, 2.0]]])
+def test_rejects_what_pgvector_rejects(encode, bad):
+    with pytest.raises(ValueError):
+        encode(bad)
+
+
+def test_halfvec_rejects_values_beyond_float16():
+    with pytest.raises(ValueError):
+        encode_halfvec([70000.0])
+
+
+def test_binary_quantize_matches_pgvector():
+    # SELECT binary_quantize('[1,-1,0,2,0.5,-3,1,1,1]'::vector) = 100110111:
+    # a bit per dimension, set where the value is > 0, first dimension first
+    bits = binary_quantize([1, -1, 0, 2, 0.5, -3, 1, 1, 1])
+    assert bits.as_string().replace(" ", "") == "100110111"
+    assert len(bits) == 9
+
+
+def test_binary_quantize_full_width():
+    vec = np.random.default_rng(2).standard_normal(1536)
+    bits = binary_quantize(vec)
+    assert len(bits) == 1536
+    assert bits.as_string().replace(" ", "") == "".join("1" if v > 0 else "0" for v in vec)